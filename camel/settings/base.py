@@ -20,6 +20,7 @@ TEX_ROOT  = os.path.join(SITE_ROOT, 'data/tex/')
 PDF_ROOT  = os.path.join(SITE_ROOT, 'data/pdf/')
 CSV_ROOT  = os.path.join(SITE_ROOT, 'data/csv/')
 XML_ROOT  = os.path.join(SITE_ROOT, 'data/xml/')
+PARSE_CACHE_ROOT = os.path.join(SITE_ROOT, 'data/cache/')
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.8/howto/deployment/checklist/
 
@@ -105,3 +106,18 @@ STATICFILES_DIRS = (
 )
 # redirect
 LOGIN_URL = '/login/'
+
+# caches: rendered book fragments go to BOOK_CACHE (see core/templatetags/bookcache.py)
+# entries never expire: refresh bumps Book.revision, which is part of every key
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'books': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'camel-books',
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_ENTRIES': 2000},
+    },
+}
+BOOK_CACHE = 'books'
@@ -21,3 +21,11 @@ DATABASES = {
 }
 
 ALLOWED_HOSTS = ['camel.maths.cf.ac.uk']
+
+# rendered book fragments (shared by the server processes)
+CACHES['books'] = {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': os.path.join(SITE_ROOT, 'data/fragments/'),
+    'TIMEOUT': None,
+    'OPTIONS': {'MAX_ENTRIES': 20000},
+}
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+'''
+bookgen.py: generate synthetic camel.cls books (for benchmarks and tests)
+
+    generate_book(directory, ...) writes a book that TexParser accepts:
+
+        <directory>/main.tex            preamble, \input of each chapter file
+        <directory>/camel.cls           copy of the class file of the example book (if found)
+        <directory>/chNN.tex            one file per chapter
+
+    Each chapter has sections and subsections with theorems (and proofs), figures,
+    tabulars, itemize lists, a homework with nested questions/parts/subparts, a single
+    choice test, and \ref commands to labels in earlier chapters. The output only
+    depends on the arguments, so benchmark runs are comparable.
+
+    Does not import Django.
+'''
+
+#------------------------------------------------
+# imports
+import os, shutil
+
+# the class file of the example book (copied next to main.tex)
+CAMEL_CLS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'tex', 'MA1234', 'camel.cls')
+
+PREAMBLE = r'''%% main.tex - synthetic book (core/bookgen.py)
+\documentclass{camel}
+
+\academicyear{%(year)s}
+\modulecode{%(code)s}
+\moduletitle{Synthetic Module}
+\booknumber{1}
+\booktitle{Synthetic Book}
+\bookversion{v1.0}
+
+\def\bit{\begin{itemize}}
+\def\eit{\end{itemize}}
+\newcommand{\R}{\mathbb{R}}
+
+\begin{document}
+\makefrontmatter
+%(inputs)s
+\end{document}
+'''
+
+PARAGRAPH = r'''Let $x_%(n)d\in\R$ and consider \emph{the sum} $\sum_{k=1}^{%(n)d} x_k$, which is
+\textbf{finite}. The case~%(n)d is treated as in the previous section\par
+'''
+
+#------------------------------------------------
+# generator
+#------------------------------------------------
+def generate_book(directory, module_code='MA9999', chapters=5, sections=3, subsections=2,
+                  theorems=2, questions=4, parts=3, subparts=2, figures=1, tabulars=1, refs=2):
+    '''
+    Write a synthetic book to directory, returns the path of main.tex
+    '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if os.path.exists(CAMEL_CLS):
+        shutil.copy(CAMEL_CLS, directory)
+
+    names = []
+    for ch in range(1, chapters + 1):
+        name = 'ch%02d' % ch
+        names.append( name )
+        with open(os.path.join(directory, name + '.tex'), 'w') as f:
+            f.write( chapter_source(ch, sections, subsections, theorems, questions, parts, subparts, figures, tabulars, refs) )
+
+    main_tex = os.path.join(directory, 'main.tex')
+    with open(main_tex, 'w') as f:
+        inputs = '\n'.join( r'\input{%s}' % name for name in names )
+        f.write( PREAMBLE % {'year': '2015-16', 'code': module_code, 'inputs': inputs} )
+    return main_tex
+
+def chapter_source(ch, sections, subsections, theorems, questions, parts, subparts, figures, tabulars, refs):
+    '''
+    LaTeX source of chapter ch
+    '''
+    lines = [ r'\chapter{Chapter %d}\label{ch:%d}' % (ch, ch), PARAGRAPH % {'n': ch} ]
+    for se in range(1, sections + 1):
+        lines.append( r'\section{Section %d.%d}\label{se:%d-%d}' % (ch, se, ch, se) )
+        lines.append( PARAGRAPH % {'n': se} )
+        for ss in range(1, subsections + 1):
+            tag = '%d-%d-%d' % (ch, se, ss)
+            lines.append( r'\subsection{Subsection %d.%d.%d}' % (ch, se, ss) )
+            lines.append( PARAGRAPH % {'n': ss} )
+            for th in range(1, theorems + 1):
+                lines.append( theorem_source('%s-%d' % (tag, th), ch, refs) )
+            for fig in range(1, figures + 1):
+                lines.append( figure_source('%s-%d' % (tag, fig)) )
+            for tab in range(1, tabulars + 1):
+                lines.append( tabular_source(tab) )
+            lines.append( r'\bit' )
+            lines.extend( r'\item Item %d of subsection %s.' % (n, tag) for n in range(1, 4) )
+            lines.append( r'\eit' )
+        lines.append( homework_source('%d-%d' % (ch, se), questions, parts, subparts) )
+    lines.append( test_source(ch) )
+    return '\n'.join(lines) + '\n'
+
+def theorem_source(tag, ch, refs):
+    # refer to theorems in this chapter and in earlier chapters
+    targets = [ r'Theorem~\ref{thm:%d-1-1-1}' % max(1, ch - n) for n in range(refs) ]
+    return '\n'.join([
+        r'\begin{theorem}[Result %s]\label{thm:%s}' % (tag, tag),
+        r'If $a^2 + b^2 = c^2$ then, by %s,' % ', '.join(targets) if targets else r'If $a^2 + b^2 = c^2$ then',
+        r'\begin{equation}',
+        r'c = \sqrt{a^2 + b^2}.',
+        r'\end{equation}',
+        r'\end{theorem}',
+        r'\begin{proof}',
+        r'Take square roots (see Section~\ref{se:%d-1}).' % ch,
+        r'\end{proof}',
+    ])
+
+def figure_source(tag):
+    return '\n'.join([
+        r'\begin{figure}',
+        r'\centering',
+        r'\includegraphics{figure.png}',
+        r'\caption{Figure %s}\label{fig:%s}' % (tag, tag),
+        r'\end{figure}',
+    ])
+
+def tabular_source(n):
+    rows = [ r'%d & $%d^2$ & %d \\' % (k, k, k * k) for k in range(1, 5) ]
+    return '\n'.join( [ r'\begin{center}', r'\begin{tabular}{lll}' ] + rows + [ r'\end{tabular}', r'\end{center}' ] )
+
+def homework_source(tag, questions, parts, subparts):
+    lines = [ r'\begin{homework}\label{hw:%s}' % tag, r'\begin{questions}' ]
+    for qu in range(1, questions + 1):
+        lines.append( r'\question Question %d of homework %s.\label{qu:%s-%d}' % (qu, tag, tag, qu) )
+        if parts:
+            lines.append( r'\begin{parts}' )
+            for pa in range(1, parts + 1):
+                lines.append( r'\part Part %d, show that $x^%d \geq 0$.' % (pa, 2 * pa) )
+                if subparts:
+                    lines.append( r'\begin{subparts}' )
+                    lines.extend( r'\subpart Subpart %d.' % sp for sp in range(1, subparts + 1) )
+                    lines.append( r'\end{subparts}' )
+                lines.append( r'\begin{answer}Because squares are non-negative.\end{answer}' )
+            lines.append( r'\end{parts}' )
+        else:
+            lines.append( r'\begin{answer}An answer.\end{answer}' )
+    lines += [ r'\end{questions}', r'\end{homework}' ]
+    return '\n'.join(lines)
+
+def test_source(ch):
+    return '\n'.join([
+        r'\begin{singlechoice}\label{sc:%d}' % ch,
+        r'\begin{questions}',
+        r'\question Which of these is prime?',
+        r'\begin{choices}',
+        r'\choice 4',
+        r'\choice 6',
+        r'\correctchoice %d' % [2, 3, 5, 7, 11][ch % 5],
+        r'\end{choices}',
+        r'\end{questions}',
+        r'\end{singlechoice}',
+    ])
@@ -4,7 +4,10 @@ doctree.py: build book tree from latex file (camel.cls)
 
     1. latex file -> book_tree
     2. book_tree -> xml
-    3. book_tree <-> django models -> database objects
+    3. book_tree <-> django models -> database objects (see bookwriter.py)
+
+    This module does not import Django, so it can be used (and run with python -m
+    core.booktree) without any Django settings.
 
     #--------------------
     General
@@ -121,12 +124,15 @@ doctree.py: build book tree from latex file (camel.cls)
 
 #------------------------------------------------
 # imports
-import sys, os, re, logging
+import sys, os, re, logging, multiprocessing
 import xml.etree.ElementTree as ET
 import xml.dom.minidom as minidom
 
-import core.models
-from django.db.models import ImageField
+from core.tokenizer import TokenStream
+from core.parsecache import ParseCache
+from core import preprocess
+from core.macros import MacroTable, read_group
+from core.stats import Stats
 
 #------------------------------------------------
 # logging
@@ -163,6 +169,25 @@ item_dict = {
     'checkboxes':   'choice|correctchoice',
 }
 
+#------------------------------------------------
+# functions
+#------------------------------------------------
+def hexlabel(idx):
+    '''
+    One mpath component: the index of a node among its siblings, e.g. 0a
+    '''
+    return hex( idx )[2:].zfill(2)
+
+def xml_escape(value):
+    '''
+    Escape text or an attribute value for xml output (str values are utf-8)
+    '''
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    elif not isinstance(value, unicode):
+        value = unicode(value)
+    return value.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'"', u'&quot;').replace(u'>', u'&gt;')
+
 #------------------------------------------------
 # classes
 #------------------------------------------------
@@ -183,39 +208,73 @@ item_dict = {
 #         if self.tree: s += '\n' + self.tree.__repr__()
 #         return s
 #
+class Counters(object):
+    '''
+    LaTeX-style counters for a single parse (owned by TexParser)
+    Each node class declares the counters it steps (Node.counters, the last one sets
+    node.number) and the counters it resets (Node.resets), e.g. a chapter steps
+    'chapter' and resets 'section', 'theorem', 'figure' etc.
+    '''
+    def __init__(self):
+        self.values = {}
+
+    def step(self, node):
+        for name in node.counters:
+            self.values[name] = self.values.get(name, 0) + 1
+            node.number = self.values[name]
+        for name in node.resets:
+            self.values[name] = 0
+        return node
+
+class NodeType(type):
+    '''
+    Metaclass for booktree nodes: every node class gets __slots__ (empty unless the class
+    declares its own) so that no node carries a __dict__, and node_type (the lowercase
+    class name, e.g. 'theorem'). NodeType.classes maps node_type to the node class.
+    '''
+    classes = {}
+
+    def __new__(mcs, name, bases, attrs):
+        attrs.setdefault('__slots__', ())
+        attrs['node_type'] = name.lower()
+        cls = type.__new__(mcs, name, bases, attrs)
+        mcs.classes[ cls.node_type ] = cls
+        return cls
+
 class Node(object):
-    counter = 0    
+    __metaclass__ = NodeType
+    __slots__ = ('node_id', 'children', 'parent', 'path', 'title', 'label', 'number', 'content')
+    counters = ()   # counters stepped by this node (the last one is its number), see Counters
+    resets = ()     # counters reset by this node
     def __init__(self, parent=None):
-        Node.counter += 1
-        self.node_id = Node.counter
+        self.node_id = None     # set by TexParser.number_nodes
         self.children = []
         self.parent = parent
+        self.path = None        # mpath, set for the whole tree by TexParser.number_nodes
+        self.title = None
+        self.label = None
+        self.number = None
+        self.content = None
         
     # get mpath
     def mpath(self):
+        if self.path is not None:
+            return self.path
         if not self.parent:
             return ''
         idx = self.parent.children.index(self)
-        hexstr = hex( idx )[2:].zfill(2)
-        return self.parent.mpath() + '.' + hexstr
+        return self.parent.mpath() + '.' + hexlabel(idx)
 
     
-    # def hexlabel(self, index):
-    #     return hex( idx )[2:].zfill(2)
-        
     # "native" output
     def __repr__(self):
         s = ("%s" % self.mpath())
         s += ': '
         s += self.__class__.__name__ 
-        if hasattr(self, 'number') and self.number:
+        if self.number:
             s += ': ' + str( self.number )
-        if hasattr(self, 'title') and self.title:
+        if self.title:
             s += ': ' + self.title
-        if hasattr(self, 'source') and self.content:
-            s += ': ' + self.source
-        if hasattr(self, 'htex') and self.htex:
-            s += ': ' + self.htex
         s += '\n'
         for child in self.children:
             s += child.__repr__()
@@ -224,19 +283,19 @@ class Node(object):
     
     # xml output
     def xml(self):
-        element = ET.Element(self.__class__.__name__.lower())
+        element = ET.Element(self.node_type)
         
         # set attributes
         # element.set('node_id', str(self.node_id))
-        if hasattr(self, 'number') and self.number:
+        if self.number:
             element.set('number',  str(self.number))
-        if hasattr(self, 'title') and self.title:
+        if self.title:
             element.set('title', self.title)
-        if hasattr(self, 'label') and self.label:
+        if self.label:
             element.set('label', self.label)
 
         # set content 
-        if hasattr(self, 'content') and self.content:
+        if self.content:
             element.text = self.content.strip()
        
         # recursive call
@@ -245,57 +304,45 @@ class Node(object):
             element.append(child_element)
         return element
 
+    # streaming xml output (one line at a time, same layout as minidom's toprettyxml)
+    def iter_xml(self, indent='  '):
+        stack = [ (self, 0, True) ]
+        while stack:
+            node, depth, entering = stack.pop()
+            pad = indent * depth
+            if not entering:
+                yield u'%s</%s>\n' % (pad, node.node_type)
+                continue
+
+            # attributes (sorted by name)
+            attrs = u''
+            for name, value in (('label', node.label), ('number', node.number), ('title', node.title)):
+                if value:
+                    attrs += u' %s="%s"' % (name, xml_escape(value))
+            text = xml_escape( node.content.strip() ) if node.content else u''
+
+            if node.children:
+                yield u'%s<%s%s>\n' % (pad, node.node_type, attrs)
+                if text:
+                    yield u'%s%s%s\n' % (pad, indent, text)
+                stack.append( (node, depth, False) )
+                for child in reversed(node.children):
+                    stack.append( (child, depth + 1, True) )
+            elif text:
+                yield u'%s<%s%s>%s</%s>\n' % (pad, node.node_type, attrs, text, node.node_type)
+            else:
+                yield u'%s<%s%s/>\n' % (pad, node.node_type, attrs)
+
     # list of (label, mpath) pairs
     def get_label_mpaths(self):
         pairs = []
-        if hasattr(self, 'label') and self.label:
+        if self.label:
             pairs.append( (self.label, self.mpath() ) )
         for child in self.children:
             pairs.extend( child.get_label_mpaths() )
         return pairs
     
 
-    # camel output (writes to database)
-    def write_to_camel_database(self, parent=None, commit=False, prefix=None, is_readonly=False):
-
-        # create booknode
-        booknode = core.models.BookNode(node_id=self.node_id)
-
-        booknode.mpath = self.mpath()
-        if prefix:
-            booknode.mpath = prefix + booknode.mpath
-
-        # set attributes
-        # booknode.module = module
-        if parent:
-            booknode.parent = parent
-        booknode.is_readonly = is_readonly            
-        booknode.node_type = self.__class__.__name__.lower()
-        booknode.node_class = node_classes[booknode.node_type]
-        if hasattr(self, 'label'):
-            booknode.label = self.label
-        if hasattr(self, 'number'):
-            booknode.number = self.number
-        if hasattr(self, 'title'):
-            booknode.title = self.title
-            
-        if hasattr(self, 'content'):
-            if booknode.node_type == "image":
-                booknode.image = self.content
-            else:
-                booknode.text = self.content
-                  
-        # write to database
-        print booknode
-        if commit: 
-            booknode.save()
-
-        # recursive call
-        for child in self.children:
-            child.write_to_camel_database(parent=booknode, prefix=prefix, commit=commit)
-            
-        return booknode
-        
 #-----------------------------
 # blocks: nodes with a title and/or label (both can be null)
 #-----------------------------
@@ -309,69 +356,64 @@ class Block(Node):
 # book block (root)
 #-----------------------------
 class Book(Block):
+    __slots__ = ('author', 'version', 'new_commands', 'tree')    # set by TexParser.make_book
     def __init__(self, title=None, label=None, parent=None):
         Block.__init__(self, title=title, label=label, parent=parent)
-        Chapter.number = 0
-        Section.counter = 0
-        Subsection.counter = 0
-        Theorem.counter = 0
-        Figure.counter = 0
-        Table.counter = 0
-        List.counter = 0
+        self.author = None
+        self.version = None
+        self.new_commands = None
+        self.tree = None
+
+    # xml document (with stylesheet), one line at a time
+    def iter_xml_document(self):
+        yield u'<?xml version="1.0" ?>\n'
+        yield u'<?xml-stylesheet type="text/css" href="xmlbook.css"?>\n'
+        for line in self.iter_xml():
+            yield line
 
     # prettyprint xml tree
     def prettyprint_xml(self):
-        xml_tree = self.xml()
-        xml_str = ET.tostring(xml_tree, 'utf-8')
-        dom = minidom.parseString(xml_str)
-        proc_ins = dom.createProcessingInstruction('xml-stylesheet', 'type="text/css" href="xmlbook.css"')
-        root = dom.firstChild
-        dom.insertBefore(proc_ins, root)
-        return dom.toprettyxml(indent="  ")
+        return u''.join( self.iter_xml_document() )
+
+    # write xml tree to a file object (incrementally, utf-8)
+    def write_xml(self, f):
+        for line in self.iter_xml_document():
+            f.write( line.encode('utf-8') )
+
+    # write xml tree to a file (e.g. in XML_ROOT)
+    def save_xml(self, filename):
+        if not os.path.isdir( os.path.dirname(filename) ):
+            os.makedirs( os.path.dirname(filename) )
+        with open(filename, 'wb') as f:
+            self.write_xml( f )
 
 #-----------------------------
 # level blocks
 #-----------------------------
 class Chapter(Block):
-    counter = 0
+    counters = ('chapter',)
+    resets = ('section', 'subsection', 'theorem', 'homework', 'test', 'figure', 'subfigure', 'table', 'list')
     def __init__(self, title=None, label=None, parent=None):
         Block.__init__(self, title=title, label=label, parent=parent)
-        Chapter.counter += 1
-        self.number = Chapter.counter
-        Section.counter = 0
-        Subsection.counter = 0
-        Theorem.counter = 0
-        Homework.counter = 0
-        Questions.counter = 0
-        Figure.counter = 0
-        Subfigure.counter = 0
-        Table.counter = 0
-        List.counter = 0
     
 class Section(Block):
-    counter = 0
+    counters = ('section',)
+    resets = ('subsection',)
     def __init__(self, title=None, label=None, parent=None):
         Block.__init__(self, title=title, label=label, parent=parent)
-        Section.counter += 1
-        self.number = Section.counter
-        Subsection.counter = 0
 
 class Subsection(Block):
-    counter = 0
+    counters = ('subsection',)
     def __init__(self, title=None, label=None, parent=None):
         Block.__init__(self, title=title, label=label, parent=parent)
-        Subsection.counter += 1
-        self.number = Subsection.counter
     
 #-----------------------------
 # theorem blocks
 #-----------------------------
 class Theorem(Block):
-    counter = 0
+    counters = ('theorem',)
     def __init__(self, title=None, label=None, parent=None):
         Block.__init__(self, title=title, label=label, parent=parent)
-        Theorem.counter += 1
-        self.number = Theorem.counter
 
 class Lemma(Theorem):
     def __init__(self, title=None, label=None, parent=None):
@@ -401,23 +443,18 @@ class Exercise(Theorem):
 # assignment blocks
 #-----------------------------
 class Assignment(Block):
-    counter = 0
     def __init__(self, title=None, label=None, parent=None):
         Block.__init__(self, title=title, label=label, parent=parent)
 
 class Homework(Assignment):
-    counter = 0
+    counters = ('homework',)
     def __init__(self, title=None, label=None, parent=None):
         Assignment.__init__(self, title=title, label=label, parent=parent)
-        Homework.counter += 1
-        self.number = Homework.counter
 
 class Test(Assignment):
-    counter = 0
+    counters = ('test',)
     def __init__(self, title=None, label=None, parent=None):
         Assignment.__init__(self, title=title, label=label, parent=parent)
-        Test.counter += 1
-        self.number = Test.counter
 
 class Singlechoice(Test):
     def __init__(self, title=None, label=None, parent=None):
@@ -443,12 +480,10 @@ class Multiplechoice(Test):
 # list blocks (no title)
 #-----------------------------
 class List(Block):
-    counter = 0
+    counters = ('list',)
+    resets = ('item',)
     def __init__(self, label=None, parent=None):
         Block.__init__(self, label=label, parent=parent)
-        List.counter += 1
-        self.number = List.counter
-        Item.counter = 0
 
 class Itemize(List):
     def __init__(self, label=None, parent=None):
@@ -459,73 +494,57 @@ class Enumerate(List):
         List.__init__(self, label=label, parent=parent)
 
 class Questions(List):
+    resets = ('item', 'question', 'part', 'subpart', 'choice')
     def __init__(self, label=None, parent=None):
         List.__init__(self, label=label, parent=parent)
-        Question.counter = 0
-        Part.counter = 0
-        Subpart.counter = 0
-        Choice.counter = 0
 
 class Parts(List):
+    resets = ('item', 'part', 'subpart', 'choice')
     def __init__(self, label=None, parent=None):
         List.__init__(self, label=label, parent=parent)
-        Part.counter = 0
-        Subpart.counter = 0
-        Choice.counter = 0
 
 class Subparts(List):
+    resets = ('item', 'subpart', 'choice')
     def __init__(self, label=None, parent=None):
         List.__init__(self, label=label, parent=parent)
-        Subpart.counter = 0
-        Choice.counter = 0
 
 class Choices(List):
+    resets = ('item', 'choice')
     def __init__(self, label=None, parent=None):
         List.__init__(self, label=label, parent=parent)
-        Choice.counter = 0
 
 class Checkboxes(List):
+    resets = ('item', 'choice')
     def __init__(self, label=None, parent=None):
         List.__init__(self, label=label, parent=parent)
-        Choice.counter = 0
 
 #-----------------------------
 # item blocks (no title)
 #-----------------------------
 class Item(Block):
-    counter = 0
+    counters = ('item',)
     def __init__(self, label=None, parent=None):
         Block.__init__(self, label=label, parent=parent)
-        Item.counter += 1
-        self.number = Item.counter
 
 class Question(Item):
-    counter = 0
+    counters = ('item', 'question')
     def __init__(self, label=None, parent=None):
         Item.__init__(self, label=label, parent=parent)
-        Question.counter += 1
-        self.number = Question.counter
 
 class Part(Item):
-    counter = 0
+    counters = ('item', 'part')
     def __init__(self, label=None, parent=None):
         Item.__init__(self, label=label, parent=parent)
-        Part.counter += 1
-        self.number = Part.counter
 
 class Subpart(Item):
-    counter = 0
+    counters = ('item', 'subpart')
     def __init__(self, label=None, parent=None):
         Item.__init__(self, label=label, parent=parent)
-        Subpart.counter += 1
-        self.number = Subpart.counter
 
 class Choice(Item):
-    counter = 0
+    counters = ('item', 'choice')
     def __init__(self, label=None, parent=None):
         Item.__init__(self, label=label, parent=parent)
-        Choice.counter += 1
-        self.number = Choice.counter
 
 class Correctchoice(Choice):
     def __init__(self, label=None, parent=None):
@@ -566,33 +585,25 @@ class Center(Block):
 # float blocks
 #-----------------------------
 class Figure(Block):
-    counter = 0
+    counters = ('figure',)
+    resets = ('subfigure',)
     def __init__(self, title=None, label=None, parent=None):
         Block.__init__(self, title=title, label=label, parent=parent)
-        Figure.counter += 1
-        self.number = Figure.counter
-        Subfigure.counter = 0
 
 class Subfigure(Block):
-    counter = 0
+    counters = ('subfigure',)
     def __init__(self, title=None, label=None, parent=None):
         Block.__init__(self, title=title, label=label, parent=parent)
-        Subfigure.counter += 1
-        self.number = Subfigure.counter
 
 class Table(Block):
-    counter = 0
+    counters = ('table',)
     def __init__(self, title=None, label=None, parent=None):
         Block.__init__(self, title=title, label=label, parent=parent)
-        Table.counter += 1
-        self.number = Table.counter
 
 class Subtable(Block):
-    counter = 0
+    counters = ('subtable',)
     def __init__(self, title=None, label=None, parent=None):
         Block.__init__(self, title=title, label=label, parent=parent)
-        Subtable.counter += 1
-        self.number = Subtable.counter
 
 
 #-----------------------------
@@ -645,112 +656,205 @@ class Jax(Content):
         #     self.htex = ''
         #     return
         
-        # remove comments (line-by-line) - now done in TexParser.read_latex_file()
+        # remove comments (line-by-line) - now done in preprocess.strip_comments()
         # lines = content.strip().split('\n')
         # for idx in range( len(lines) ):
         #     lines[idx] = re.sub(r'\%.*$', "", lines[idx])
         # s = '\n'.join(lines) + '\n'
         
-        s = content
-        
-        # temporary hack: kill mathmode labels (MathJax can be configured to handle these)
-        s = re.sub(r'\\label\{([^\}]*)\}', r'',s)
-
-        # font styles
-        s = re.sub(r'\\emph\{([^\}]*)\}',r'<i>\1</i>',s)
-        s = re.sub(r'\\textit\{([^\}]*)\}',     r'<i>\1</i>',s)
-        s = re.sub(r'\\textbf\{([^\}]*)\}',     r'<b>\1</b>',s)
-        s = re.sub(r'\\texttt\{([^\}]*)\}',     r'<tt>\1</tt>',s)
-        s = re.sub(r'\\underline\{([^\}]*)\}',  r'<u>\1</u>',s)
-        
-        # spacing
-        s = re.sub(r'\\vspace[\*]?\{[^\}]\w+\}',r'<p>',s)
-        s = re.sub(r'\\hspace[\*]?\{[^\}]\w+\}',r'&nbsp;&nbsp;',s)
-        
-        # custom
-        s = re.sub(r'\\proofomitted',           r'<i>[Proof omitted]</i><br/>', s)
-
-        # layout
-        s = re.sub(r'\\paragraph\{([^\}]*)\}',  r'<br>\n<b>\\1</b>\n',s)
-        s = re.sub(r'\\par\s+',                 r'<br>',s)
-        s = re.sub(r'\\bigskip\s+',             r'<br>',s)
-
-        # tricky
-        s = re.sub(r'\\percent', r'&#37;',s)
-        s = re.sub(r'\\\&', r'&amp;',s)
-        s = re.sub(r'~', r'&nbsp;',s)
-        
-        # kill
-        s = re.sub(r'\\maketitle',          r'',s)
-        s = re.sub(r'\\tableofcontents',    r'',s)
-        s = re.sub(r'\\makefrontmatter',    r'',s)
-        s = re.sub(r'\\clearpage',          r'',s)
-        s = re.sub(r'\\cleardoublepage',    r'',s)
-        s = re.sub(r'\\break',              r'',s)
-        s = re.sub(r'\\newpage',            r'',s)
-        s = re.sub(r'\\label\{.*\}',        r'',s)  # already extracted
-        s = re.sub(r'\\centering',          r'',s)
-        s = re.sub(r'\\hfill',              r'',s)
-        s = re.sub(r'\\vfill',              r'',s)
-        s = re.sub(r'\\if.*',               r'',s)
-        s = re.sub(r'\\small',              r'',s)
-        s = re.sub(r'\\normalsize',         r'',s)
-        s = re.sub(r'\\endinput',           r'',s)
-        s = re.sub(r'\ ',                   r' ',s)
-            
         # set field value (tidy up)
-        self.content = s.strip()
+        self.content = clean_jax( content ).strip()
     
 
+#-----------------------------
+# Jax cleanup
+#-----------------------------
+# (pattern, replacement) pairs, applied in a single scan of each Jax fragment
+# replacement is either a string, or an (open, close) pair of tags that are wrapped around
+# the (cleaned) argument of the command: the pattern then ends with the opening brace and
+# the argument is read as a balanced group, so that commands nest (\textbf{\emph{x}})
+jax_substitutions = (
+
+    # temporary hack: kill mathmode labels (MathJax can be configured to handle these)
+    (r'\\label\{[^\}]*\}',                ''),
+
+    # font styles
+    (r'\\emph\{',                        ('<i>', '</i>')),
+    (r'\\textit\{',                      ('<i>', '</i>')),
+    (r'\\textbf\{',                      ('<b>', '</b>')),
+    (r'\\texttt\{',                      ('<tt>', '</tt>')),
+    (r'\\underline\{',                   ('<u>', '</u>')),
+
+    # spacing
+    (r'\\vspace[\*]?\{[^\}]\w+\}',        '<p>'),
+    (r'\\hspace[\*]?\{[^\}]\w+\}',        '&nbsp;&nbsp;'),
+
+    # custom
+    (r'\\proofomitted',                   '<i>[Proof omitted]</i><br/>'),
+
+    # layout (\paragraph{title} gives a literal \1, not the title)
+    (r'\\paragraph\{[^\}]*\}',            '<br>\n<b>\\1</b>\n'),
+    (r'\\par\s+',                         '<br>'),
+    (r'\\bigskip\s+',                     '<br>'),
+
+    # tricky
+    (r'\\percent',                        '&#37;'),
+    (r'\\\&',                             '&amp;'),
+    (r'~',                                '&nbsp;'),
+
+    # kill
+    (r'\\maketitle',                      ''),
+    (r'\\tableofcontents',                ''),
+    (r'\\makefrontmatter',                ''),
+    (r'\\clearpage',                      ''),
+    (r'\\cleardoublepage',                ''),
+    (r'\\break',                          ''),
+    (r'\\newpage',                        ''),
+    (r'\\centering',                      ''),
+    (r'\\hfill',                          ''),
+    (r'\\vfill',                          ''),
+    (r'\\if.*',                           ''),
+    (r'\\small',                          ''),
+    (r'\\normalsize',                     ''),
+    (r'\\endinput',                       ''),
+)
+
+def compile_alternation(substitutions):
+    '''
+    Combine (pattern, replacement) pairs into one regex
+    Returns the regex and a dictionary {number of the group that wraps a pattern: replacement}
+    Patterns that start with a backslash share it, i.e. \\(?:(emph...)|(textbf...))|(~), so that
+    the regex engine can skip quickly to the next backslash (or other first character).
+    '''
+    commands = [ (pattern[2:], replacement) for pattern, replacement in substitutions if pattern.startswith(r'\\') ]
+    others = [ (pattern, replacement) for pattern, replacement in substitutions if not pattern.startswith(r'\\') ]
+    groups = {}
+    alternatives = []
+    group = 1
+    for pattern, replacement in commands + others:
+        groups[group] = replacement
+        alternatives.append( '(%s)' % pattern )
+        group += re.compile(pattern).groups + 1
+    regex = r'\\(?:' + '|'.join( alternatives[:len(commands)] ) + ')'
+    if others:
+        regex += '|' + '|'.join( alternatives[len(commands):] )
+    return re.compile( regex ), groups
+
+jax_pattern, jax_groups = compile_alternation( jax_substitutions )
+
+def clean_jax(s):
+    '''
+    Convert the text-mode LaTeX in a Jax fragment to html (see jax_substitutions)
+    '''
+    parts = []
+    pos = 0
+    while True:
+        match = jax_pattern.search( s, pos )
+        if match is None:
+            break
+        replacement = jax_groups[ match.lastindex ]
+        end = match.end()
+        if isinstance(replacement, tuple):
+            argument, end = read_group( s, end - 1 )
+            if argument is None:
+                # unbalanced: leave the command as it is
+                parts.append( s[pos:match.end()] )
+                pos = match.end()
+                continue
+            replacement = replacement[0] + clean_jax( argument ) + replacement[1]
+        parts.append( s[pos:match.start()] )
+        parts.append( replacement )
+        pos = end
+    parts.append( s[pos:] )
+    return ''.join( parts )
+
+#-----------------------------
+# parse errors
+class ParseError(ValueError):
+    '''
+    Error in the latex source, at filename:lineno if known (see preprocess.SourceMap)
+    '''
+    def __init__(self, message, filename=None, lineno=None):
+        if filename:
+            message = '%s:%d: %s' % (filename, lineno, message)
+        ValueError.__init__(self, message)
+        self.filename = filename
+        self.lineno = lineno
+
+#-----------------------------
+# worker function (chapters are parsed in a process pool, see TexParser.parse_body)
+def parse_chapter(task):
+    chunk, source_map, macros, profile = task
+    p = TexParser(profile=profile)
+    p.macros = macros
+    return p.parse_chunk( chunk, source_map ), p.stats
+
 #-----------------------------
 # TexParser class (root node of document tree)
 class TexParser(object):
     # init
-    def __init__(self):
-        pass
-    
-    def read_latex_file(self, filename, level=0):
-        if level > 4:
-            print('error: read_body: recursion limit reached (max = 4)')
-            return ''
-        
-        # open file
-        with open(filename) as f:
-            f_str = f.read()
-        
-            # remove comments (line-by-line)
-            lines = f_str.strip().split('\n')
-            for idx in range( len(lines) ):
-                lines[idx] = re.sub(r'\%.*$', "", lines[idx])
-            f_str = '\n'.join(lines) + '\n'
-        
-            # find input commands
-            pattern = re.compile(r'[^%+]\\input\{([^\}]*)\}')
-            matches = re.finditer(pattern, f_str)
-            
-            # return contents if no \input commands (end recursion)
-            if not matches:
-                return f_str
-            
-            # otherwise process \input commands
-            else:
-                s = ''
-                start_index = 0
-                for match in matches:
-                    end_index = match.start()
-                    s += f_str[ start_index:end_index ]
-                    start_index = match.end()
-                    nested_filename = match.groups()[0]
-                    # append .tex extension if necessary
-                    if not re.search(r'\.', nested_filename):
-                        nested_filename = nested_filename + '.tex'
-                    nested_filename = os.path.join(os.path.dirname(filename), nested_filename)
-                    out.info('File: %s', nested_filename)
-                    # recursive call
-                    s += self.read_latex_file(nested_filename, level=level+1)
-                s += f_str[start_index:]
-                return s
-    
+    def __init__(self, cache_dir=None, jobs=1, profile=False):
+        '''
+        cache_dir: directory for the parse cache (unchanged chapter files are not re-parsed)
+        jobs:      number of processes used to parse chapters
+        profile:   time the parser stages (see stats.py)
+        '''
+        self.cache = ParseCache(cache_dir) if cache_dir else None
+        self.jobs = jobs
+        self.counters = Counters()
+        self.stats = Stats(profile)    # stage timers, node counts, bytes read (see stats.py)
+        self.macros = MacroTable()  # user macros of the preamble (set by parse_body)
+        self.cache_version = None   # hash of camel.cls and the parser (see cache_key)
+
+    def read_latex_file(self, filename):
+        '''
+        Returns the preprocessed contents of filename (see preprocess.py)
+        '''
+        self.cache_version = None
+        lines = preprocess.expand_shorthands( preprocess.read_source(filename) )
+        return ''.join( line.text for line in lines )
+
+    def read_chunks(self, main_file):
+        '''
+        Yields the document body of main_file as (chunk, source_map), one chunk at a time
+        The body is read through the preprocessor pipeline (see preprocess.py) and split into
+        chunks at the \input files that begin with \chapter.
+        '''
+        chunks = preprocess.chunk_source( preprocess.read_document(main_file), main_file )
+        while True:
+            with self.stats.timer('read'):
+                item = next( chunks, None )
+            if item is None:
+                return
+            self.stats.bytes += len( item[0] )
+            yield item
+
+    def read_macros(self, main_file):
+        '''
+        Returns the table of user macros (\newcommand, \def) defined in the preamble of main_file
+        '''
+        lines = preprocess.read_preamble( main_file )
+        return MacroTable.parse( ''.join( line.text for line in lines ) )
+
+    def cache_key(self, main_file, chunk):
+        '''
+        Content hash of a chapter chunk, plus the hash of camel.cls, of the parser itself
+        (booktree.py, tokenizer.py and macros.py) and of the macro definitions (macros are
+        expanded during parsing)
+        '''
+        if self.cache_version is None:
+            here = os.path.dirname(os.path.abspath(__file__))
+            sources = [ os.path.join(here, 'booktree.py'), os.path.join(here, 'tokenizer.py'), os.path.join(here, 'macros.py') ]
+            cls_file = os.path.join(os.path.dirname(main_file), 'camel.cls')
+            if os.path.exists(cls_file):
+                sources.append( cls_file )
+            contents = []
+            for source in sources:
+                with open(source) as f:
+                    contents.append( f.read() )
+            self.cache_version = ParseCache.key(*contents)
+        return ParseCache.key(self.cache_version, self.macros.key(), chunk)
+
     
     def read_preamble(self, filename):
         with open(filename) as f:
@@ -793,20 +897,11 @@ class TexParser(object):
     
     def read_body(self, filename):
         s = self.read_latex_file(filename)
-        s = self.fix_latex(s)
         pattern = r'\\begin{document}(.*)\\end{document}' 
         match = re.compile(pattern, re.DOTALL).search( s )
         body = match.groups()[0] if match else ''
         return body
 
-    def fix_latex(self, s):
-        s = re.sub(r'\\bit\s+', r'\\begin{itemize} ', s)
-        s = re.sub(r'\\eit\s+', r'\\end{itemize} ', s)
-        s = re.sub(r'\\ben\s+', r'\\begin{enumerate} ', s)
-        s = re.sub(r'\\een\s+', r'\\end{enumerate} ', s)
-        s = re.sub(r'\\it\s+', r'\\item ', s)
-        return s
-        
     
     
     def make_book(self, main_file="main.tex"):
@@ -891,26 +986,16 @@ class TexParser(object):
         if match:
             preamble_data['book_version'] = match.groups()[0]
 
-        # newcommands (keep as latex for mathjax to handle)
-        newcmds = []    
-        pattern = re.compile(r'(\\newcommand\{[^\}]*\}\{.*\})') # dodgy
-        matches = re.finditer(pattern, preamble)
-        for match in matches:
-            newcmds.append( match.groups()[0] )
-        # defs
-        pattern = re.compile(r'(\\def\\(\w+)\{.*\})') # dodgy
-        matches = re.finditer(pattern, preamble)
-        for match in matches:
-            newcmds.append( match.groups()[0] )
-
-        preamble_data['new_commands'] = '\n'.join( newcmds )
+        # newcommands and defs (expanded by the parser, but kept as latex for mathjax
+        # to handle in answers typed by students)
+        preamble_data['new_commands'] = self.read_macros( main_file ).latex()
         return preamble_data
 
 
     def parse_body(self, main_file):
         '''
         1. Chop into chapters/sections/subsections.
-            LaTeX allows content *before* the first chapter etc., so this is tricky. 
+            LaTeX allows content *before* the first chapter etc., so this is tricky.
             We want to avoid creating a "Chapter 0", "Section 0.1" and so on.
             The children of the Book element should just be a sequence of BookNodes
             This method uses recursion (with an explicit stack), but it pays off later.
@@ -933,39 +1018,153 @@ class TexParser(object):
                     - block
                     - section
                         -block
-            
+
         2. Call parse_snippet recursively on the resulting blocks
             We have recursed down through chapters, sections and subsections
             We now proceed to process the blocks that these represent
+
+        3. Chapter files are parsed (and cached) independently
+            The body is split into chunks that start with a \chapter command (usually one
+            chunk per \input file). If the parser has a cache, each chunk is looked up by
+            its content hash and only chunks that have changed are parsed. With jobs > 1
+            the remaining chapters are parsed in a process pool. Chapter numbers and
+            node_ids are fixed up once the chunks have been stitched together.
+            The chunks are read one at a time (see read_chunks) and handed to the parser
+            (or the pool) as they are read, so the source text of the book is not held in
+            memory as a whole (only the chunks waiting for a worker of the pool are).
+
+        Each chunk is tokenized once (see tokenizer.py). From here on, every snippet is
+        described by a range of token indices [lo, hi) and a range of character
+        indices [start, end) into the same token stream.
+
+        4. User macros (\newcommand, \def in the preamble) are expanded in the content of
+            Jax nodes and in titles, so MathJax does not have to (see macros.py).
         '''
-        
-        # extract body
-        body = self.read_body( main_file )
+        root = Book()
+        self.macros = self.read_macros( main_file )
+        self.cache_version = None   # camel.cls may have changed since the last parse
+        book_counters = Counters()
+
+        # chapter subtrees in document order: lists of nodes (from the cache, or parsed without
+        # their parent link), or (AsyncResult, cache key) for the chunks parsed in the pool
+        parts = []
+        pool = None
+        try:
+            for chunk, source_map in self.read_chunks( main_file ):
+                if not chunk.lstrip().startswith('\\chapter'):
+                    # content before the first chapter is parsed directly into the book
+                    self.counters = book_counters
+                    first = len( root.children )
+                    self.parse_levels( self.tokenize(chunk, source_map), root )
+                    parts.append( root.children[first:] )
+                    del root.children[first:]
+                    continue
+                key = self.cache_key( main_file, chunk ) if self.cache else None
+                nodes = self.cache.get( key ) if self.cache else None
+                if nodes is None and pool is None and self.jobs > 1 and not multiprocessing.current_process().daemon:
+                    # worker processes (e.g. refresh --jobs) cannot start a pool of their own
+                    pool = multiprocessing.Pool( self.jobs )
+                if nodes is None and pool:
+                    parts.append( (pool.apply_async( parse_chapter, [(chunk, source_map, self.macros, self.stats.enabled)] ), key) )
+                    continue
+                if nodes is None:
+                    nodes = self.parse_chunk( chunk, source_map )
+                    if self.cache:
+                        self.cache.put( key, nodes )
+                parts.append( nodes )
+
+            # stitch together
+            for nodes in parts:
+                if isinstance(nodes, tuple):
+                    result, key = nodes
+                    nodes, stats = result.get()
+                    self.stats.merge( stats )
+                    if self.cache:
+                        self.cache.put( key, nodes )
+                for node in nodes:
+                    node.parent = root
+                root.children.extend( nodes )
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        if self.cache:
+            out.info('Parse cache: %d hits, %d misses', self.cache.hits, self.cache.misses)
+
+        self.number_nodes( root )
+        return root
+
+    def parse_chunk(self, chunk, source_map=None):
+        '''
+        Parse a chapter chunk into a list of nodes without a parent (chapters do not depend on
+        each other, so every chunk gets fresh counters and the chapter numbers are fixed up later)
+        '''
+        self.counters = Counters()
+        chunk_root = Block()
+        self.parse_levels( self.tokenize(chunk, source_map), chunk_root )
+        nodes = chunk_root.children
+        for node in nodes:
+            node.parent = None
+        return nodes
+
+    def tokenize(self, chunk, source_map=None):
+        with self.stats.timer('tokenize'):
+            return TokenStream( chunk, source_map )
+
+    def error(self, stream, offset, message):
+        '''
+        Returns a ParseError for the character offset in stream (located in the original file)
+        '''
+        filename, lineno = stream.source_map.locate(offset) if stream.source_map else (None, None)
+        return ParseError( message, filename, lineno )
 
-        # find all level commands 
-        pattern = r'\\(chapter|section|subsection)\{([^\}]*)\}'
-        matches = re.finditer(pattern, body)
+    def number_nodes(self, root):
+        '''
+        Set chapter numbers, node_ids (document order) and mpaths once the chapters are in place
+        '''
+        chapters = [ node for node in root.children if isinstance(node, Chapter) ]
+        for idx, chapter in enumerate(chapters):
+            chapter.number = idx + 1
+
+        node_id = 0
+        nodes = {}
+        stack = [ (root, '') ]
+        while stack:
+            node, path = stack.pop()
+            node_id += 1
+            node.node_id = node_id
+            node.path = path
+            nodes[node.node_type] = nodes.get(node.node_type, 0) + 1
+            for idx in reversed( range(len(node.children)) ):
+                stack.append( (node.children[idx], path + '.' + hexlabel(idx)) )
+        self.stats.nodes = nodes
+
+    def parse_levels(self, stream, root):
+        '''
+        Chop a token stream into chapters/sections/subsections (see parse_body)
+        The resulting nodes are appended to root.
+        '''
+        tokens = stream.tokens
+        body = stream.source
 
         # init stack
-        root = Book()
         stack = [ root ]
         start_idx = 0
-        
+        lo = 0
+
         # iterate over level commands
-        for match in matches: 
-            node_type   = match.groups()[0]     # chapter, section or subsection
-            node_title  = match.groups()[1]    # title
-            end_idx   = match.start()            # end index of block before current level command
-            tex_str     = body[ start_idx : end_idx ]
-
-            # Call parse_snippet on tex_str
-            # This tex_str is the block located BEFORE the current level command
-            # The tex_str located after the very last level command is processed separately at the end
-            children = self.parse_snippet( tex_str, parent=stack[-1] )
-            # for child in children:
-            #     child.parent = stack[-1]
+        for idx, token in enumerate(tokens):
+            if token.kind != 'level':
+                continue
+            node_type   = token.name            # chapter, section or subsection
+            node_title  = token.arg             # title
+            end_idx     = token.start           # end index of block before current level command
+
+            # Call parse_snippet on the block located BEFORE the current level command
+            # The block located after the very last level command is processed separately at the end
+            children = self.parse_snippet( stream, lo, idx, start_idx, end_idx, parent=stack[-1] )
             stack[-1].children.extend( children )
-            # stack[-1].label = label
 
             # chapter/section/subsection: close current subsection (if any) and append it to enclosing section
             if node_type in ['chapter', 'section', 'subsection']:
@@ -983,93 +1182,80 @@ class TexParser(object):
                             ch = stack.pop()
                             stack[-1].children.append( ch )
                         # push new chapter onto stack
-                        ch = Chapter( node_title )
+                        ch = self.counters.step( Chapter( self.macros.expand(node_title) ) )
                         ch.parent = stack[-1]
                         stack.append( ch )
                     # push new section onto stack
                     else:
-                        se = Section( node_title )
+                        se = self.counters.step( Section( self.macros.expand(node_title) ) )
                         se.parent = stack[-1]
                         stack.append( se )
                 # push new subsection onto stack
-                else: 
-                    ss = Subsection( node_title )
+                else:
+                    ss = self.counters.step( Subsection( self.macros.expand(node_title) ) )
                     ss.parent = stack[-1]
                     stack.append( ss )
 
             # update start_idx for next match
-            start_idx = match.end()
+            start_idx = token.end
+            lo = idx + 1
 
         # clean up tail (after last match has been processed)
         # last level command could be chapter, section or subsection
-        tex_str = body[ start_idx : len(body) ]
-        children = self.parse_snippet( tex_str, parent=stack[-1] )
-        # for child in children:
-        #     child.parent = stack[-1]
-        last_level = stack.pop()
-        last_level.children.extend( children )
-        # last_level.label = label
-        stack[-1].children.append( last_level )    # append last level to parent
-
-        # pop off enclosing environments until we reach the root
+        children = self.parse_snippet( stream, lo, len(tokens), start_idx, len(body), parent=stack[-1] )
+        stack[-1].children.extend( children )
+
+        # pop off enclosing levels until we reach the root
         while len(stack) > 1:
             node = stack.pop()
             stack[-1].children.append( node )
 
-        # return the root node (book)
-        return stack.pop()   
-    
-    def chop_snippet(self, snippet):
+    def chop_snippet(self, stream, lo, hi, start, end):
         '''
-        returns list of [node_type, node_title, start_idx, end_idx] 
+        returns list of [node_type, node_title, start_idx, end_idx, token_lo, token_hi]
             0: node_type    'tex' or environment name
             1: node_title (only for environments)
-            2: start_idx    overkill: one array of cut_points would be enough
+            2: start_idx    character range of the block
             3: end_idx
-            
+            4: token_lo     token range of the block
+            5: token_hi
+
         List alternates as [tex, env, tex, env, ... , env, tex]
             Starts and ends with tex nodes
-            
-        1. tex_str chopped up on \begin{environment} and \end{environment}
+
+        1. tokens chopped up on \begin{environment} and \end{environment}
         2. list process using a stack (to pair every \begin with its \end)
 
         Only level-one environments are extracted. Any environments nested within level-one
         environments are processed recursively by parse_snippet
-        
+
         '''
-        # initialise 
+        # initialise
         stack = []
-        blocks = []     # ['tex' or environment_name, title (if any), sub-snippet]
-        
-        # append first block: always a content block (empty blocks are removed later)
-        # Initially it contains the entire tex string
-        # The end_index will be overwritten unless "tex_str" contains only one block
-        # The final entry is the block title
-        blocks.append([ 'tex', '', 0, len(snippet) ])
+        blocks = []     # ['tex' or environment_name, title (if any), character range, token range]
 
-        # find all environment delimiters 
-        # catches environment names (optional argument)
-        # careful: also catches tabular column format string (second curly-braces)
-        pattern = r'\\(begin|end)\{(\w+)\}(\[(.*)\]|\{(.*)\})*'
-        matches = re.finditer(pattern, snippet)
+        # append first block: always a content block (empty blocks are removed later)
+        # Initially it contains the entire snippet
+        # The end indices will be overwritten unless the snippet contains only one block
+        blocks.append([ 'tex', '', start, end, lo, hi ])
 
         # old school
         timeout=False
         timeout_name = None
-        
+
         # loop over environment delimiters
-        for match in matches: 
-            
-            # process current match
-            groups = match.groups()
-            
+        tokens = stream.tokens
+        for idx in xrange(lo, hi):
+            token = tokens[idx]
+            if token.kind != 'begin' and token.kind != 'end':
+                continue
+
             # descriptive names
-            begin_or_end           = groups[0]
-            environment_name       = groups[1]
-            environment_title      = groups[3] if groups[3] else None
-            
+            environment_name       = token.name
+            environment_title      = token.arg
+
             # at "begin"
-            if begin_or_end == 'begin':
+            if token.kind == 'begin':
                 # start timeout if beginning of mathmode environment
                 if environment_name in node_types['mathmode']:
                     timeout = True
@@ -1080,21 +1266,26 @@ class TexParser(object):
                     stack.append( environment_name )
                     # extend slices only if at beginning of level-one environment
                     if len(stack) == 1:
-                        # set end_idx of preceeding block
-                        blocks[-1][3] = match.start()
+                        # set end of preceeding block
+                        blocks[-1][3] = token.start
+                        blocks[-1][5] = idx
                         # append new sub-snippet for current environment (contains the rest of the snippet)
-                        blocks.append([ environment_name, environment_title, match.end(), len(snippet) ])
+                        blocks.append([ environment_name, environment_title, token.end, end, idx + 1, hi ])
             # at "end"
             else:
                 if not timeout:
                     # pop name off stack (and check that it co-incides with current node_type )
-                    assert environment_name == stack.pop()
+                    if not stack or environment_name != stack[-1]:
+                        opened = r'\begin{%s}' % stack[-1] if stack else r'no \begin'
+                        raise self.error( stream, token.start, r'\end{%s} does not match %s' % (environment_name, opened) )
+                    stack.pop()
                     # add block only if end of level-one environment
                     if len(stack) == 0:
-                        # set end_idx of previous block
-                        blocks[-1][3] = match.start()
+                        # set end of previous block
+                        blocks[-1][3] = token.start
+                        blocks[-1][5] = idx
                         # append new tex block (to cap off this environment)
-                        blocks.append([ 'tex', '', match.end(), len(snippet) ])
+                        blocks.append([ 'tex', '', token.end, end, idx + 1, hi ])
                 # stop timeout if end of corresponding mathmode environment
                 else:
                     # end timeout if necessary
@@ -1102,29 +1293,31 @@ class TexParser(object):
                         timeout = False
         return blocks
 
-    
-    
-    def parse_snippet(self, snippet, parent=None):
+
+
+    def parse_snippet(self, stream, lo, hi, start, end, parent=None, skip=()):
         '''
-        First calls chop_snippet, which returns a list of substrings
+        First calls chop_snippet, which returns a list of sub-snippets
         List alternates as [tex, env, tex, env, ... , env, tex]
             i.e. starts and ends with tex nodes
-            The 
-            
+
         This only processes level-one environments. Any environments nested within level-one
         environments are processed recursively
-        
+
         rationale: "parent" is passed because tex_str is stripped of its "context"
         however this is already implicit, because the parent will contain a list of
         child nodes in the correct order: the parent link is needed to make computing
         mpaths easy.
+
+        skip: indices of caption tokens that have already been consumed by enclosing floats
         '''
-        
+
         #----------------------------------------
         # find sub-snippets, their types and their titles
-        # (crazy) format is [node_types_name, node_title, start_idx, end_idx]
-        blocks = self.chop_snippet( snippet )
-        # snippet, snippet_type, snippet_title = self.chop_snippet(tex_str)
+        # (crazy) format is [node_types_name, node_title, start_idx, end_idx, token_lo, token_hi]
+        with self.stats.timer('chop_snippet'):
+            blocks = self.chop_snippet( stream, lo, hi, start, end )
+        tokens = stream.tokens
 
         # initialise list of children (return value)
         children = []
@@ -1132,29 +1325,31 @@ class TexParser(object):
         # iterate through sub-snippets
         for block in blocks:
 
-            # use descriptive names (recycle name 'snippet' )
+            # use descriptive names
             snip_type = block[0]
             snip_title = block[1]
-            snip = snippet[ block[2]: block[3] ]
+            snip_start, snip_end = block[2], block[3]
+            snip_lo, snip_hi = block[4], block[5]
 
             # tex snippet (contain no non-mathmode environments)
-            #   jax: mixture of html and latex commands
+            #   jax: mixture of html and latex
             #   tabular: hack into a jax string
             #   drawback:  can't use tabular to set out figures
             if snip_type == 'tabular':
-                
+
                 # check for nothing-but-whitespace
-                if not snip or not re.compile(r'\S+',re.DOTALL).search(snip):
+                snip = stream.text( snip_start, snip_end )
+                if not snip.strip():
                     continue
 
                 # kill horizontal lines
-                snip = re.sub(r'\\hline','', snip)
+                snip = snip.replace(r'\hline', '')
 
                 htex = '<table class="tabular">'
                 # split table rows on double fowrard slash
                 rows = snip.split(r'\\')
                 for row in rows:
-                    if not row or not re.compile(r'\S+',re.DOTALL).search(row):
+                    if not row.strip():
                         break
                     htex += '<tr>'
                     # split table elements on ampersand
@@ -1163,154 +1358,139 @@ class TexParser(object):
                         htex += '<td>' + cell + '</td>'
                     htex += '</tr>'
                 htex += '</table>'
-                
-                children.append( Jax( content=htex, parent=parent ) )
-                                
+
+                children.append( self.jax( htex, parent ) )
+
             # tex snip (inline stuff done here)
             elif snip_type == 'tex':
-                
+
                 # check for nothing-but-whitespace
-                if not snip or not re.compile(r'\S+',re.DOTALL).search(snip):
+                if not stream.text( snip_start, snip_end ).strip():
                     continue
+                with self.stats.timer('parse_tex'):
+                    children.extend( self.parse_tex( stream, snip_lo, snip_hi, snip_start, snip_end, parent=parent, skip=skip ) )
 
-                # find and extract label text, then attach to parent
-                label = None
-                pattern = r'\\label\{([^\}]*)\}'
-                match = re.search(pattern, snip)
-                if match and parent:
-                    parent.label = match.groups()[0]
-        
-                # images (parse contents of figure or subfigure environment)
-                # match = re.compile(r'\\includegraphics(\[[^\]]*\])\{([^\}]+)\}').search(snip)
-                match = re.compile(r'\\includegraphics(\[[^\]]*\])*\{([^\}]+)\}').search(snip)
-                if match:
-                    src = match.groups()[1] 
-                    children.append( Image( content=src, parent=parent ) )
-
-                else:
-                    pattern = r'\\(ref|cite)\{([^\}]+)\}'
-                    matches = re.finditer(pattern, snip)
-                    if not matches:
-                        if not snip or not re.compile(r'\S+',re.DOTALL).search(snip):
-                            continue
-                        children.append( Jax( content=snip, label=label, parent=parent ) )
-                    else:
-                        start_idx = 0;
-                        for match in matches: 
-                            end_idx = match.start()
-                            ref_text = match.groups()[0]
-                            jax_snip = snip[ start_idx: end_idx ]
-                            if not jax_snip or not re.compile(r'\S+',re.DOTALL).search(jax_snip):
-                                continue
-                            children.append( Jax( content=jax_snip, label=label, parent=parent ) )
-                            if match.groups()[1] == 'ref':
-                                children.append( Reference( content=ref_text, parent=parent ) )
-                            elif match.groups()[1] == 'cite':
-                                children.append( Citation( content=ref_text, parent=parent ) )
-                            start_idx = match.end()
-                        # process final jax snippet
-                        jax_snip = snip[ start_idx: ]
-                        if not jax_snip or not re.compile(r'\S+',re.DOTALL).search(jax_snip):
-                            continue
-                        children.append( Jax( content=jax_snip, label=label, parent=parent ) )
-            
             # containers
             else:
-                node = eval( snip_type.capitalize() )( parent=parent )
-                # print '=========================================='
-                # print snip_type
-                # print type(node)
-                # print '=========================================='
+                node = self.counters.step( eval( snip_type.capitalize() )( parent=parent ) )
 
                 # mathmode: equation, eqnarray, align, array (no children)
                 if snip_type in node_types['mathmode']:
                     return []
-            
+
                 # lists
                 elif snip_type in node_types['list']:
                     item_name = item_dict[snip_type] # item, question, part, subpart, choice
-                    node.children = self.parse_list_contents(snip, parent=node, item_name=item_name)            
-            
+                    node.children = self.parse_list_contents( stream, snip_lo, snip_hi, snip_start, snip_end, parent=node, item_name=item_name, skip=skip )
+
                 # float: tables, figures, subfigures (extract caption and set as title)
                 elif snip_type in node_types['float']:
-                    match = re.compile(r'\\caption\{([^\}]+)\}').search(snip)
-                    if match:
-                        node.title = match.groups()[0]
-                        snip = snip[:match.start()] + snip[match.end():]
-                    node.children = self.parse_snippet( snippet=snip, parent=node )
+                    caption = skip
+                    for idx in xrange(snip_lo, snip_hi):
+                        if tokens[idx].kind == 'caption' and idx not in skip:
+                            node.title = self.macros.expand( tokens[idx].arg )
+                            caption = skip + (idx,)
+                            break
+                    node.children = self.parse_snippet( stream, snip_lo, snip_hi, snip_start, snip_end, parent=node, skip=caption )
 
                 # all others
                 else:
-                    # print snip_type
-                    if snip_title: 
-                        node.title = snip_title
-                    # print content
-                    node.children = self.parse_snippet( snippet=snip, parent=node )
+                    if snip_title:
+                        node.title = self.macros.expand( snip_title )
+                    node.children = self.parse_snippet( stream, snip_lo, snip_hi, snip_start, snip_end, parent=node, skip=skip )
 
                 children.append(node)
-            
+
         return children
 
-    
-    def parse_list_contents(self, snippet, parent=None, item_name="item"):
+    def jax(self, content, parent):
+        with self.stats.timer('jax'):
+            return Jax( content=self.macros.expand(content), parent=parent )
+
+    def parse_tex(self, stream, lo, hi, start, end, parent=None, skip=()):
         '''
-        Returns list of item nodes (becomes the children of the enclosing list node)
+        Returns list of content nodes for a tex snippet (contains no non-mathmode environments)
+            label:              first \label is attached to the parent
+            includegraphics:    the snippet becomes a single Image node
+            ref/cite:           Jax is split around Reference and Citation nodes
+                                (not inside math, which is left to MathJax)
         '''
+        tokens = stream.tokens
+        children = []
 
-       # check item name is valid
-        # if item_name not in node_types['item']:
-        #     return None
-
-        # function to extract next item snippet
-        def find_next_item(snippet, item_name='item'):
-            '''
-            string processing function that skips over environments to find the next item snippet
-            '''
-            
-            # find all item tokens and environment delimiters
-            pattern = r'\\(' + item_name + r')|\\(begin|end)\{(\w+)\}' 
-            matches = re.finditer(pattern, snippet)
-            
-            # return the entire snippet if no matches at all
-            if not matches:
-                return snippet, ''
-
-            # get first match and make sure it's an item (not an environment delimiter)
-            first_match = matches.next()
-            if not first_match.groups()[0]:
-                return snippet, []
-            
-            # set item type (needed to distinguish between \choice and \correctchoice)
-            item_type = first_match.groups()[0]
-            
-            # use stack to keep track of levels
-            start_idx = first_match.end()
-            stack = []
-            for match in matches:
-                groups = match.groups()
-                if groups[1]:
-                    if groups[1] == 'begin':
-                        stack.append( groups[2] )
-                    else:
-                        stack.pop()
+        # find and extract label text, then attach to parent
+        for idx in xrange(lo, hi):
+            if tokens[idx].kind == 'label':
+                if parent:
+                    parent.label = tokens[idx].arg
+                break
+
+        # images (parse contents of figure or subfigure environment)
+        for idx in xrange(lo, hi):
+            if tokens[idx].kind == 'graphics':
+                children.append( Image( content=tokens[idx].arg, parent=parent ) )
+                return children
+
+        # split on references and citations (drop caption if already consumed)
+        pieces = []
+        cursor = start
+        for idx in xrange(lo, hi):
+            token = tokens[idx]
+            if idx in skip:
+                pieces.append( stream.text(cursor, token.start) )
+                cursor = token.end
+            elif token.kind == 'ref' and not token.math:
+                pieces.append( stream.text(cursor, token.start) )
+                cursor = token.end
+                jax_snip = ''.join(pieces)
+                pieces = []
+                if jax_snip.strip():
+                    children.append( self.jax( jax_snip, parent ) )
+                if token.name == 'ref':
+                    children.append( Reference( content=token.arg, parent=parent ) )
                 else:
-                    # return to calling environment when stack empty (next item reached)
-                    if len(stack) == 0:
-                        end_idx = match.start()
-                        return snippet[start_idx:end_idx], snippet[ end_idx: ], item_type
+                    children.append( Citation( content=token.arg, parent=parent ) )
+        pieces.append( stream.text(cursor, end) )
+
+        # process final jax snippet
+        jax_snip = ''.join(pieces)
+        if jax_snip.strip():
+            children.append( self.jax( jax_snip, parent ) )
+        return children
+
+
+    def parse_list_contents(self, stream, lo, hi, start, end, parent=None, item_name="item", skip=()):
+        '''
+        Returns list of item nodes (becomes the children of the enclosing list node)
 
-            # return final item snippet
-            return snippet[ start_idx: ], '', item_type
+        Items are found by walking the token range, skipping over nested environments.
+        Anything before the first item is ignored.
+        '''
+        tokens = stream.tokens
+        item_names = item_name.split('|')
+
+        # find (item_type, token index) for every item at the top level of this list
+        cuts = []
+        depth = 0
+        for idx in xrange(lo, hi):
+            token = tokens[idx]
+            if token.kind == 'begin':
+                depth += 1
+            elif token.kind == 'end':
+                depth -= 1
+            elif token.kind == 'item' and depth == 0 and token.name in item_names:
+                cuts.append( idx )
 
         # init list to hold items
         item_list = []
-        
+
         # chop up list (recursive call to parse_snippet here)
-        tail = snippet
-        while tail:
-            snip, tail, item_type = find_next_item(tail, item_name=item_name)
-            item = eval( item_type.capitalize() )(parent=parent)
-            item.children = self.parse_snippet( snippet=snip, parent=item  )
+        for n, idx in enumerate(cuts):
+            item_start = tokens[idx].end
+            item_hi = cuts[n+1] if n+1 < len(cuts) else hi
+            item_end = tokens[item_hi].start if item_hi < hi else end
+            item = self.counters.step( eval( tokens[idx].name.capitalize() )(parent=parent) )
+            item.children = self.parse_snippet( stream, idx + 1, item_hi, item_start, item_end, parent=item, skip=skip )
             item_list.append( item )
 
         return item_list
@@ -1330,6 +1510,7 @@ def main(args=None):
     parser.add_option("-v", "--verbose", action="store_false", dest="verbose", help="verbose output")
     parser.add_option("-t", "--text", action="store_true", dest="text", help="print text tree to stdout")
     parser.add_option("-x", "--xml", action="store_true", dest="xml", help="print xml tree to stdout")
+    parser.add_option("-o", "--xml-dir", dest="xml_dir", help="also save xml tree to XML_DIR/<module_code>.xml")
     parser.add_option("-l", "--labels", action="store_true", dest="labels", help="print (label, mpath) pairs to stdout")
     parser.add_option("-d", "--db", action="store_true", dest="db", help="update camel database (dry run)")
     parser.add_option("-c", "--commit", action="store_true", dest="commit", help="update camel database (commit changes)")
@@ -1349,12 +1530,12 @@ def main(args=None):
     if options.text:
         print book
 
-    # xml output
+    # xml output (saved in the xml directory as well)
     if options.xml:
-        xml_file = open("xmlbook.xml","w")
-        xml_file.write("%s" % book.prettyprint_xml() )
-        xml_file.close()        
-        print book.prettyprint_xml()
+        if options.xml_dir:
+            module_code = os.path.basename( os.path.dirname( os.path.abspath(main_tex) ) )
+            book.save_xml( os.path.join(options.xml_dir, module_code + '.xml') )
+        book.write_xml( sys.stdout )
 
     # labels
     if options.labels:
@@ -1363,89 +1544,13 @@ def main(args=None):
         for pair in pairs:
             print pair[0].ljust(col_width) + pair[1]
 
-    # camel database output
+    # camel database output (needs Django settings, e.g. DJANGO_SETTINGS_MODULE=camel.settings.dev)
     if options.db:
-        
-        # hack to set user-defined latex macros
-        nc = ''
-        nc += r'\newcommand{\N}{\mathbb{N}}'
-        nc += r'\newcommand{\Z}{\mathbb{Z}}'
-        nc += r'\newcommand{\R}{\mathbb{R}}'
-        nc += r'\newcommand{\C}{\mathbb{C}}'
-        nc += r'\newcommand{\prob}{\mathbb{P}}'
-        nc += r'\newcommand{\expe}{\mathbb{E}}'
-        nc += r'\newcommand{\var}{\text{Var}}'
-        nc += r'\newcommand{\cov}{\text{Cov}}'
-        nc += r'\newcommand{\supp}{\text{supp}}'
-
-        # check whether this module already exists in the database
-        preamble = p.parse_preamble( main_tex )
-        code = preamble['module_code']
-        year = preamble['academic_year']
-        module = core.models.Module.objects.filter(code=code, year=year).first()
-        if not module:
-            out.info( 'Creating new module %s/%s' % (code, year) )
-            module = core.models.Module(code=code, year=year, title=preamble['module_title'])
-            module.save()
-        else:
-            out.info( 'Updating existing module %s/%s' % (code, year) )
-
-        number = preamble['book_number']
-        bk = core.models.Book.objects.filter(module=module, number=number).first()
-        if bk:
-            out.info( 'Existing book %s/%s/%s will be deleted' % (code, year, number) )
-            for booknode in core.models.BookNode.objects.filter(mpath__startswith=bk.tree.mpath):
-                booknode.delete()
-            bk.delete()
-        
-
-        # set module newcommands
-        # book.newcommands = nc
-        # book.save()
-        
-        # print preamble
-        
-        cbook = core.models.Book()
-        code = preamble['module_code']
-        year = preamble['academic_year']
-        
-        cbook.module = core.models.Module.objects.filter(code=code, year=year).first()
-        if 'book_number' in preamble:
-            cbook.number = int(preamble['book_number'])
-        else:
-            cbook.number = 0
-        if 'book_title' in preamble:
-            cbook.title = preamble['book_title']
-        if 'book_author' in preamble:
-            cbook.author = preamble['book_author']
-        if 'book_version' in preamble:
-            cbook.version = preamble['book_version']
-        if 'new_commands' in preamble:
-            cbook.new_commands = preamble['new_commands']
-            
-        hexstr = hex( cbook.number )[2:].zfill(2)
-        prefix = code + '.' + hexstr
+        import django
+        django.setup()
+        from core.bookwriter import write_module
+        write_module( book, p.parse_preamble( main_tex ), commit=options.commit )
 
-        # write book database
-        if options.commit:
-            cbook.tree = book.write_to_camel_database(prefix=prefix, commit=True)
-            cbook.save()
-            
-        else:
-            book.write_to_camel_database(prefix=prefix, commit=False)
-          
-        # write labels to database
-        pairs = book.get_label_mpaths()
-        for pair in pairs:
-            lab = core.models.Label()
-            lab.book = cbook
-            lab.text = prefix + '.' + pair[0]
-            lab.mpath = prefix + pair[1]
-            if options.commit:
-                lab.save()
-            else:
-                print lab
-          
 if __name__ == '__main__':
     main()
 
@@ -0,0 +1,663 @@
+#!/usr/bin/python
+'''
+bookwriter.py: write a book tree (core.booktree) to the camel database
+
+    This is the Django side of the parser: core.booktree itself does not import Django.
+
+    #--------------------
+    Incremental update
+    #--------------------
+    The freshly parsed book tree is matched against the existing BookNode rows:
+
+        1. nodes with a label are matched by label (so labelled questions keep their
+           primary key even if they move to a different mpath)
+        2. questions, parts and choices (ITEM_TYPES, the nodes that answers point at) are
+           matched by mpath only if the content of their subtree is unchanged, otherwise
+           with a row anywhere in the book that has the same content (e.g. a question that
+           moved down because a new one was inserted before it); the nodes of their
+           subtrees are matched with the rows of the subtree of the row
+        3. remaining nodes are matched by mpath
+        4. a match is only accepted if the node_type is unchanged
+
+    Matched rows are updated in place (only if something changed), unmatched nodes
+    are inserted, and unmatched rows are deleted. Answers, SingleChoiceAnswers and
+    Submissions that point at matched rows are left alone. If an unmatched row has
+    answers or submissions the update is refused (UpdateError): deleting the row would
+    delete them. Labelling the node, or a full refresh, resolves this.
+
+    #--------------------
+    Dry run
+    #--------------------
+    diff_report lists what an incremental update would do (refresh --diff) without
+    writing anything: the rows are loaded in one query (see book_rows), annotated with
+    the number of answers and submissions attached to each, and matched in memory.
+
+    #--------------------
+    Bulk insert
+    #--------------------
+    A new book is written with write_book: all BookNode instances are built in
+    memory and inserted with bulk_create, one level of the tree at a time (the
+    primary keys of a level are read back by mpath to set the parent of the next
+    level). Labels are bulk inserted as well.
+
+    #--------------------
+    Blue/green publish
+    #--------------------
+    publish_book replaces the tree of an existing book without taking it offline: the new
+    tree is written under a new tree_id (no Book points at it yet, so the site does not
+    show it), and Book.tree is switched over to it with a single update, in the same
+    transaction as the labels. The old tree is deleted afterwards (see delete_tree), e.g.
+    in the background by refresh. Views look up nodes by mpath within the tree of the
+    node they show, so two versions of a book can exist side by side.
+
+    #--------------------
+    MPTT fields
+    #--------------------
+    The nested-set fields (lft, rght, level) of the whole tree are computed in one
+    traversal of the book tree (see tree_values) and written together with the
+    other fields, so no per-row MPTT bookkeeping (or rebuild) is needed.
+
+    #--------------------
+    Context keys
+    #--------------------
+    Every BookNode points at its module, book and chapter (a chapter at itself), so views
+    get the context of a node with select_related instead of slicing its mpath. Module and
+    book are set when the rows are created, chapters are set afterwards with one update
+    per chapter (see set_chapters), using the nested-set fields of the chapter.
+
+    write_book and update_book bump Book.revision, which invalidates the trees cached by
+    the web processes (see core.treecache).
+
+    #--------------------
+    Prerendered HTML
+    #--------------------
+    write_book and update_book also render the static HTML of the chapters, questions and
+    choices of the tree (see core.prerender), in the same transaction, so a tree is never
+    published without it. The time spent is reported as the render stage of refresh --profile.
+'''
+
+#------------------------------------------------
+# imports
+import logging, hashlib
+from operator import attrgetter
+
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils.encoding import force_text
+
+from core.models import Module, Book, BookNode, Label, Answer, SingleChoiceAnswer, Submission
+from core.booktree import node_classes
+from core.prerender import render_tree
+from core.stats import Stats
+
+#------------------------------------------------
+# logging
+out = logging.getLogger(__name__)
+
+# fields that describe the content of a node, and fields that describe its position
+CONTENT_FIELDS = ('mpath', 'node_type', 'node_class', 'number', 'title', 'label', 'text', 'image')
+TREE_FIELDS = ('node_id', 'lft', 'rght', 'level')
+
+# node types that answers point at: matched by mpath only if their content is unchanged
+ITEM_TYPES = ('question', 'part', 'subpart', 'choice', 'correctchoice')
+
+# sqlite limits the number of parameters in a query
+BATCH_SIZE = 500
+
+#------------------------------------------------
+# helpers
+#------------------------------------------------
+def book_prefix(module_code, book_number):
+    '''
+    mpath prefix of a book, e.g. MA1234.01
+    '''
+    hexstr = hex( book_number )[2:].zfill(2)
+    return module_code + '.' + hexstr
+
+def tree_values(book):
+    '''
+    Returns a list of (node, lft, rght, level) in document order (one traversal)
+    '''
+    values = []
+    index = {}
+    counter = 0
+    stack = [ (book, 0, True) ]
+    while stack:
+        node, level, entering = stack.pop()
+        counter += 1
+        if entering:
+            index[id(node)] = len(values)
+            values.append( [node, counter, None, level] )
+            stack.append( (node, level, False) )
+            for child in reversed(node.children):
+                stack.append( (child, level + 1, True) )
+        else:
+            values[ index[id(node)] ][2] = counter
+    return [ tuple(value) for value in values ]
+
+def node_fields(node, prefix):
+    '''
+    Returns a dictionary of BookNode field values for a book tree node
+    '''
+    fields = {
+        'mpath':        prefix + node.mpath(),
+        'node_id':      node.node_id,
+        'node_type':    node.node_type,
+        'node_class':   node_classes[node.node_type],
+        'number':       node.number,
+        'title':        node.title,
+        'label':        node.label,
+        'text':         None,
+        'image':        None,
+    }
+    if node.node_type == 'image':
+        fields['image'] = node.content
+    else:
+        fields['text'] = node.content
+    for key in ('title', 'label', 'text', 'image'):
+        if fields[key] is not None:
+            fields[key] = force_text( fields[key] )
+    return fields
+
+def new_book(preamble, module):
+    '''
+    Returns a new (unsaved) Book for the preamble of a parsed book
+    '''
+    cbook = Book()
+    cbook.module = module
+    if 'book_number' in preamble:
+        cbook.number = int(preamble['book_number'])
+    else:
+        cbook.number = 0
+    set_book_fields(cbook, preamble)
+    return cbook
+
+def set_book_fields(cbook, preamble):
+    '''
+    Copy title, author, version and new_commands from the preamble (cbook is not saved)
+    '''
+    for attr, key in (('title', 'book_title'), ('author', 'book_author'), ('version', 'book_version'), ('new_commands', 'new_commands')):
+        if key in preamble:
+            setattr(cbook, attr, preamble[key])
+
+def set_chapters(tree_id):
+    '''
+    Point every node of a tree at the chapter that contains it (lft and rght must be up
+    to date). Only rows with a different chapter are written. Returns the number of rows.
+    '''
+    count = 0
+    for chapter in BookNode.objects.filter(tree_id=tree_id, node_type='chapter'):
+        nodes = BookNode.objects.filter(tree_id=tree_id, lft__gte=chapter.lft, rght__lte=chapter.rght)
+        count += nodes.exclude(chapter=chapter).update(chapter=chapter)
+    return count
+
+def content_of(node_type, title, text, image):
+    return u'\x01'.join( force_text(value) if value is not None else u'' for value in (node_type, title, text, image) )
+
+def subtrees(entries):
+    '''
+    entries: [(lft, rght, node_type, content), ...] in document (lft) order
+    Returns (ends, hashes): the subtree of entry i is entries[i:ends[i]], and hashes[i] is
+    the hash of its content (see content_of) if node_type is one of ITEM_TYPES, else None
+    '''
+    ends = []
+    hashes = []
+    for idx, (lft, rght, node_type, content) in enumerate(entries):
+        end = idx + 1
+        while end < len(entries) and entries[end][0] < rght:
+            end += 1
+        ends.append( end )
+        if node_type in ITEM_TYPES:
+            hashes.append( hashlib.sha1( u'\x00'.join( entry[3] for entry in entries[idx:end] ).encode('utf-8') ).hexdigest() )
+        else:
+            hashes.append( None )
+    return ends, hashes
+
+def row_value(row, key):
+    value = getattr(row, key)
+    if key == 'image':
+        return value.name or None
+    return value
+
+#------------------------------------------------
+# BookDiff
+#------------------------------------------------
+class UpdateError(ValueError):
+    '''
+    An incremental update that would delete answers or submissions
+    '''
+
+class BookDiff(object):
+    '''
+    Result of matching a book tree against existing BookNode rows
+        added:      [node, ...]                     nodes without a matching row
+        removed:    [row, ...]                      rows without a matching node
+        changed:    [(node, row, changes), ...]     content changed (changes: dict of new values)
+        unchanged:  [(node, row), ...]              content unchanged (position may have shifted)
+    '''
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.changed = []
+        self.unchanged = []
+        self.fields = {}    # id(node) -> dict of field values (incl. tree fields)
+        self.rows = {}      # id(node) -> matched row
+
+    def __unicode__(self):
+        return u'%d added, %d removed, %d changed, %d unchanged' % (
+            len(self.added), len(self.removed), len(self.changed), len(self.unchanged))
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+def diff_book(book, prefix, rows):
+    '''
+    Match the nodes of book against rows (existing BookNodes of the same book)
+    '''
+    diff = BookDiff()
+
+    by_label = {}
+    by_mpath = {}
+    for row in rows:
+        by_mpath[row.mpath] = row
+        if row.label:
+            by_label.setdefault(row.label, row)
+
+    nodes = []
+    for node, lft, rght, level in tree_values(book):
+        fields = node_fields(node, prefix)
+        fields.update( lft=lft, rght=rght, level=level )
+        diff.fields[id(node)] = fields
+        nodes.append( node )
+
+    # subtrees and content hashes of nodes and rows (document order)
+    ordered = sorted( rows, key=attrgetter('lft') )
+    row_index = dict( (row.pk, idx) for idx, row in enumerate(ordered) )
+    row_ends, row_hashes = subtrees([ (row.lft, row.rght, row.node_type, content_of(row.node_type, row.title, row.text, row_value(row, 'image')))
+        for row in ordered ])
+    node_ends, node_hashes = subtrees([ (fields['lft'], fields['rght'], fields['node_type'], content_of(fields['node_type'], fields['title'], fields['text'], fields['image']))
+        for fields in [ diff.fields[id(node)] for node in nodes ] ])
+    by_hash = {}
+    for idx, row in enumerate(ordered):
+        if row_hashes[idx] is not None:
+            by_hash.setdefault( (row.node_type, row_hashes[idx]), [] ).append( idx )
+
+    matched = set()
+    def match(node, row):
+        diff.rows[id(node)] = row
+        matched.add( row.pk )
+
+    # match by label
+    for node in nodes:
+        fields = diff.fields[id(node)]
+        row = by_label.get( fields['label'] ) if fields['label'] else None
+        if row and row.pk not in matched and row.node_type == fields['node_type']:
+            match( node, row )
+
+    # match questions, parts and choices by content (at the same mpath if possible), with their subtrees
+    for idx, node in enumerate(nodes):
+        if id(node) in diff.rows or node_hashes[idx] is None:
+            continue
+        fields = diff.fields[id(node)]
+        row = by_mpath.get( fields['mpath'] )
+        candidates = ( [ row_index[row.pk] ] if row else [] ) + by_hash.get( (fields['node_type'], node_hashes[idx]), [] )
+        for ridx in candidates:
+            row = ordered[ridx]
+            if row.pk in matched or row.node_type != fields['node_type'] or row_hashes[ridx] != node_hashes[idx]:
+                continue
+            for subnode, subrow in zip( nodes[idx:node_ends[idx]], ordered[ridx:row_ends[ridx]] ):
+                if id(subnode) not in diff.rows and subrow.pk not in matched:
+                    match( subnode, subrow )
+            break
+
+    # match the remaining nodes by mpath
+    for node in nodes:
+        fields = diff.fields[id(node)]
+        if id(node) in diff.rows or fields['node_type'] in ITEM_TYPES:
+            continue
+        row = by_mpath.get( fields['mpath'] )
+        if row and row.pk not in matched and row.node_type == fields['node_type']:
+            match( node, row )
+
+    # classify
+    for node in nodes:
+        row = diff.rows.get( id(node) )
+        if row is None:
+            diff.added.append( node )
+            continue
+        fields = diff.fields[id(node)]
+        changes = dict( (key, fields[key]) for key in CONTENT_FIELDS if row_value(row, key) != fields[key] )
+        # parent: new parent node (no row yet) or a different parent row
+        if node.parent:
+            parent_row = diff.rows.get( id(node.parent) )
+            if parent_row is None or parent_row.pk != row.parent_id:
+                changes['parent'] = parent_row
+        if changes:
+            diff.changed.append( (node, row, changes) )
+        else:
+            diff.unchanged.append( (node, row) )
+
+    diff.removed = [ row for row in rows if row.pk not in matched ]
+    return diff
+
+def answered(pks):
+    '''
+    Returns the set of the pks (of BookNodes) that answers or submissions point at
+    '''
+    found = set()
+    for idx in range(0, len(pks), BATCH_SIZE):
+        batch = pks[idx:idx+BATCH_SIZE]
+        found.update( Answer.objects.filter(question__in=batch).values_list('question_id', flat=True) )
+        found.update( SingleChoiceAnswer.objects.filter(question__in=batch).values_list('question_id', flat=True) )
+        found.update( SingleChoiceAnswer.objects.filter(choice__in=batch).values_list('choice_id', flat=True) )
+        found.update( Submission.objects.filter(assignment__in=batch).values_list('assignment_id', flat=True) )
+    return found
+
+def book_rows(cbook):
+    '''
+    Returns the BookNode rows of cbook (one query), each annotated with the number of
+    answers (Answer and SingleChoiceAnswer) and submissions attached to it
+    '''
+    rows = BookNode.objects.filter(tree_id=cbook.tree.tree_id).annotate(
+        num_answers=Count('answer', distinct=True),
+        num_choices=Count('singlechoiceanswer', distinct=True),
+        num_submissions=Count('submission', distinct=True),
+    )
+    return list( rows )
+
+def diff_labels(book, cbook, prefix):
+    '''
+    Returns (added, removed, moved) labels of book compared to the Label rows of cbook
+        added, removed:     [(text, mpath), ...]
+        moved:              [(text, old_mpath, new_mpath), ...]
+    '''
+    wanted = dict( (prefix + '.' + label, prefix + mpath) for label, mpath in book.get_label_mpaths() )
+    existing = dict( Label.objects.filter(book=cbook).values_list('text', 'mpath') )
+    added = sorted( (text, mpath) for text, mpath in wanted.items() if text not in existing )
+    removed = sorted( (text, mpath) for text, mpath in existing.items() if text not in wanted )
+    moved = sorted( (text, existing[text], mpath) for text, mpath in wanted.items() if text in existing and existing[text] != mpath )
+    return added, removed, moved
+
+def diff_report(book, cbook, prefix):
+    '''
+    Compare book (core.booktree.Book) with the stored book cbook without writing anything
+    Returns (lines, flagged): report lines, and the rows with answers or submissions
+    that would be removed or changed
+    '''
+    diff = diff_book(book, prefix, book_rows(cbook))
+    labels = diff_labels(book, cbook, prefix)
+
+    def attached(row):
+        counts = []
+        if row.num_answers + row.num_choices:
+            counts.append( '%d answers' % (row.num_answers + row.num_choices) )
+        if row.num_submissions:
+            counts.append( '%d submissions' % row.num_submissions )
+        return '  [%s]' % ', '.join(counts) if counts else ''
+
+    lines = [ u'%s: %s, labels: %d added, %d removed, %d moved' % ((prefix, diff) + tuple(map(len, labels))) ]
+    flagged = []
+    for node in diff.added:
+        fields = diff.fields[id(node)]
+        lines.append( u'+ %-24s %-14s %s' % (fields['mpath'], fields['node_type'], fields['label'] or '') )
+    for row in diff.removed:
+        lines.append( u'- %-24s %-14s %s%s' % (row.mpath, row.node_type, row.label or '', attached(row)) )
+        if attached(row):
+            flagged.append( row )
+    for node, row, changes in diff.changed:
+        fields = diff.fields[id(node)]
+        moved = '' if fields['mpath'] == row.mpath else ' (was %s)' % row.mpath
+        lines.append( u'~ %-24s %-14s %s%s: %s%s' % (fields['mpath'], fields['node_type'], fields['label'] or '', moved, ', '.join(sorted(changes)), attached(row)) )
+        if attached(row):
+            flagged.append( row )
+
+    added, removed, moved = labels
+    lines.extend( u'+ label %s -> %s' % label for label in added )
+    lines.extend( u'- label %s -> %s' % label for label in removed )
+    lines.extend( u'~ label %s -> %s (was %s)' % (text, new, old) for text, old, new in moved )
+    return lines, flagged
+
+#------------------------------------------------
+# bulk insert
+#------------------------------------------------
+def next_tree_id():
+    '''
+    Allocate the tree_id of a new tree (call within the transaction that writes the tree)
+    The root node with the highest tree_id is locked (select_for_update) until the
+    transaction ends, so a concurrent writer waits and then gets the next tree_id instead
+    of the same one. sqlite ignores select_for_update, but only lets one transaction write
+    at a time, so the second writer fails rather than reusing the tree_id.
+    '''
+    list( BookNode.objects.select_for_update().filter(level=0).order_by('-tree_id').values_list('pk', flat=True)[:1] )
+    return BookNode._tree_manager._get_next_tree_id()
+
+def write_book(book, cbook, prefix, stats=None):
+    '''
+    Insert the nodes of book (core.booktree.Book) as a new tree and save cbook
+    (core.models.Book) with its root node and labels. Returns the root BookNode.
+    '''
+    stats = stats or Stats()
+    with transaction.atomic():
+        if cbook.pk is None:
+            # the nodes point at their book
+            cbook.save()
+        tree_id = next_tree_id()
+
+        # one list of BookNodes per level (parents are always one level up)
+        levels = []
+        parent_of = {}
+        for node, lft, rght, level in tree_values(book):
+            fields = node_fields(node, prefix)
+            fields.update( tree_id=tree_id, lft=lft, rght=rght, level=level, book_id=cbook.pk, module_id=cbook.module_id )
+            if level == len(levels):
+                levels.append( [] )
+            levels[level].append( BookNode(**fields) )
+            if node.parent:
+                parent_of[fields['mpath']] = prefix + node.parent.mpath()
+
+        pks = {}
+        for level, booknodes in enumerate(levels):
+            for booknode in booknodes:
+                booknode.parent_id = pks.get( parent_of.get(booknode.mpath) )
+            BookNode.objects.bulk_create( booknodes, batch_size=BATCH_SIZE )
+            pks.update( BookNode.objects.filter(tree_id=tree_id, level=level).values_list('mpath', 'pk') )
+        set_chapters( tree_id )
+        with stats.timer('render'):
+            render_tree( tree_id )
+
+        cbook.tree = BookNode.objects.get(tree_id=tree_id, level=0)
+        cbook.revision += 1
+        cbook.save()
+
+        labels = [ Label(book=cbook, text=prefix + '.' + label, mpath=prefix + mpath) for label, mpath in book.get_label_mpaths() ]
+        Label.objects.bulk_create( labels, batch_size=BATCH_SIZE )
+
+    out.info('Bulk insert %s: %d nodes, %d labels', prefix, sum(map(len, levels)), len(labels))
+    return cbook.tree
+
+#------------------------------------------------
+# blue/green publish
+#------------------------------------------------
+def publish_book(book, cbook, prefix, stats=None):
+    '''
+    Replace the tree of cbook (core.models.Book, saved) with book in one transaction
+    The new tree is built under a new tree_id, then Book.tree is switched over to it.
+    Returns the tree_id of the old tree (to be deleted with delete_tree), or None.
+    '''
+    old_tree_id = cbook.tree.tree_id if cbook.tree else None
+    with transaction.atomic():
+        Label.objects.filter(book=cbook).delete()
+        write_book( book, cbook, prefix, stats )
+    out.info('Published %s: tree %s replaces tree %s', prefix, cbook.tree.tree_id, old_tree_id)
+    return old_tree_id
+
+def delete_tree(tree_id):
+    '''
+    Delete the BookNodes of a tree that is no longer published (after publish_book)
+    Answers and submissions of its nodes are deleted with them.
+    Returns the number of BookNodes deleted.
+    '''
+    if Book.objects.filter(tree__tree_id=tree_id).exists():
+        out.warning('Tree %s is still published - not deleted', tree_id)
+        return 0
+    with transaction.atomic():
+        nodes = BookNode.objects.filter(tree_id=tree_id)
+        count = nodes.count()
+        nodes.delete()
+    out.info('Deleted tree %s: %d nodes', tree_id, count)
+    return count
+
+#------------------------------------------------
+# one node at a time (with MPTT bookkeeping)
+#------------------------------------------------
+def write_to_camel_database(node, parent=None, commit=False, prefix=None, is_readonly=False):
+    '''
+    Write node and its descendants one BookNode at a time (commit=False: print only)
+    Returns the BookNode of node.
+    '''
+    # create booknode
+    booknode = BookNode(node_id=node.node_id)
+
+    booknode.mpath = node.mpath()
+    if prefix:
+        booknode.mpath = prefix + booknode.mpath
+
+    # set attributes
+    if parent:
+        booknode.parent = parent
+    booknode.is_readonly = is_readonly
+    booknode.node_type = node.node_type
+    booknode.node_class = node_classes[booknode.node_type]
+    booknode.label = node.label
+    booknode.number = node.number
+    booknode.title = node.title
+    if booknode.node_type == "image":
+        booknode.image = node.content
+    else:
+        booknode.text = node.content
+
+    # write to database
+    print booknode
+    if commit:
+        booknode.save()
+
+    # recursive call
+    for child in node.children:
+        write_to_camel_database(child, parent=booknode, prefix=prefix, commit=commit)
+
+    return booknode
+
+def write_module(book, preamble, commit=False):
+    '''
+    Write a parsed book to the database (used by booktree.main), replacing an existing
+    book with the same number. The module is created if it does not exist yet.
+    commit=False: dry run (print the BookNodes and Labels)
+    '''
+    # check whether this module already exists in the database
+    code = preamble['module_code']
+    year = preamble['academic_year']
+    module = Module.objects.filter(code=code, year=year).first()
+    if not module:
+        out.info( 'Creating new module %s/%s' % (code, year) )
+        module = Module(code=code, year=year, title=preamble['module_title'])
+        if commit:
+            module.save()
+    else:
+        out.info( 'Updating existing module %s/%s' % (code, year) )
+
+    cbook = new_book( preamble, module )
+    prefix = book_prefix( code, cbook.number )
+    if not commit:
+        write_to_camel_database( book, prefix=prefix, commit=False )
+        for label, mpath in book.get_label_mpaths():
+            print Label(text=prefix + '.' + label, mpath=prefix + mpath)
+        return
+
+    bk = Book.objects.filter(module=module, number=cbook.number).first()
+    if bk:
+        out.info( 'Existing book %s/%s/%s will be replaced' % (code, year, cbook.number) )
+        set_book_fields( bk, preamble )
+        old_tree_id = publish_book( book, bk, prefix )
+        if old_tree_id is not None:
+            delete_tree( old_tree_id )
+        return
+    write_book( book, cbook, prefix )
+
+#------------------------------------------------
+# incremental update
+#------------------------------------------------
+def update_book(book, cbook, prefix, stats=None):
+    '''
+    Update the BookNode rows of cbook (core.models.Book) to match book (core.booktree.Book)
+    Only the rows that need it are inserted, updated or deleted. Returns the BookDiff.
+    Raises UpdateError (and writes nothing) if rows with answers or submissions would be deleted.
+    '''
+    stats = stats or Stats()
+    with transaction.atomic():
+        # the rows are matched and written in one transaction, with the book and its rows
+        # locked (select_for_update): a concurrent update of the book waits, and so do
+        # answers and submissions that point at the rows
+        root_pk = Book.objects.select_for_update().filter(pk=cbook.pk).values_list('tree', flat=True)[0]
+        tree_id = BookNode.objects.get(pk=root_pk).tree_id
+        rows = list( BookNode.objects.select_for_update().filter(tree_id=tree_id) )
+        diff = diff_book(book, prefix, rows)
+        out.info('Incremental update %s: %s', prefix, diff)
+        attached = answered( [ row.pk for row in diff.removed ] )
+        if attached:
+            mpaths = sorted( row.mpath for row in diff.removed if row.pk in attached )
+            raise UpdateError('%s: %d nodes with answers or submissions would be removed (%s)' % (prefix, len(mpaths), ', '.join(mpaths)))
+
+        with BookNode.objects.disable_mptt_updates():
+
+            # inserts (document order, so that parents are inserted first)
+            row_for = dict( diff.rows )
+            for node in diff.added:
+                parent = row_for.get( id(node.parent) ) if node.parent else None
+                row = BookNode( parent=parent, tree_id=tree_id, book_id=cbook.pk, module_id=cbook.module_id, **diff.fields[id(node)] )
+                row.save()
+                row_for[id(node)] = row
+
+            # updates (content changes, new parents and shifted tree fields)
+            updated = 0
+            for node, row in [ (node, row) for node, row, changes in diff.changed ] + diff.unchanged:
+                fields = diff.fields[id(node)]
+                update = dict( (key, fields[key]) for key in CONTENT_FIELDS + TREE_FIELDS if row_value(row, key) != fields[key] )
+                parent = row_for.get( id(node.parent) ) if node.parent else None
+                if (parent.pk if parent else None) != row.parent_id:
+                    update['parent'] = parent
+                if update:
+                    BookNode.objects.filter(pk=row.pk).update(**update)
+                    updated += 1
+
+            # deletes (cascades to answers and submissions of removed nodes)
+            # nodes that move out of a removed chapter must not be deleted with it
+            pks = [ row.pk for row in diff.removed ]
+            for idx in range(0, len(pks), BATCH_SIZE):
+                BookNode.objects.filter(tree_id=tree_id, chapter__in=pks[idx:idx+BATCH_SIZE]).update(chapter=None)
+            for idx in range(0, len(pks), BATCH_SIZE):
+                BookNode.objects.filter(pk__in=pks[idx:idx+BATCH_SIZE]).delete()
+
+            set_chapters( tree_id )
+
+        with stats.timer('render'):
+            render_tree( tree_id )
+        update_labels(book, cbook, prefix)
+        Book.objects.filter(pk=cbook.pk).update(revision=F('revision') + 1)
+        cbook.revision += 1
+
+    out.info('Incremental update %s: %d inserts, %d updates, %d deletes', prefix, len(diff.added), updated, len(diff.removed))
+    return diff
+
+def update_labels(book, cbook, prefix):
+    '''
+    Bring the Label rows of cbook in line with the labels of book
+    '''
+    wanted = dict( (prefix + '.' + label, prefix + mpath) for label, mpath in book.get_label_mpaths() )
+    for lab in Label.objects.filter(book=cbook):
+        mpath = wanted.pop( lab.text, None )
+        if mpath is None:
+            lab.delete()
+        elif lab.mpath != mpath:
+            lab.mpath = mpath
+            lab.save()
+    Label.objects.bulk_create( [ Label(book=cbook, text=text, mpath=mpath) for text, mpath in sorted(wanted.items()) ] )
@@ -0,0 +1,329 @@
+#!/usr/bin/python
+'''
+macros.py: user macros of the preamble (\newcommand, \def), expanded server-side
+
+    table = MacroTable.parse( preamble )
+    table.expand( r'Let $x\in\R$' )           -> r'Let $x\in\mathbb{R}$'
+
+    #--------------------
+    Definitions
+    #--------------------
+    \newcommand{\name}{body}                  (also \renewcommand, \providecommand, starred)
+    \newcommand\name[2]{body with #1 and #2}
+    \newcommand{\name}[2][default]{...}       first argument optional, [default] if omitted
+    \def\name#1#2{body}                       undelimited parameters only
+    \DeclareMathOperator{\name}{text}         expands to \operatorname{text}
+
+    Bodies and arguments may contain nested braces. Definitions that cannot be expanded
+    (e.g. \def with delimited parameters) are skipped, and are still passed on to MathJax
+    through Book.new_commands (MacroTable.latex returns the source of every definition).
+    So are structural definitions, whose body begins or ends an environment, and the
+    shorthands that the preprocessor expands (\bit, \eit, \ben, \een, \it): expanding
+    them in titles and Jax would leave stray \begin{itemize} etc. in the text.
+
+    #--------------------
+    Expansion
+    #--------------------
+    Macros are expanded recursively (up to MAX_DEPTH levels), and the result is memoized
+    per distinct fragment (text passed to expand). A macro that is missing its arguments
+    is left as it is. Whitespace after a macro is kept (unlike TeX, which would drop it),
+    so that e.g. "\R x" does not become "\mathbb{R}x" when \R is defined as \mathbb{R}.
+
+    Does not import Django.
+'''
+
+#------------------------------------------------
+# imports
+import re, logging
+from collections import namedtuple
+
+from core.preprocess import shorthands
+
+#------------------------------------------------
+# logging
+out = logging.getLogger(__name__)
+
+#------------------------------------------------
+# macro type
+#   nargs:      number of arguments
+#   default:    default value of the (optional) first argument, or None if all arguments are mandatory
+#   body:       replacement text, with parameters #1 ... #9
+#   source:     the definition as written in the preamble
+Macro = namedtuple('Macro', 'name nargs default body source')
+
+MAX_DEPTH = 32          # maximum nesting of macro expansions (catches \def\a{\a})
+MEMO_SIZE = 50000       # maximum number of memoized fragments
+
+definition_pattern = re.compile(r'\\(newcommand|renewcommand|providecommand|def|DeclareMathOperator)(?![a-zA-Z@])(\*?)')
+control_pattern = re.compile(r'\\([a-zA-Z@]+|.)', re.DOTALL)
+parameter_pattern = re.compile(r'\\.|##|#([1-9])', re.DOTALL)
+environment_pattern = re.compile(r'\\(begin|end)(?![a-zA-Z@])')
+
+def is_structural(macro):
+    '''
+    True if macro begins or ends an environment, or is a shorthand of the preprocessor
+    '''
+    return macro.name in shorthands or environment_pattern.search( macro.body ) is not None
+
+#------------------------------------------------
+# scanning helpers
+#------------------------------------------------
+def skip_space(s, pos):
+    while pos < len(s) and s[pos] in ' \t\n':
+        pos += 1
+    return pos
+
+def read_group(s, pos, open_char='{', close_char='}'):
+    '''
+    Reads a balanced group starting at s[pos] == open_char
+    Returns (contents, end) or (None, pos) if there is no complete group at pos
+    Braces inside [...] groups are balanced as well, escaped braces are skipped.
+    '''
+    if pos >= len(s) or s[pos] != open_char:
+        return None, pos
+    braces = 0
+    idx = pos
+    while idx < len(s):
+        char = s[idx]
+        if char == '\\':
+            idx += 2
+            continue
+        if char == '{':
+            braces += 1
+        elif char == '}':
+            braces -= 1
+            if braces < 0:
+                break
+        if braces == 0 and char == close_char and idx > pos:
+            return s[pos+1:idx], idx + 1
+        idx += 1
+    return None, pos
+
+def read_argument(s, pos):
+    '''
+    Reads one mandatory argument: a {group}, a control sequence or a single character
+    Returns (argument, end) or (None, pos)
+    '''
+    pos = skip_space(s, pos)
+    if pos >= len(s) or s[pos] == '}':
+        return None, pos
+    if s[pos] == '{':
+        return read_group(s, pos)
+    if s[pos] == '\\':
+        match = control_pattern.match(s, pos)
+        return match.group(0), match.end()
+    return s[pos], pos + 1
+
+def substitute(body, args):
+    '''
+    Replaces the parameters #1 ... #9 of body by args (## is a literal #, \# is left alone)
+    '''
+    def parameter(match):
+        if match.group(1) and int(match.group(1)) <= len(args):
+            return args[ int(match.group(1)) - 1 ]
+        return '#' if match.group(0) == '##' else match.group(0)
+    return parameter_pattern.sub(parameter, body)
+
+def read_name(s, pos):
+    '''
+    Reads the macro name of a definition, as \name or {\name}
+    Returns (name, end) or (None, pos)
+    '''
+    pos = skip_space(s, pos)
+    if s.startswith('{', pos):
+        group, end = read_group(s, pos)
+        if group is not None:
+            match = control_pattern.match(group.strip())
+            if match and match.end() == len(group.strip()):
+                return match.group(1), end
+        return None, pos
+    match = control_pattern.match(s, pos)
+    if match:
+        return match.group(1), match.end()
+    return None, pos
+
+#------------------------------------------------
+# MacroTable
+#------------------------------------------------
+class MacroTable(object):
+    def __init__(self, macros=()):
+        self.macros = {}
+        self.sources = []
+        for macro in macros:
+            self.macros[macro.name] = macro
+            self.sources.append( macro.source )
+        self.compile()
+
+    def __len__(self):
+        return len(self.macros)
+
+    def __contains__(self, name):
+        return name in self.macros
+
+    def __getstate__(self):
+        # the memo is not sent to worker processes
+        return { 'macros': self.macros, 'sources': self.sources }
+
+    def __setstate__(self, state):
+        self.macros = state['macros']
+        self.sources = state['sources']
+        self.compile()
+
+    def add(self, macro):
+        self.macros[macro.name] = macro
+        self.sources.append( macro.source )
+        self.compile()
+
+    def compile(self):
+        '''
+        Quick test for fragments that contain none of the macros
+        '''
+        self.memo = {}
+        names = sorted( self.macros, key=len, reverse=True )
+        self.quick = re.compile( r'\\(?:%s)(?![a-zA-Z@])' % '|'.join( re.escape(name) for name in names ) ) if names else None
+
+    def latex(self):
+        '''
+        Returns the definitions as written in the preamble (for MathJax)
+        '''
+        return '\n'.join( self.sources )
+
+    def key(self):
+        # identifies the table (part of the parse cache key)
+        return '\n'.join( self.sources )
+
+    #------------------------------------------------
+    # definitions
+    @classmethod
+    def parse(cls, preamble):
+        '''
+        Returns the table of macros defined in preamble (comments should have been removed)
+        '''
+        table = cls()
+        pos = 0
+        while True:
+            match = definition_pattern.search(preamble, pos)
+            if not match:
+                break
+            macro, end = cls.parse_definition(preamble, match)
+            if macro is None:
+                out.warning('Cannot parse macro definition: %s', preamble[ match.start():match.start() + 60 ].split('\n')[0])
+                pos = match.end()
+                continue
+            if macro.body is not None and not is_structural( macro ):
+                table.add( macro )
+            else:
+                table.sources.append( macro.source )
+            pos = end
+        return table
+
+    @classmethod
+    def parse_definition(cls, s, match):
+        '''
+        Returns (macro, end) for the definition at match, or (None, pos) if it cannot be parsed
+        Definitions that are understood but cannot be expanded have body None
+        '''
+        command, star = match.groups()
+        name, pos = read_name(s, match.end())
+        if name is None:
+            return None, match.end()
+        nargs = 0
+        default = None
+
+        if command == 'def':
+            params = re.compile(r'(#[1-9])*').match(s, pos).group(0)
+            pos += len(params)
+            if not s.startswith('{', pos):
+                # delimited parameters (e.g. \def\pair(#1,#2){...})
+                brace = s.find('{', pos)
+                body, end = read_group(s, brace) if brace >= 0 else (None, pos)
+                if body is None:
+                    return None, pos
+                return Macro(name, 0, None, None, s[ match.start():end ]), end
+            nargs = len(params) // 2
+
+        elif command == 'DeclareMathOperator':
+            text, end = read_group(s, skip_space(s, pos))
+            if text is None:
+                return None, pos
+            body = r'\operatorname%s{%s}' % (star, text)
+            return Macro(name, 0, None, body, s[ match.start():end ]), end
+
+        else:
+            pos = skip_space(s, pos)
+            group, end = read_group(s, pos, '[', ']')
+            if group is not None:
+                if not group.strip().isdigit():
+                    return None, pos
+                nargs = int(group)
+                pos = skip_space(s, end)
+                group, end = read_group(s, pos, '[', ']')
+                if group is not None:
+                    default = group
+                    pos = skip_space(s, end)
+
+        body, end = read_group(s, skip_space(s, pos))
+        if body is None:
+            return None, pos
+        return Macro(name, nargs, default, body, s[ match.start():end ]), end
+
+    #------------------------------------------------
+    # expansion
+    def expand(self, s):
+        '''
+        Returns s with every user macro expanded (memoized per fragment)
+        '''
+        if not s or self.quick is None or not self.quick.search(s):
+            return s
+        try:
+            return self.memo[s]
+        except KeyError:
+            pass
+        if len(self.memo) >= MEMO_SIZE:
+            self.memo.clear()
+        result = self.memo[s] = self.expand_text(s, 0)
+        return result
+
+    def expand_text(self, s, depth):
+        if depth > MAX_DEPTH:
+            out.error('Macro expansion too deep (max = %d): %s', MAX_DEPTH, s[:60])
+            return s
+        pieces = []
+        pos = 0
+        for match in control_pattern.finditer(s):
+            if match.start() < pos:
+                continue
+            macro = self.macros.get( match.group(1) )
+            if macro is None:
+                continue
+            args, end = self.read_arguments(s, match.end(), macro)
+            if args is None:
+                continue
+            body = substitute( macro.body, args )
+            pieces.append( s[ pos:match.start() ] )
+            pieces.append( self.expand_text(body, depth + 1) if self.quick.search(body) else body )
+            pos = end
+        if not pieces:
+            return s
+        pieces.append( s[pos:] )
+        return ''.join(pieces)
+
+    def read_arguments(self, s, pos, macro):
+        '''
+        Returns (list of arguments, end) or (None, pos) if arguments are missing
+        '''
+        args = []
+        if macro.default is not None:
+            end = skip_space(s, pos)
+            group, end = read_group(s, end, '[', ']')
+            if group is None:
+                args.append( macro.default )
+            else:
+                args.append( group )
+                pos = end
+        while len(args) < macro.nargs:
+            arg, pos = read_argument(s, pos)
+            if arg is None:
+                return None, pos
+            args.append( arg )
+        return args, pos
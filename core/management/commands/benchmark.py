@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+'''
+benchmark.py (camel/management)
+    1. generate a synthetic book (core/bookgen.py)
+    2. time each stage of refresh on it: read_latex_file, parse_preamble, parse_body,
+       xml export and database write
+    3. record the results as json (one object per run of the command)
+
+    The database write runs in a transaction that is rolled back.
+'''
+
+import os, json, time, shutil, logging, platform, tempfile
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.bookgen import generate_book
+from core.booktree import TexParser
+from core.bookwriter import book_prefix, new_book, write_book
+from core.models import Module
+
+out = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Time the parser stages on a synthetic book and record the results as json'
+
+    option_list = BaseCommand.option_list + (
+        make_option("--chapters", type="int", dest="chapters", default=5, help="number of chapters"),
+        make_option("--sections", type="int", dest="sections", default=3, help="sections per chapter"),
+        make_option("--questions", type="int", dest="questions", default=4, help="questions per homework"),
+        make_option("--repeat", type="int", dest="repeat", default=3, help="number of runs of each stage"),
+        make_option("--db", action="store_true", dest="db", default=False, help="time the database write as well"),
+        make_option("--output", dest="output", default=None, help="append the results to this file (json lines)"),
+    )
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp(prefix='camel-benchmark-')
+        try:
+            size = dict( (key, options[key]) for key in ('chapters', 'sections', 'questions') )
+            main_tex = generate_book( directory, **size )
+            result = self.run( main_tex, options )
+            result['size'] = size
+        finally:
+            shutil.rmtree( directory )
+
+        line = json.dumps( result, sort_keys=True )
+        if options['output']:
+            with open(options['output'], 'a') as f:
+                f.write( line + '\n' )
+            out.info('Benchmark results appended to %s', options['output'])
+        self.stdout.write( line )
+
+    def run(self, main_tex, options):
+        stages = [
+            ('read_latex_file', lambda: TexParser().read_latex_file( main_tex )),
+            ('parse_preamble',  lambda: TexParser().parse_preamble( main_tex )),
+            ('parse_body',      lambda: TexParser().parse_body( main_tex )),
+        ]
+        book = TexParser().parse_body( main_tex )
+        preamble = TexParser().parse_preamble( main_tex )
+        stages.append( ('xml', lambda: self.write_xml( book )) )
+        if options['db']:
+            stages.append( ('db', lambda: self.write_db( book, preamble )) )
+
+        timings = {}
+        for name, stage in stages:
+            runs = []
+            for n in range( options['repeat'] ):
+                start = time.time()
+                stage()
+                runs.append( time.time() - start )
+            timings[name] = { 'min': min(runs), 'mean': sum(runs) / len(runs), 'runs': runs }
+            out.info('%-16s %.4fs', name, min(runs))
+
+        nodes = 0
+        stack = [ book ]
+        while stack:
+            node = stack.pop()
+            nodes += 1
+            stack.extend( node.children )
+
+        return {
+            'timestamp':    time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python':       platform.python_version(),
+            'bytes':        len( TexParser().read_latex_file( main_tex ) ),
+            'nodes':        nodes,
+            'stages':       timings,
+        }
+
+    def write_xml(self, book):
+        with open(os.devnull, 'wb') as f:
+            book.write_xml( f )
+
+    def write_db(self, book, preamble):
+        with transaction.atomic():
+            module = Module.objects.create( code=preamble['module_code'], year=preamble['academic_year'] )
+            cbook = new_book( preamble, module )
+            write_book( book, cbook, book_prefix(module.code, cbook.number) )
+            transaction.set_rollback( True )
@@ -4,36 +4,120 @@
 refresh.py (camel/management)
     1. create doctree: parse main.py
     2. traverse doctree: populate database
+
+    With --jobs N the modules are parsed in N worker processes. The finished book trees
+    are sent back to this process, which does all the output and database writes.
+    A single module is parsed with its chapters spread over N processes instead.
+
+    With --snapshot the parsed book is also saved as XML_ROOT/<module_code>.jsonl (see
+    core/snapshot.py), and --from-snapshot loads the book from there instead of parsing
+    the LaTeX sources (e.g. to deploy a book on a second server).
+
+    With --db an existing book is replaced without taking it offline: the new tree is built
+    next to the old one and published by switching Book.tree over in one transaction (see
+    core/bookwriter.py). The old tree is deleted in a background thread, which is waited for
+    before the command exits.
+
+    With --diff nothing is written: the parsed book is compared with the book in the database,
+    and the nodes and labels that an incremental refresh would add, remove or change are
+    listed. The command fails if any of these nodes have answers or submissions attached
+    (e.g. to stop a git pre-push hook).
+
+    With --profile the time spent in each parser stage (see core/stats.py) and the number
+    of nodes are printed per module (with --db also the time spent writing and prerendering
+    the book, see core/prerender.py), and --profile-dump FILE writes cProfile data of this
+    process to FILE (e.g. for snakeviz or pstats). With --jobs the workers are not profiled.
 '''
 
-import os, re, time, shutil, logging, subprocess
+import os, re, time, shutil, logging, cProfile, threading, subprocess, itertools, traceback, multiprocessing
 
 from optparse import make_option
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import connection
 
 from core.booktree import TexParser
-from core.models import Module, BookNode, Book, Label
+from core.bookwriter import book_prefix, new_book, set_book_fields, update_book, UpdateError, write_book, publish_book, delete_tree, diff_report
+from core.snapshot import save_snapshot, load_snapshot
+from core.stats import Stats
+from core.models import Module, Book
 
 SITE_ROOT = getattr(settings, 'SITE_ROOT')
 TEX_ROOT  = getattr(settings, 'TEX_ROOT')
+XML_ROOT  = getattr(settings, 'XML_ROOT')
+PARSE_CACHE_ROOT = getattr(settings, 'PARSE_CACHE_ROOT', None)
 
 out = logging.getLogger(__name__)
 
+def snapshot_filename(module_code):
+    return os.path.join(XML_ROOT, module_code + '.jsonl')
+
+def collect_tree(tree_id):
+    '''
+    Delete an unpublished tree (runs in a background thread with its own database connection)
+    '''
+    try:
+        delete_tree( tree_id )
+    except Exception:
+        out.error('Deleting tree %s failed\n%s', tree_id, traceback.format_exc())
+    finally:
+        connection.close()
+
+def parse_module(task):
+    '''
+    Parse main.tex of one module, or load its snapshot (called in a worker process with --jobs)
+    task: (module_code, cache_dir, jobs, snapshot, profile), snapshot is None, 'save' or 'load'
+    Returns (module_code, preamble, book, stats, seconds, error), error is a traceback string or None
+    '''
+    module_code, cache_dir, jobs, snapshot, profile = task
+    start = time.time()
+    stats = Stats(profile)
+    try:
+        if snapshot == 'load':
+            with stats.timer('snapshot'):
+                preamble, book = load_snapshot( snapshot_filename(module_code) )
+        else:
+            main_tex = os.path.join(TEX_ROOT, module_code, 'main.tex')
+            p = TexParser(cache_dir=cache_dir, jobs=jobs, profile=profile)
+            stats = p.stats
+            preamble = p.parse_preamble( main_tex )
+            book = p.parse_book( main_tex )
+            if book is None:
+                raise ValueError('Errors in %s' % main_tex)
+            book.title = preamble['book_title']
+            if snapshot == 'save':
+                if not os.path.isdir(XML_ROOT):
+                    os.makedirs(XML_ROOT)
+                with stats.timer('snapshot'):
+                    save_snapshot( book, preamble, snapshot_filename(module_code) )
+    except Exception:
+        return (module_code, None, None, stats, time.time() - start, traceback.format_exc())
+    return (module_code, preamble, book, stats, time.time() - start, None)
+
 class Command(BaseCommand):
     '''
-    Currently deletes the existing booktree entirely, which will be a problemm when answers
+    By default deletes the existing booktree entirely, which will be a problemm when answers
     and submissions point to question and assessment objects.
+    With --incremental the existing booktree is updated in place (see core/bookwriter.py),
+    so unchanged nodes keep their primary keys (and their answers and submissions).
     '''
     args = 'module_code (, module_code, ...)'
     help = 'Update database for specified module codes'
 
     option_list = BaseCommand.option_list + (
         make_option("--text", action="store_true", dest="text", default=False, help="print document tree to stdout"),
-        make_option("--xml", action="store_true", dest="xml", default=False, help="print xml tree to stdout"),
+        make_option("--xml", action="store_true", dest="xml", default=False, help="write xml tree to XML_ROOT/<module_code>.xml"),
         make_option("--labels", action="store_true", dest="labels", help="print (label, mpath) pairs to stdout"),
         make_option("--db", action="store_true", dest="db", default=False, help="write to database"),
+        make_option("--diff", action="store_true", dest="diff", default=False, help="report what would change in the database (writes nothing)"),
+        make_option("--incremental", action="store_true", dest="incremental", default=False, help="update existing book in place (with --db)"),
+        make_option("--no-cache", action="store_true", dest="nocache", default=False, help="parse every chapter (ignore the parse cache)"),
+        make_option("--snapshot", action="store_const", const="save", dest="snapshot", help="save the parsed book to XML_ROOT/<module_code>.jsonl"),
+        make_option("--from-snapshot", action="store_const", const="load", dest="snapshot", help="load the book from XML_ROOT/<module_code>.jsonl (no LaTeX parsing)"),
+        make_option("--jobs", type="int", dest="jobs", default=1, help="number of processes used for parsing (modules, or chapters of a single module)"),
+        make_option("--profile", action="store_true", dest="profile", default=False, help="print time per parser stage and node counts"),
+        make_option("--profile-dump", dest="profile_dump", default=None, help="write cProfile data of this process to this file"),
     )
 
     def handle(self, *args, **options):
@@ -49,91 +133,156 @@ class Command(BaseCommand):
         # out.info('SITE_ROOT = %s' % SITE_ROOT)
         # out.info('TEX_ROOT  = %s' % TEX_ROOT)
 
+        # create book trees (in module order, in parallel with --jobs)
+        cache_dir = None if options['nocache'] else PARSE_CACHE_ROOT
+        tasks = [ (module_code, cache_dir, options['jobs'], options['snapshot'], options['profile']) for module_code in args ]
+        jobs = min( options['jobs'], len(tasks) )
+        pool = multiprocessing.Pool( jobs ) if jobs > 1 else None
+        results = pool.imap( parse_module, tasks ) if pool else itertools.imap( parse_module, tasks )
+
+        profiler = cProfile.Profile() if options['profile_dump'] else None
+        if profiler:
+            profiler.enable()
+
         # iterate over modules
-        for module_code in args:
-            out.info('BEGIN processing %s', module_code)
+        failed = []
+        self.collectors = []
+        try:
+            for module_code, preamble, book, stats, seconds, error in results:
+                out.info('BEGIN processing %s', module_code)
+                if error:
+                    out.error('%s: parse failed after %.2fs\n%s', module_code, seconds, error)
+                    failed.append( module_code )
+                    continue
+                out.info('%s: parsed in %.2fs', module_code, seconds)
 
-            # find main.tex
-            main_tex = os.path.join(TEX_ROOT, module_code, 'main.tex')
+                start = time.time()
+                try:
+                    self.output_book( book, preamble, options, stats )
+                except CommandError as e:
+                    out.error('%s: %s', module_code, e)
+                    failed.append( module_code )
+                    continue
+                except Exception:
+                    out.error('%s: output failed\n%s', module_code, traceback.format_exc())
+                    failed.append( module_code )
+                    continue
+                out.info('%s: written in %.2fs', module_code, time.time() - start)
 
-            # create book tree
-            p = TexParser()
-            preamble = p.parse_preamble( main_tex )
-            book = p.parse_book( main_tex )
-            book.title = preamble['book_title']
+                if options['profile']:
+                    lines = [ 'Profile of %s (%.2fs parse)' % (module_code, seconds) ] + [ '  ' + line for line in stats.report() ]
+                    out.info( '\n'.join(lines) )
+                    for line in lines:
+                        self.stdout.write( line )
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            for thread in self.collectors:
+                thread.join()
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats( options['profile_dump'] )
+                out.info('Profile data written to %s', options['profile_dump'])
+
+        if failed:
+            raise CommandError('Refresh failed for %s' % ', '.join(failed))
+
+    def output_book(self, book, preamble, options, stats=None):
+        stats = stats or Stats()
+
+        # dry run (nothing else is written)
+        if options['diff']:
+            with stats.timer('diff'):
+                self.output_diff( book, preamble )
+            return
+
+        # xml output (streamed to file)
+        if options['xml']:
+            xml_file = os.path.join(XML_ROOT, preamble['module_code'] + '.xml')
+            with stats.timer('xml'):
+                book.save_xml( xml_file )
+            self.stdout.write( 'XML written to %s' % xml_file )
 
-            # xml output
-            if options['xml']:
-                xml = book.prettyprint_xml()
-                self.stdout.write( xml )
-
-            # labels
-            elif options['labels']:
-                pairs = book.get_label_mpaths()
-                col_width = max( [len(pair[0]) for pair in pairs] ) + 2  # padding
-                for pair in pairs:
-                    self.stdout.write( pair[0].ljust(col_width) + pair[1] )
-                    
-                    
-            # camel database output
-            if options['db']:
-
-                # check whether this module already exists in the database
-                preamble = p.parse_preamble( main_tex )
-                code = preamble['module_code']
-                year = preamble['academic_year']
-                module = Module.objects.filter(code=code, year=year).first()
-                if not module:
-                    out.warning( 'Module %s/%s does not exist - do nothing' % (code, year) )
-                    # out.info( 'Creating new module %s/%s' % (code, year) )
-                    # module = Module(code=code, year=year, title=preamble['module_title'])
-                    # module.save()
-                else:
-                    out.info( 'Updating existing module %s/%s' % (code, year) )
-
-                number = preamble['book_number']
-                bk = Book.objects.filter(module=module, number=number).first()
-                if bk:
-                    out.info( 'Existing book %s/%s/%s will be deleted' % (code, year, number) )
-                    for booknode in BookNode.objects.filter(mpath__startswith=bk.tree.mpath):
-                        booknode.delete()
-                    bk.delete()
-        
-                cbook = Book()
-                code = preamble['module_code']
-                year = preamble['academic_year']
-        
-                cbook.module = Module.objects.filter(code=code, year=year).first()
-                if 'book_number' in preamble:
-                    cbook.number = int(preamble['book_number'])
-                else:
-                    cbook.number = 0
-                if 'book_title' in preamble:
-                    cbook.title = preamble['book_title']
-                if 'book_author' in preamble:
-                    cbook.author = preamble['book_author']
-                if 'book_version' in preamble:
-                    cbook.version = preamble['book_version']
-                if 'new_commands' in preamble:
-                    cbook.new_commands = preamble['new_commands']
-            
-                hexstr = hex( cbook.number )[2:].zfill(2)
-                prefix = code + '.' + hexstr
-
-                # write book database
-                cbook.tree = book.write_to_camel_database(prefix=prefix, commit=True)
-                cbook.save()
-          
-                # write labels to database
-                pairs = book.get_label_mpaths()
-                for pair in pairs:
-                    lab = Label()
-                    lab.book = cbook
-                    lab.text = prefix + '.' + pair[0]
-                    lab.mpath = prefix + pair[1]
-                    lab.save()
-                    print lab                    
+        # labels
+        elif options['labels']:
+            pairs = book.get_label_mpaths()
+            col_width = max( [len(pair[0]) for pair in pairs] ) + 2  # padding
+            for pair in pairs:
+                self.stdout.write( pair[0].ljust(col_width) + pair[1] )
+                
+                
+        # camel database output
+        if options['db']:
+            with stats.timer('db'):
+                self.output_db( book, preamble, options, stats )
 
+    def output_diff(self, book, preamble):
+        code = preamble['module_code']
+        number = int( preamble.get('book_number', 0) )
+        prefix = book_prefix( code, number )
+        bk = Book.objects.filter(module__code=code, module__year=preamble['academic_year'], number=number).select_related('tree').first()
+        if not bk or not bk.tree:
+            self.stdout.write( '%s: not in the database (every node would be added)' % prefix )
+            return
+        lines, flagged = diff_report( book, bk, prefix )
+        for line in lines:
+            self.stdout.write( line )
+        if flagged:
+            raise CommandError('%d nodes with answers or submissions would be removed or changed' % len(flagged))
+
+    def output_db(self, book, preamble, options, stats=None):
 
+        # check whether this module already exists in the database
+        code = preamble['module_code']
+        year = preamble['academic_year']
+        module = Module.objects.filter(code=code, year=year).first()
+        if not module:
+            out.warning( 'Module %s/%s does not exist - do nothing' % (code, year) )
+            # out.info( 'Creating new module %s/%s' % (code, year) )
+            # module = Module(code=code, year=year, title=preamble['module_title'])
+            # module.save()
+        else:
+            out.info( 'Updating existing module %s/%s' % (code, year) )
 
+        number = preamble['book_number']
+        bk = Book.objects.filter(module=module, number=number).first()
 
+        # incremental: update existing book in place
+        if bk and bk.tree and options['incremental']:
+            out.info( 'Existing book %s/%s/%s will be updated' % (code, year, number) )
+            set_book_fields( bk, preamble )
+            bk.save()
+            try:
+                update_book( book, bk, book_prefix(code, bk.number), stats )
+            except UpdateError as e:
+                raise CommandError( '%s - not updated' % e )
+            return
+
+        # replace existing book (publish the new tree, then delete the old one)
+        if bk:
+            out.info( 'Existing book %s/%s/%s will be replaced' % (code, year, number) )
+            set_book_fields( bk, preamble )
+            old_tree_id = publish_book( book, bk, book_prefix(code, bk.number), stats )
+            if old_tree_id is not None:
+                self.collect( old_tree_id )
+            return
+
+        cbook = new_book( preamble, module )
+        prefix = book_prefix( code, cbook.number )
+
+        # write book and labels to database
+        write_book( book, cbook, prefix, stats )
+
+    def collect(self, tree_id):
+        '''
+        Delete the old tree of a book in the background
+        The old tree is deleted here instead inside a transaction (another connection would
+        not see the new tree yet) and with sqlite (one writer at a time).
+        '''
+        if connection.in_atomic_block or connection.vendor == 'sqlite':
+            delete_tree( tree_id )
+            return
+        thread = threading.Thread( target=collect_tree, args=(tree_id,), name='collect-tree-%s' % tree_id )
+        thread.start()
+        self.collectors.append( thread )
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# prefix scans (mpath LIKE 'MA1234.01%') can only use a btree index on postgres if it is
+# built with varchar_pattern_ops (unless the database uses the C collation); on other
+# databases the index_together index below serves them
+PATTERN_INDEX = 'core_booknode_tree_type_mpath_like'
+
+def create_pattern_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX %s ON core_booknode (tree_id, node_type, mpath varchar_pattern_ops)' % PATTERN_INDEX
+        )
+
+def drop_pattern_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % PATTERN_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='answer',
+            index_together=set([('user', 'question')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='booknode',
+            index_together=set([('tree_id', 'node_type', 'mpath')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='singlechoiceanswer',
+            index_together=set([('user', 'question')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='submission',
+            index_together=set([('user', 'assignment')]),
+        ),
+        migrations.RunPython(create_pattern_index, drop_pattern_index),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def set_context(apps, schema_editor):
+    # module, book and chapter of the nodes of every published tree (see bookwriter.set_chapters)
+    Book = apps.get_model('core', 'Book')
+    BookNode = apps.get_model('core', 'BookNode')
+    for book in Book.objects.exclude(tree=None).select_related('tree', 'module'):
+        tree_id = book.tree.tree_id
+        BookNode.objects.filter(tree_id=tree_id).update(book=book, module=book.module)
+        for chapter in BookNode.objects.filter(tree_id=tree_id, node_type='chapter'):
+            BookNode.objects.filter(tree_id=tree_id, lft__gte=chapter.lft, rght__lte=chapter.rght).update(chapter=chapter)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booknode',
+            name='book',
+            field=models.ForeignKey(related_name='booknode_book', blank=True, to='core.Book', null=True),
+        ),
+        migrations.AddField(
+            model_name='booknode',
+            name='chapter',
+            field=models.ForeignKey(related_name='booknode_chapter', blank=True, to='core.BookNode', null=True),
+        ),
+        migrations.AddField(
+            model_name='booknode',
+            name='module',
+            field=models.ForeignKey(related_name='booknode_module', blank=True, to='core.Module', null=True),
+        ),
+        migrations.RunPython(set_context, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_booknode_context'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='revision',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_book_revision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booknode',
+            name='html',
+            field=models.TextField(null=True, blank=True),
+        ),
+    ]
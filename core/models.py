@@ -69,9 +69,13 @@ class Module(models.Model):
 class BookNode(MPTTModel):
 
     # keys
-    # module = models.ForeignKey(Module)
     parent = TreeForeignKey('self', null=True, blank=True, related_name='children')
 
+    # context (denormalized, set by bookwriter): views get module, book and chapter of a node in one query
+    module = models.ForeignKey(Module, null=True, blank=True, related_name='booknode_module')
+    book = models.ForeignKey('Book', null=True, blank=True, related_name='booknode_book')
+    chapter = models.ForeignKey('self', null=True, blank=True, related_name='booknode_chapter') # the node itself for a chapter
+
     # attributes
     node_class = models.CharField(max_length=10)
     node_type = models.CharField(max_length=10)
@@ -82,6 +86,7 @@ class BookNode(MPTTModel):
     # content
     text = models.TextField(null=True)
     image = models.ImageField(upload_to='figure_images', null=True, blank=False)
+    html = models.TextField(null=True, blank=True) # prerendered (chapters, questions and choices), see prerender.py
 
     # labels
     node_id = models.PositiveSmallIntegerField() # serial number (from booktree.py)
@@ -103,23 +108,41 @@ class BookNode(MPTTModel):
             return prev
         return False
 
+    def get_ancestor_chain(self):
+        '''
+        Ancestors from the root down to (and including) this node: one query over
+        tree_id/lft/rght, memoized on the instance (and on the ancestors it returns)
+        '''
+        chain = getattr(self, '_ancestor_chain', None)
+        if chain is None:
+            chain = list( self.get_ancestors(include_self=True) )
+            chain[-1] = self
+            for idx, node in enumerate(chain):
+                node._ancestor_chain = chain[:idx+1]
+        return chain
+
+    def find_ancestor(self, match, include_self=True):
+        '''
+        Nearest ancestor for which match(node) is true, or None
+        '''
+        chain = self.get_ancestor_chain()
+        if not include_self:
+            chain = chain[:-1]
+        for node in reversed(chain):
+            if match(node):
+                return node
+        return None
+
     def get_parent_by_type(self, node_type):
-        pa = self.parent
-        while pa.node_type != node_type:
-            pa = pa.parent
-        return pa
+        return self.find_ancestor(lambda node: node.node_type == node_type, include_self=False)
 
     def get_parent_book(self):
-        pa = self
-        while pa.node_type != 'book':
-            pa = pa.parent
-        return pa
+        return self.find_ancestor(lambda node: node.node_type == 'book')
 
     def get_parent_chapter(self):
-        pa = self
-        while pa.node_type != 'chapter':
-            pa = pa.parent
-        return pa
+        if self.chapter_id:
+            return self.chapter
+        return self.find_ancestor(lambda node: node.node_type == 'chapter')
 
     # def get_parent_homework(self):
     #     pa = self
@@ -127,23 +150,63 @@ class BookNode(MPTTModel):
     #         pa = pa.parent
     #     return pa
     def get_parent_assignment(self):
-        pa = self
-        while pa.node_class != 'assignment':
-            pa = pa.parent
-        return pa
+        return self.find_ancestor(lambda node: node.node_class == 'assignment')
 
     def get_root_node(self):
-        pa = self
-        while pa.node_type != 'book':
-            pa = pa.parent
-        return pa
+        return self.find_ancestor(lambda node: node.node_type == 'book')
+
+    # navigation: nodes of a cached tree (see core.treecache) answer from memory, as lists,
+    # and share the loading of their content with the nodes they were reached from
+    def get_children(self):
+        tree = getattr(self, '_book_tree', None)
+        if tree is None or hasattr(self, '_cached_children'):
+            # (children cached by the recursetree template tag)
+            return super(BookNode, self).get_children()
+        return tree.get_children(self.pk, content=self._node_content)
+
+    def get_descendants(self, include_self=False):
+        tree = getattr(self, '_book_tree', None)
+        if tree is None:
+            return super(BookNode, self).get_descendants(include_self=include_self)
+        return tree.get_descendants(self.pk, include_self=include_self, content=self._node_content)
+
+    def get_siblings(self, include_self=False):
+        tree = getattr(self, '_book_tree', None)
+        if tree is None:
+            return super(BookNode, self).get_siblings(include_self=include_self)
+        return tree.get_siblings(self.pk, include_self=include_self, content=self._node_content)
+
+    def get_next_sibling(self, *filter_args, **filter_kwargs):
+        tree = getattr(self, '_book_tree', None)
+        if tree is None or filter_args or filter_kwargs:
+            return super(BookNode, self).get_next_sibling(*filter_args, **filter_kwargs)
+        return tree.get_next_sibling(self.pk, content=self._node_content)
+
+    def get_previous_sibling(self, *filter_args, **filter_kwargs):
+        tree = getattr(self, '_book_tree', None)
+        if tree is None or filter_args or filter_kwargs:
+            return super(BookNode, self).get_previous_sibling(*filter_args, **filter_kwargs)
+        return tree.get_previous_sibling(self.pk, content=self._node_content)
 
     def get_descendants_inc_self(self):
         return self.get_descendants(include_self=True)
 
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        # nodes of a cached tree load their (deferred) content for the whole page at once
+        content = getattr(self, '_node_content', None)
+        if content is not None and fields and content.provides(fields):
+            content.load(self)
+            return
+        super(BookNode, self).refresh_from_db(using=using, fields=fields, **kwargs)
+
     class MPTTMeta:
         order_insertion_by = ['node_id']
 
+    class Meta:
+        # views filter on (tree_id, node_type, mpath__startswith) and order by mpath
+        # on postgres, migration 0002 adds the same index with varchar_pattern_ops (for LIKE 'prefix%')
+        index_together = [('tree_id', 'node_type', 'mpath')]
+
     def __unicode__(self):
         return self.mpath
 
@@ -159,6 +222,7 @@ class Book(models.Model):
     version = models.CharField(max_length=100, null=True, blank=True)
     new_commands = models.CharField(max_length=5000, null=True, blank=True)
     tree = models.ForeignKey(BookNode, related_name="book_tree", null=True)
+    revision = models.PositiveIntegerField(default=0) # bumped by bookwriter whenever the tree is written (see treecache.py)
 
     def __unicode__(self):
         s = ''
@@ -206,6 +270,9 @@ class Answer(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        index_together = [('user', 'question')]
+
     def __unicode__(self):
         s = unicode( self.question.mpath )
         s = s + unicode('|' + self.user.username )
@@ -222,6 +289,9 @@ class SingleChoiceAnswer(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        index_together = [('user', 'question')]
+
     def __unicode__(self):
         s = self.question.mpath
         s = s + '|' + self.user.username
@@ -241,6 +311,7 @@ class Submission(models.Model):
 
     class Meta:
         ordering = ['created']
+        index_together = [('user', 'assignment')]
 
 
 
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+'''
+parsecache.py: on-disk cache for parsed booktree fragments
+
+    Used by TexParser to avoid re-parsing chapter files that have not changed.
+    Values are pickled and stored one file per key:
+
+        <cache_dir>/<key>.pickle
+
+    Keys are content hashes (see ParseCache.key), so the cache never needs to be
+    invalidated explicitly: edited files simply produce new keys. Stale entries can
+    be removed by deleting the cache directory.
+'''
+
+#------------------------------------------------
+# imports
+import os, hashlib, logging, tempfile
+import cPickle as pickle
+
+#------------------------------------------------
+# logging
+out = logging.getLogger(__name__)
+
+#------------------------------------------------
+# ParseCache
+class ParseCache(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def key(*parts):
+        '''
+        sha1 hex digest of the given strings
+        '''
+        sha = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            sha.update(part)
+            sha.update('\0')
+        return sha.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+    def get(self, key):
+        '''
+        Returns the cached value, or None on a miss (missing or unreadable entry)
+        '''
+        try:
+            with open(self.path(key), 'rb') as f:
+                value = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        '''
+        Write value atomically (so that concurrent readers never see a partial file)
+        '''
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.path(key))
+        except (IOError, OSError, RuntimeError, pickle.PicklingError):
+            out.warning('Parse cache: could not write %s', key)
+            if os.path.exists(tmp):
+                os.remove(tmp)
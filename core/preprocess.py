@@ -0,0 +1,206 @@
+#!/usr/bin/python
+'''
+preprocess.py: streaming preprocessor for latex source (camel.cls)
+
+    The source of a book is read through a pipeline of generators, one line at a time,
+    so no stage holds more than a line (and no stage copies the whole book):
+
+        read_lines(filename)        lines of a file
+        strip_comments(lines)       remove % comments (but not \%)
+        document_body(lines)        lines between \begin{document} and \end{document}
+        document_preamble(lines)    lines before \begin{document}
+        expand_inputs(lines)        replace \input{file} by the lines of file (recursively)
+        expand_shorthands(lines)    \bit, \eit, \ben, \een and \it
+
+    Every stage yields Line tuples (filename, lineno, text), where text is a line of the
+    original file or a piece of it (e.g. the text before an \input command). So each piece
+    of text can be traced back to where it came from: chunk_source joins the lines into
+    chunks for TexParser, each with a SourceMap from character offsets back to file and
+    line, which the parser uses to report errors at their original location.
+
+    Does not import Django.
+'''
+
+#------------------------------------------------
+# imports
+import os, re, logging, itertools
+from bisect import bisect_right
+from collections import namedtuple
+
+#------------------------------------------------
+# logging
+out = logging.getLogger(__name__)
+
+#------------------------------------------------
+# line type
+Line = namedtuple('Line', 'filename lineno text')
+
+# maximum depth of nested \input files (main.tex is level 0)
+MAX_LEVEL = 4
+
+# comment: first % that is not escaped (\\% is a line break followed by a comment)
+comment_pattern = re.compile(r'((?:[^%\\]|\\.)*)%')
+input_pattern = re.compile(r'\\input\{([^\}]*)\}')
+shorthand_pattern = re.compile(r'\\(bit|eit|ben|een|it)\s+')
+shorthands = {
+    'bit':  r'\begin{itemize} ',
+    'eit':  r'\end{itemize} ',
+    'ben':  r'\begin{enumerate} ',
+    'een':  r'\end{enumerate} ',
+    'it':   r'\item ',
+}
+
+#------------------------------------------------
+# stages
+#------------------------------------------------
+def read_lines(filename):
+    with open(filename) as f:
+        for lineno, text in enumerate(f, 1):
+            yield Line(filename, lineno, text)
+
+def strip_comments(lines):
+    for line in lines:
+        if '%' in line.text:
+            match = comment_pattern.match(line.text)
+            if match:
+                newline = '\n' if line.text.endswith('\n') else ''
+                line = line._replace(text=match.group(1) + newline)
+        yield line
+
+def document_body(lines):
+    '''
+    Lines between \begin{document} and \end{document} (apply after strip_comments)
+    '''
+    lines = iter(lines)
+    for line in lines:
+        idx = line.text.find(r'\begin{document}')
+        if idx >= 0:
+            yield line._replace(text=line.text[ idx + len(r'\begin{document}'): ])
+            break
+    for line in lines:
+        idx = line.text.find(r'\end{document}')
+        if idx >= 0:
+            yield line._replace(text=line.text[:idx])
+            break
+        yield line
+
+def document_preamble(lines):
+    '''
+    Lines before \begin{document} (apply after strip_comments)
+    '''
+    for line in lines:
+        idx = line.text.find(r'\begin{document}')
+        if idx >= 0:
+            yield line._replace(text=line.text[:idx])
+            break
+        yield line
+
+def input_filename(filename, nested_filename):
+    # append .tex extension if necessary
+    if not re.search(r'\.', nested_filename):
+        nested_filename = nested_filename + '.tex'
+    nested_filename = os.path.join(os.path.dirname(filename), nested_filename)
+    out.info('File: %s', nested_filename)
+    return nested_filename
+
+def expand_inputs(lines, level=0):
+    '''
+    Replace each \input{file} by the (preprocessed) lines of file
+    The text before and after an \input command is passed on even if it is empty, so the
+    lines of an input file are always delimited by lines of the file that includes it.
+    '''
+    for line in lines:
+        if r'\input' not in line.text:
+            yield line
+            continue
+        start = 0
+        for match in input_pattern.finditer(line.text):
+            yield line._replace(text=line.text[ start:match.start() ])
+            start = match.end()
+            if level >= MAX_LEVEL:
+                out.error('%s:%d: \\input nested too deeply (max = %d)', line.filename, line.lineno, MAX_LEVEL)
+                continue
+            nested_filename = input_filename( line.filename, match.group(1) )
+            for nested in read_source(nested_filename, level=level+1):
+                yield nested
+        yield line._replace(text=line.text[start:])
+
+def expand_shorthands(lines):
+    for line in lines:
+        if '\\' in line.text:
+            text = shorthand_pattern.sub(lambda match: shorthands[match.group(1)], line.text)
+            if text != line.text:
+                line = line._replace(text=text)
+        yield line
+
+#------------------------------------------------
+# pipelines
+#------------------------------------------------
+def read_source(filename, level=0):
+    '''
+    Lines of filename with comments removed and \input commands expanded
+    '''
+    return expand_inputs( strip_comments(read_lines(filename)), level=level )
+
+def read_document(main_file):
+    '''
+    Preprocessed lines of the document body of main_file
+    '''
+    body = document_body( strip_comments(read_lines(main_file)) )
+    return expand_shorthands( expand_inputs(body) )
+
+def read_preamble(main_file):
+    '''
+    Preprocessed lines of the preamble of main_file (macro definitions, see macros.py)
+    '''
+    return expand_inputs( document_preamble(strip_comments(read_lines(main_file))) )
+
+#------------------------------------------------
+# source map
+#------------------------------------------------
+class SourceMap(object):
+    '''
+    Maps character offsets in a chunk of preprocessed text to (filename, lineno)
+    '''
+    def __init__(self):
+        self.offsets = []
+        self.positions = []
+
+    def append(self, offset, filename, lineno):
+        if not self.positions or self.positions[-1] != (filename, lineno):
+            self.offsets.append( offset )
+            self.positions.append( (filename, lineno) )
+
+    def locate(self, offset):
+        idx = bisect_right(self.offsets, offset) - 1
+        if idx < 0:
+            return (None, None)
+        return self.positions[idx]
+
+def chunk_source(lines, main_file):
+    '''
+    Join lines into chunks, yields (text, source_map) for each chunk
+
+    The lines are grouped into parts: runs of lines of main_file, and the lines of each
+    \input file of main_file (including the files it inputs). A new chunk starts at every
+    part that begins with \chapter (usually one chunk per chapter file, see TexParser.parse_body).
+    Only one part is held in memory besides the current chunk.
+    '''
+    pieces = []
+    source_map = None
+    offset = 0
+    for in_main, part in itertools.groupby(lines, key=lambda line: line.filename == main_file):
+        part = list(part)
+        text = ''.join( line.text for line in part )
+        if source_map is None or text.lstrip().startswith('\\chapter'):
+            if source_map is not None:
+                yield ''.join(pieces), source_map
+            pieces = []
+            source_map = SourceMap()
+            offset = 0
+        for line in part:
+            source_map.append( offset, line.filename, line.lineno )
+            offset += len(line.text)
+        pieces.append( text )
+    if source_map is not None:
+        yield ''.join(pieces), source_map
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+'''
+prerender.py: static HTML of chapters, questions and choices, rendered when a tree is written
+
+    The body of a chapter page, and of each question and choice of a homework or test
+    page, is rendered once per tree (when bookwriter writes it) and stored in BookNode.html:
+
+        node_type               template                subtree                 page
+        chapter                 booknode.html           chapter and descendants chapter_detail.html
+        question (homework)     booknode.html           descendants             homework.html
+        question (test)         question_block.html     descendants             sctest.html
+        choice, correctchoice   booknode.html           descendants             sctest.html
+
+    Pages include the stored HTML instead of walking the subtree with {% recursetree %},
+    and fall back to rendering the subtree if html is not set (e.g. for trees written
+    before it existed). Views only add what depends on the user (answers, submissions).
+
+    #--------------------
+    Splice markers
+    #--------------------
+    Templates are rendered with prerender=True, and parts that are only shown to users
+    who are logged in (e.g. the Start buttons of homework and tests) are rendered and
+    wrapped in markers
+
+        <!--camel:user--> ... <!--/camel:user-->
+
+    splice(html, user) removes the markers, and for anonymous users what is between them.
+'''
+
+#------------------------------------------------
+# imports
+import re, logging
+
+from django.template.loader import render_to_string
+
+from core.models import BookNode
+from core.treecache import BookTree
+
+#------------------------------------------------
+# logging
+out = logging.getLogger(__name__)
+
+USER_START = '<!--camel:user-->'
+USER_END = '<!--/camel:user-->'
+user_pattern = re.compile( re.escape(USER_START) + '.*?' + re.escape(USER_END), re.DOTALL )
+
+RENDERED_TYPES = ['chapter', 'question', 'choice', 'correctchoice']
+TEST_TYPES = ['singlechoice', 'multiplechoice']
+
+#------------------------------------------------
+# rendering
+#------------------------------------------------
+def render_node(node):
+    '''
+    Returns the static HTML of node (a node of a BookTree, see RENDERED_TYPES)
+    '''
+    context = { 'prerender': True, 'chapter': node.chapter }
+    if node.node_type == 'chapter':
+        context['subtree'] = node.get_descendants(include_self=True)
+        return render_to_string( 'booknode.html', context )
+    context['subtree'] = node.get_descendants()
+    assignment = node.get_parent_assignment()
+    if node.node_type == 'question' and assignment and assignment.node_type in TEST_TYPES:
+        return render_to_string( 'question_block.html', context )
+    return render_to_string( 'booknode.html', context )
+
+def render_tree(tree_id):
+    '''
+    Render the chapters, questions and choices of a tree and store their html
+    Only rows whose html changed are written. Returns the number of rows written.
+    '''
+    nodes = BookTree.load( tree_id, None ).select( node_type=RENDERED_TYPES )
+    count = 0
+    for node in nodes:
+        html = render_node( node )
+        if html != node.html:
+            BookNode.objects.filter(pk=node.pk).update(html=html)
+            count += 1
+    out.info('Rendered tree %s: %d of %d nodes changed', tree_id, count, len(nodes))
+    return count
+
+#------------------------------------------------
+# per-user parts
+#------------------------------------------------
+def splice(html, user):
+    '''
+    Returns html for user: marked parts are removed for anonymous users (or user None)
+    '''
+    if html is None:
+        return None
+    if user is not None and user.is_authenticated():
+        return html.replace(USER_START, '').replace(USER_END, '')
+    return user_pattern.sub('', html)
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+'''
+snapshot.py: save a parsed book (core.booktree) as json lines, and load it back
+
+    A snapshot holds everything refresh needs to write a book to the database, so a
+    book can be deployed (e.g. to a staging server) without parsing the LaTeX sources.
+
+    #--------------------
+    Format
+    #--------------------
+    One json value per line:
+
+        {"format": "camel-booktree", "version": 1, "preamble": {...}}     header
+        [depth, node_type, number, title, label, content]                 one line per node
+
+    Nodes are listed in document order (preorder), depth is 0 for the book itself.
+    Node ids, mpaths and chapter numbers are recomputed on loading (TexParser.number_nodes).
+'''
+
+#------------------------------------------------
+# imports
+import json
+
+from core import booktree
+
+FORMAT = 'camel-booktree'
+VERSION = 1
+
+#------------------------------------------------
+# write
+#------------------------------------------------
+def write_snapshot(book, preamble, f):
+    '''
+    Write book and its preamble to the file object f (one line at a time)
+    '''
+    header = { 'format': FORMAT, 'version': VERSION, 'preamble': preamble }
+    f.write( json.dumps(header) + '\n' )
+    stack = [ (book, 0) ]
+    while stack:
+        node, depth = stack.pop()
+        line = [ depth, node.node_type, node.number, node.title, node.label, node.content ]
+        f.write( json.dumps(line, separators=(',', ':')) + '\n' )
+        for child in reversed(node.children):
+            stack.append( (child, depth + 1) )
+
+def save_snapshot(book, preamble, filename):
+    with open(filename, 'wb') as f:
+        write_snapshot( book, preamble, f )
+
+#------------------------------------------------
+# read
+#------------------------------------------------
+def read_snapshot(f):
+    '''
+    Rebuild a book from the file object f, returns (preamble, book)
+    '''
+    header = json.loads( f.readline() )
+    if header.get('format') != FORMAT or header.get('version') != VERSION:
+        raise ValueError('Not a booktree snapshot (expected %s version %d)' % (FORMAT, VERSION))
+
+    book = None
+    parents = []
+    for lineno, line in enumerate(f, 2):
+        depth, node_type, number, title, label, content = json.loads( line )
+        node_class = booktree.NodeType.classes.get( node_type )
+        if node_class is None:
+            raise ValueError('Unknown node type %r in booktree snapshot, line %d' % (node_type, lineno))
+
+        # bypass the constructors (Jax content is already cleaned up)
+        if node_class is booktree.Book:
+            node = booktree.Book()
+        else:
+            node = node_class.__new__( node_class )
+            booktree.Node.__init__( node )
+        node.number = number
+        node.title = title
+        node.label = label
+        node.content = content
+
+        del parents[depth:]
+        if parents:
+            node.parent = parents[-1]
+            node.parent.children.append( node )
+        else:
+            book = node
+        parents.append( node )
+
+    if book is None:
+        raise ValueError('Empty booktree snapshot')
+    booktree.TexParser().number_nodes( book )
+    return header['preamble'], book
+
+def load_snapshot(filename):
+    with open(filename, 'rb') as f:
+        return read_snapshot( f )
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+'''
+stats.py: per-stage timers and counters for the parser and refresh
+
+    stats = Stats(enabled=True)
+    with stats.timer('tokenize'):
+        ...
+
+    The timers of a Stats that is not enabled do nothing (the parser calls them for every
+    snippet, so they are only switched on with refresh --profile); counters are always kept.
+
+    Stage times are inclusive (e.g. chop_snippet is called from within parse_levels), so
+    they do not add up to the total. TexParser.stats also holds the number of nodes by
+    node_type and the number of bytes read; see refresh --profile.
+
+    Does not import Django.
+'''
+
+#------------------------------------------------
+# imports
+import time
+from contextlib import contextmanager
+
+#------------------------------------------------
+# Stats
+class NullTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+null_timer = NullTimer()
+
+class Stats(object):
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.times = {}     # stage: seconds
+        self.calls = {}     # stage: number of calls
+        self.nodes = {}     # node_type: number of nodes
+        self.bytes = 0      # bytes of LaTeX source read
+
+    def timer(self, stage):
+        if not self.enabled:
+            return null_timer
+        return self.stage_timer( stage )
+
+    @contextmanager
+    def stage_timer(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[stage] = self.times.get(stage, 0.0) + time.time() - start
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def merge(self, other):
+        '''
+        Add the timers and counters of other (e.g. from a worker process)
+        '''
+        for stage, seconds in other.times.items():
+            self.times[stage] = self.times.get(stage, 0.0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + other.calls[stage]
+        for node_type, count in other.nodes.items():
+            self.nodes[node_type] = self.nodes.get(node_type, 0) + count
+        self.bytes += other.bytes
+
+    def report(self):
+        '''
+        Returns a list of report lines (stages in order of time spent)
+        '''
+        lines = []
+        for stage in sorted(self.times, key=self.times.get, reverse=True):
+            lines.append( '%-16s %9.4fs %8d calls' % (stage, self.times[stage], self.calls[stage]) )
+        if self.bytes:
+            lines.append( '%-16s %9d' % ('bytes', self.bytes) )
+        if self.nodes:
+            lines.append( '%-16s %9d' % ('nodes', sum(self.nodes.values())) )
+            for node_type in sorted(self.nodes, key=self.nodes.get, reverse=True):
+                lines.append( '  %-14s %9d' % (node_type, self.nodes[node_type]) )
+        return lines
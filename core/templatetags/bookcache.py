@@ -0,0 +1,74 @@
+'''
+bookcache.py: versioned fragment cache for book pages
+
+    {% load bookcache %}
+    {% bookcache "chapter" book chapter %}
+        ...
+    {% endbookcache %}
+
+    {% bookcache view book node [vary_on ...] %} caches its contents in the BOOK_CACHE
+    cache (see settings) under (book id, Book.revision, view, node pk, vary_on ...).
+    refresh bumps Book.revision whenever it writes a book, so the fragments of the old
+    revision are never read again (and are culled by the cache backend): no keys need to
+    be deleted.
+
+    The contents are rendered with prerender=True, so the parts that depend on the user
+    are wrapped in splice markers (see core/prerender.py) and one fragment is shared by
+    anonymous and logged in readers; the markers are resolved for the user of the request.
+    Without a book or node the contents are rendered (and spliced) but not cached.
+
+    {{ question.html | splice:user | safe }} resolves the markers of prerendered HTML
+    (BookNode.html) that is output without the bookcache tag.
+'''
+
+from django import template
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.http import urlquote
+
+from core.prerender import splice
+
+register = template.Library()
+
+BOOK_CACHE = getattr(settings, 'BOOK_CACHE', 'default')
+
+def fragment_key(book, view, node, vary_on=()):
+    key = 'bookcache:%s:%s:%s:%s' % (book.pk, book.revision, view, node.pk)
+    return ':'.join( [key] + [ urlquote(value) for value in vary_on ] )
+
+class BookCacheNode(template.Node):
+    def __init__(self, nodelist, view, book, node, vary_on):
+        self.nodelist = nodelist
+        self.view = view
+        self.book = book
+        self.node = node
+        self.vary_on = vary_on
+
+    def render(self, context):
+        book = self.book.resolve(context)
+        node = self.node.resolve(context)
+        key = None
+        if book and node:
+            key = fragment_key( book, self.view.resolve(context), node, [ var.resolve(context) for var in self.vary_on ] )
+            html = caches[BOOK_CACHE].get(key)
+            if html is not None:
+                return splice( html, context.get('user') )
+        with context.push(prerender=True):
+            html = self.nodelist.render(context)
+        if key:
+            caches[BOOK_CACHE].set(key, html)
+        return splice( html, context.get('user') )
+
+@register.filter(name='splice')
+def splice_filter(html, user):
+    return splice( html, user )
+
+@register.tag
+def bookcache(parser, token):
+    bits = token.split_contents()
+    if len(bits) < 4:
+        raise template.TemplateSyntaxError('%r tag requires at least three arguments: view, book and node' % bits[0])
+    nodelist = parser.parse(('endbookcache',))
+    parser.delete_first_token()
+    view, book, node = [ parser.compile_filter(bit) for bit in bits[1:4] ]
+    return BookCacheNode( nodelist, view, book, node, [ parser.compile_filter(bit) for bit in bits[4:] ] )
@@ -0,0 +1,16 @@
+import pytest
+
+from django.core.cache import caches
+
+from core import treecache
+from core.templatetags.bookcache import BOOK_CACHE
+
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+    """
+    Test databases reuse tree ids and book revisions, so start without cached
+    trees and fragments
+    """
+    treecache.clear()
+    caches[BOOK_CACHE].clear()
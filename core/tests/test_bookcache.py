@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db.models import F
+
+from core import treecache
+from core.booktree import TexParser
+from core.bookwriter import write_module
+from core.models import Book, BookNode
+
+
+@pytest.mark.django_db
+def test_fragments_are_shared_and_versioned(client):
+    """
+    Test that anonymous and logged in readers share the cached chapter
+    fragment (with the user parts spliced in), and that bumping the book
+    revision invalidates it
+    """
+    main_tex = os.path.join(settings.TEX_ROOT, "MA1234", "main.tex")
+    p = TexParser()
+    write_module(p.parse_book(main_tex), p.parse_preamble(main_tex), commit=True)
+    chapter = BookNode.objects.filter(node_type="chapter", booknode_chapter__node_type="homework").distinct().first()
+    url = reverse("chapter-detail", kwargs={"pk": chapter.pk})
+    selected = reverse("chapter-selected", kwargs={"node_type": "homework", "pk": chapter.pk})
+    User.objects.create_user("student", "student@example.com", "secret")
+
+    anonymous = client.get(url).content
+    assert client.get(selected).status_code == 200
+    assert "<button>Start</button>" not in anonymous
+    BookNode.objects.filter(tree_id=chapter.tree_id, node_type="homework").update(title="Renamed")
+    BookNode.objects.filter(pk=chapter.pk).update(html="<p>Changed</p>")
+    treecache.clear()
+
+    client.login(username="student", password="secret")
+    logged_in = client.get(url).content
+    assert "<button>Start</button>" in logged_in and "<p>Changed</p>" not in logged_in
+    assert "Renamed" not in client.get(selected).content
+
+    Book.objects.update(revision=F("revision") + 1)
+    assert "<p>Changed</p>" in client.get(url).content
+    assert "Renamed" in client.get(selected).content
+
+@pytest.mark.django_db
+def test_question_html_is_spliced(client):
+    """
+    Test that the prerendered html of questions is spliced for the user on
+    pages that output it without the bookcache tag
+    """
+    main_tex = os.path.join(settings.TEX_ROOT, "MA1234", "main.tex")
+    p = TexParser()
+    write_module(p.parse_book(main_tex), p.parse_preamble(main_tex), commit=True)
+    homework = [node for node in BookNode.objects.filter(node_type="homework") if node.get_descendants().filter(node_type="question")][0]
+    BookNode.objects.filter(tree_id=homework.tree_id, node_type="question").update(
+        html="<p>Question</p><!--camel:user--><p>Reader</p><!--/camel:user-->")
+    User.objects.create_user("student", "student@example.com", "secret")
+    client.login(username="student", password="secret")
+
+    content = client.get(reverse("homework", kwargs={"pk": homework.pk})).content
+    assert "<p>Question</p><p>Reader</p>" in content and "camel:user" not in content
@@ -0,0 +1,169 @@
+import os
+import shutil
+import subprocess
+import sys
+import threading
+
+from django.conf import settings
+
+import core
+from core.booktree import TexParser, clean_jax
+
+
+def copy_module(tmpdir, module_code="MA1234"):
+    source = os.path.join(settings.TEX_ROOT, module_code)
+    target = str(tmpdir.join(module_code))
+    shutil.copytree(source, target)
+    return os.path.join(target, "main.tex")
+
+def test_parse_cache_returns_same_tree(tmpdir):
+    """
+    Test that a book parsed from the cache is identical to a fresh parse,
+    and that only an edited chapter file is parsed again
+    """
+    main_tex = copy_module(tmpdir)
+    cache_dir = str(tmpdir.join("cache"))
+    fresh = TexParser().parse_book(main_tex)
+
+    cold = TexParser(cache_dir=cache_dir)
+    assert repr(cold.parse_book(main_tex)) == repr(fresh)
+    assert cold.cache.hits == 0
+
+    warm = TexParser(cache_dir=cache_dir)
+    assert repr(warm.parse_book(main_tex)) == repr(fresh)
+    assert warm.cache.misses == 0
+
+    with open(os.path.join(os.path.dirname(main_tex), "02_events.tex"), "a") as f:
+        f.write("\nOne more sentence.\n")
+    edited = TexParser(cache_dir=cache_dir)
+    book = edited.parse_book(main_tex)
+    assert edited.cache.misses == 1
+    assert [chapter.number for chapter in book.children if chapter.__class__.__name__ == "Chapter"] == [1, 2, 3]
+
+def test_parse_cache_sees_edited_class_file(tmpdir):
+    """
+    Test that a parser which parses the book again notices an edited
+    camel.cls (the cache version is not kept from the first parse)
+    """
+    main_tex = copy_module(tmpdir)
+    parser = TexParser(cache_dir=str(tmpdir.join("cache")))
+    parser.parse_book(main_tex)
+    with open(os.path.join(os.path.dirname(main_tex), "camel.cls"), "a") as f:
+        f.write("\n% edited\n")
+    parser.parse_book(main_tex)
+    assert parser.cache.hits == 0
+
+def test_mpaths_are_assigned_in_one_traversal(tmpdir):
+    """
+    Test that parse_book stores the mpath of every node, and that it agrees
+    with the position of the node among its siblings
+    """
+    book = TexParser().parse_book(copy_module(tmpdir))
+    stack = [book]
+    while stack:
+        node = stack.pop()
+        assert node.path is not None
+        for idx, child in enumerate(node.children):
+            assert child.mpath() == node.mpath() + "." + hex(idx)[2:].zfill(2)
+            stack.append(child)
+
+def test_parsers_do_not_share_counters(tmpdir):
+    """
+    Test that numbering is local to each parse, so that books parsed one after
+    another or in parallel threads get the same numbers
+    """
+    main_tex = copy_module(tmpdir)
+    expected = repr(TexParser().parse_book(main_tex))
+    assert repr(TexParser().parse_book(main_tex)) == expected
+
+    results = []
+    def parse():
+        results.append(repr(TexParser().parse_book(main_tex)))
+    threads = [threading.Thread(target=parse) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [expected] * 4
+
+def test_parallel_chapters_give_same_tree(tmpdir):
+    """
+    Test that parsing the chapters in a process pool gives the same book
+    """
+    main_tex = copy_module(tmpdir)
+    assert repr(TexParser(jobs=3).parse_book(main_tex)) == repr(TexParser().parse_book(main_tex))
+
+def test_chunks_are_parsed_as_they_are_read(tmpdir, monkeypatch):
+    """
+    Test that parse_body parses each chapter chunk before the next one is read
+    """
+    events = []
+    read_chunks, parse_chunk = TexParser.read_chunks, TexParser.parse_chunk
+    def reading(self, main_file):
+        for chunk in read_chunks(self, main_file):
+            events.append("read")
+            yield chunk
+    def parsing(self, chunk, source_map=None):
+        events.append("parse")
+        return parse_chunk(self, chunk, source_map)
+    monkeypatch.setattr(TexParser, "read_chunks", reading)
+    monkeypatch.setattr(TexParser, "parse_chunk", parsing)
+
+    TexParser().parse_book(copy_module(tmpdir))
+    chapters = events.count("parse")
+    assert chapters > 1
+    assert events[-2 * chapters:] == ["read", "parse"] * chapters
+
+def test_stage_timers_only_run_when_profiling(tmpdir):
+    """
+    Test that the stage timers are off unless the parser profiles (node
+    counts are kept either way), also in the chapter process pool
+    """
+    main_tex = copy_module(tmpdir)
+    plain = TexParser(jobs=2)
+    plain.parse_book(main_tex)
+    assert plain.stats.times == {} and plain.stats.nodes["chapter"] > 0
+
+    profiled = TexParser(jobs=2, profile=True)
+    profiled.parse_book(main_tex)
+    assert profiled.stats.calls["tokenize"] > 0 and profiled.stats.calls["jax"] > 0
+
+def test_nodes_have_no_instance_dict(tmpdir):
+    """
+    Test that booktree nodes are slotted (no per-instance __dict__)
+    """
+    book = TexParser().parse_book(copy_module(tmpdir))
+    stack = [book]
+    while stack:
+        node = stack.pop()
+        assert not hasattr(node, "__dict__")
+        assert node.node_type == node.__class__.__name__.lower()
+        stack.extend(node.children)
+
+def test_clean_jax():
+    """
+    Test the single-pass Jax cleanup (command arguments are cleaned as well)
+    """
+    assert clean_jax(r"\emph{a~b} and \textbf{c}\label{x}") == "<i>a&nbsp;b</i> and <b>c</b>"
+    assert clean_jax("50\\percent \\& more\\newpage") == "50&#37; &amp; more"
+    assert clean_jax("$a \\iff b$\nnext") == "$a \nnext"
+
+def test_clean_jax_nested_commands():
+    """
+    Test that font commands take balanced arguments, so that they nest
+    """
+    assert clean_jax(r"\textbf{\emph{x}}") == "<b><i>x</i></b>"
+    assert clean_jax(r"\underline{\textbf{y}} z") == "<u><b>y</b></u> z"
+    assert clean_jax(r"\emph{\label{q}x}") == "<i>x</i>"
+    assert clean_jax(r"\emph{a {b} c}") == "<i>a {b} c</i>"
+    assert clean_jax(r"\emph{open") == r"\emph{open"
+
+def test_booktree_imports_without_django():
+    """
+    Test that the parser can be imported (and run) without Django settings
+    """
+    env = dict(os.environ)
+    env.pop("DJANGO_SETTINGS_MODULE", None)
+    script = "import sys, core.booktree; print(any(name.startswith('django') for name in sys.modules))"
+    output = subprocess.check_output([sys.executable, "-c", script], env=env, cwd=os.path.dirname(os.path.dirname(core.__file__)))
+    assert output.strip() == b"False"
@@ -0,0 +1,65 @@
+import os
+import shutil
+
+from django.conf import settings
+
+from core.macros import MacroTable
+from core.booktree import TexParser
+
+
+PREAMBLE = r"""
+\newcommand{\R}{\mathbb{R}}
+\newcommand\norm[1]{\left\| #1 \right\|}
+\newcommand{\inner}[2][x]{\langle #1, #2 \rangle_{\R}}
+\def\pair#1#2{(#1,#2)}
+\def\loop{\loop}
+"""
+
+def test_expand_arguments_and_nested_braces():
+    """
+    Test that arguments (optional, braced or single tokens) are substituted
+    and expanded, and that incomplete or recursive macros are left alone
+    """
+    table = MacroTable.parse(PREAMBLE)
+    assert table.expand(r"$\norm{f_{\R}}$") == r"$\left\| f_{\mathbb{R}} \right\|$"
+    assert table.expand(r"\inner{a}\inner[b]{\frac{1}{2}}") == r"\langle x, a \rangle_{\mathbb{R}}\langle b, \frac{1}{2} \rangle_{\mathbb{R}}"
+    assert table.expand(r"\pair ab \\R \Real") == r"(a,b) \\R \Real"
+    assert table.expand(r"\norm") == r"\norm"
+    assert table.expand(r"\loop") == r"\loop"
+    assert table.expand(r"\R") is table.expand(r"\R")
+
+def test_structural_definitions_are_not_expanded():
+    """
+    Test that definitions that open or close environments, and the
+    preprocessor shorthands, are left alone but still passed to MathJax
+    """
+    table = MacroTable.parse(PREAMBLE + r"""
+\def\bit{\begin{itemize}}
+\def\it{\item}
+\newcommand{\bthm}{\begin{theorem}}
+\newcommand{\ethm}{\end{theorem}}
+""")
+    assert table.expand(r"\bit \it \bthm x\ethm \R") == r"\bit \it \bthm x\ethm \mathbb{R}"
+    assert r"\def\bit{\begin{itemize}}" in table.latex()
+    assert r"\newcommand{\ethm}{\end{theorem}}" in table.latex()
+
+def test_parse_book_expands_macros_and_keys_cache_on_them(tmpdir):
+    """
+    Test that preamble macros are expanded in the book, and that editing a
+    macro definition invalidates the cached chapters
+    """
+    module = str(tmpdir.join("MA1234"))
+    shutil.copytree(os.path.join(settings.TEX_ROOT, "MA1234"), module)
+    main_tex = os.path.join(module, "main.tex")
+    cache_dir = str(tmpdir.join("cache"))
+    xml = TexParser(cache_dir=cache_dir).parse_book(main_tex).prettyprint_xml()
+    assert r"\prob" not in xml and r"$\mathbb{P}(A)$" in xml
+
+    with open(main_tex) as f:
+        source = f.read()
+    with open(main_tex, "w") as f:
+        f.write(source.replace(r"\newcommand{\prob}{\mathbb{P}}", r"\newcommand{\prob}{P}"))
+    p = TexParser(cache_dir=cache_dir)
+    xml = p.parse_book(main_tex).prettyprint_xml()
+    assert p.cache.hits == 0
+    assert r"$P(A)$" in xml
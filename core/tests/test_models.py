@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from django.conf import settings
+from django.db import connection
+
+from core.booktree import TexParser
+from core.bookwriter import write_module
+from core.models import BookNode, Answer, Submission
+
+
+def query_plan(qset):
+    sql, params = qset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+    return " | ".join(row[-1] for row in cursor.fetchall())
+
+@pytest.mark.django_db
+@pytest.mark.skipif(connection.vendor != "sqlite", reason="EXPLAIN QUERY PLAN is sqlite syntax")
+def test_view_queries_use_indexes():
+    """
+    Test that the mpath prefix scans of the views and the answer/submission
+    lookups are index searches, and that ordering by mpath needs no sort
+    """
+    plan = query_plan(BookNode.objects.filter(node_type="question", tree_id=1, mpath__startswith="MA1234.01").order_by("mpath"))
+    assert "USING INDEX core_booknode_tree_id_" in plan
+    assert "TEMP B-TREE" not in plan
+
+    plan = query_plan(Answer.objects.filter(user=1, question=2))
+    assert "USING INDEX core_answer_user_id_" in plan and "question_id=?" in plan
+
+    plan = query_plan(Submission.objects.filter(user=1, assignment=2))
+    assert "USING INDEX core_submission_user_id_" in plan and "assignment_id=?" in plan
+
+@pytest.mark.django_db
+def test_ancestor_helpers_share_one_query(django_assert_num_queries):
+    """
+    Test that the get_parent_* helpers of a node cost one query between them
+    """
+    main_tex = os.path.join(settings.TEX_ROOT, "MA1234", "main.tex")
+    p = TexParser()
+    write_module(p.parse_book(main_tex), p.parse_preamble(main_tex), commit=True)
+    question = BookNode.objects.filter(node_type="question").order_by("-level").first()
+    question.chapter_id = None
+
+    with django_assert_num_queries(1):
+        assignment = question.get_parent_assignment()
+        chapter = question.get_parent_chapter()
+        root = question.get_root_node()
+        assert question.get_parent_book() is root
+        assert assignment.get_parent_by_type("chapter") is chapter
+
+    assert assignment.node_class == "assignment" and chapter.node_type == "chapter"
+    assert root.level == 0 and root.node_type == "book"
+    assert question.get_parent_by_type("question") is None
@@ -0,0 +1,40 @@
+import pytest
+
+from core.preprocess import read_document, chunk_source
+from core.booktree import TexParser, ParseError
+
+
+def write_book(tmpdir, chapter):
+    tmpdir.join("main.tex").write(
+        "\\documentclass{camel}\n"
+        "\\begin{document}\n"
+        "% \\input{missing}\n"
+        "\\input{ch1}\n"
+        "\\end{document}\n"
+    )
+    tmpdir.join("ch1.tex").write(chapter)
+    return str(tmpdir.join("main.tex"))
+
+def test_pipeline_keeps_escaped_percent_and_source_lines(tmpdir):
+    """
+    Test that comments are stripped but \\% is kept, that commented \\input
+    commands are ignored, and that text maps back to its file and line
+    """
+    main_tex = write_book(tmpdir, "\\chapter{One}\nCosts 5\\% more. % or less\n\\bit\n\\it one\n\\eit\n")
+    chunks = list(chunk_source(read_document(main_tex), main_tex))
+    assert len(chunks) == 2
+    text, source_map = chunks[1]
+    assert text == "\\chapter{One}\nCosts 5\\% more. \n\\begin{itemize} \\item one\n\\end{itemize} \n"
+    assert source_map.locate(text.index("Costs")) == (str(tmpdir.join("ch1.tex")), 2)
+    assert source_map.locate(text.index("\\item")) == (str(tmpdir.join("ch1.tex")), 4)
+
+def test_parse_error_reports_original_location(tmpdir):
+    """
+    Test that a mismatched \\end is reported at its line in the chapter file
+    """
+    main_tex = write_book(tmpdir, "\\chapter{One}\n\\begin{theorem}\nText\n\\end{proof}\n")
+    with pytest.raises(ParseError) as error:
+        TexParser().parse_body(main_tex)
+    assert error.value.filename == str(tmpdir.join("ch1.tex"))
+    assert error.value.lineno == 4
+    assert str(error.value).endswith(r"\end{proof} does not match \begin{theorem}")
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.urlresolvers import reverse
+
+from core.booktree import TexParser
+from core.bookwriter import write_module
+from core.models import BookNode
+from core.prerender import render_tree, USER_START
+from core.templatetags.bookcache import BOOK_CACHE
+
+
+@pytest.fixture
+def tree_id(db):
+    main_tex = os.path.join(settings.TEX_ROOT, "MA1234", "main.tex")
+    p = TexParser()
+    write_module(p.parse_book(main_tex), p.parse_preamble(main_tex), commit=True)
+    return BookNode.objects.get(level=0).tree_id
+
+def test_chapter_page_matches_live_rendering(tree_id, client):
+    """
+    Test that the prerendered chapter gives the same page as rendering the
+    subtree, for anonymous and logged in users
+    """
+    chapter = BookNode.objects.filter(tree_id=tree_id, node_type="chapter", booknode_chapter__node_type="homework").distinct().first()
+    assert USER_START in chapter.html
+    url = reverse("chapter-detail", kwargs={"pk": chapter.pk})
+    User.objects.create_user("student", "student@example.com", "secret")
+
+    pages = []
+    for login in (False, True):
+        if login:
+            client.login(username="student", password="secret")
+        prerendered = client.get(url).content
+        BookNode.objects.filter(pk=chapter.pk).update(html=None)
+        caches[BOOK_CACHE].clear()
+        assert client.get(url).content == prerendered
+        pages.append(prerendered)
+        render_tree(tree_id)
+        caches[BOOK_CACHE].clear()
+    anonymous, logged_in = pages
+    assert "<button>Start</button>" not in anonymous and "<button>Start</button>" in logged_in
+    assert USER_START not in logged_in
+
+def test_render_tree_writes_changed_rows_only(tree_id):
+    """
+    Test that questions and choices are prerendered and that rendering an
+    unchanged tree again writes nothing
+    """
+    assert not BookNode.objects.filter(tree_id=tree_id, node_type__in=["chapter", "question"], html=None).exists()
+    assert BookNode.objects.filter(tree_id=tree_id, node_type="jax", html=None).exists()
+    BookNode.objects.filter(tree_id=tree_id, node_type="question").update(html=None)
+    count = BookNode.objects.filter(tree_id=tree_id, node_type="question").count()
+    assert render_tree(tree_id) == count
+    assert render_tree(tree_id) == 0
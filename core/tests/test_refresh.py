@@ -0,0 +1,303 @@
+import json
+import os
+import shutil
+import pstats
+from StringIO import StringIO
+
+from model_mommy import mommy
+import pytest
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+
+from core.management.commands import refresh
+from core.bookwriter import write_to_camel_database
+from core.snapshot import read_snapshot
+from core.models import Module, Book, BookNode, Label, Answer
+
+
+@pytest.fixture
+def tex_root(tmpdir, monkeypatch):
+    """
+    Copy of the MA1234 sources that tests are free to edit
+    """
+    shutil.copytree(os.path.join(settings.TEX_ROOT, "MA1234"), str(tmpdir.join("MA1234")))
+    monkeypatch.setattr(refresh, "TEX_ROOT", str(tmpdir))
+    monkeypatch.setattr(refresh, "PARSE_CACHE_ROOT", None)
+    return tmpdir
+
+def edit(tex_root, filename, old, new):
+    path = str(tex_root.join("MA1234", filename))
+    with open(path) as f:
+        source = f.read()
+    assert old in source
+    with open(path, "w") as f:
+        f.write(source.replace(old, new, 1))
+
+def tree_fields(tree_id):
+    return list(BookNode.objects.filter(tree_id=tree_id).order_by("pk").values_list("pk", "parent", "lft", "rght", "level"))
+
+@pytest.mark.django_db
+def test_incremental_refresh_keeps_unchanged_nodes(tex_root):
+    """
+    Test that an incremental refresh after a one-word edit updates a single row,
+    keeps primary keys (and answers) and leaves a consistent MPTT tree
+    """
+    Module.objects.create(code="MA1234", year="2015-16")
+    call_command("refresh", "MA1234", db=True)
+    book = Book.objects.get()
+    before = dict(BookNode.objects.values_list("mpath", "pk"))
+    question = BookNode.objects.filter(node_type="question").first()
+    answer = mommy.make(Answer, question=question)
+
+    edit(tex_root, "02_events.tex", "Games of chance", "Games of luck")
+    call_command("refresh", "MA1234", db=True, incremental=True)
+
+    assert dict(BookNode.objects.values_list("mpath", "pk")) == before
+    assert Answer.objects.filter(pk=answer.pk, question=question).exists()
+    assert BookNode.objects.filter(text__contains="Games of luck").count() == 1
+    assert Label.objects.filter(book=book).count() == len(set(Label.objects.values_list("text", flat=True)))
+
+    tree_id = Book.objects.get().tree.tree_id
+    fields = tree_fields(tree_id)
+    BookNode.objects.partial_rebuild(tree_id)
+    assert tree_fields(tree_id) == fields
+
+@pytest.mark.django_db
+def test_incremental_refresh_inserts_and_deletes(tex_root):
+    """
+    Test that nodes added to and removed from the source are inserted and deleted,
+    and that the resulting MPTT tree is the one a full rebuild would give
+    """
+    Module.objects.create(code="MA1234", year="2015-16")
+    call_command("refresh", "MA1234", db=True)
+    count = BookNode.objects.count()
+
+    edit(tex_root, "01_sets.tex", r"\section{Set algebra}", "\\section{Set algebra}\n\\begin{remark}New.\\end{remark}\n")
+    call_command("refresh", "MA1234", db=True, incremental=True)
+    assert BookNode.objects.count() == count + 2
+    assert BookNode.objects.filter(node_type="remark", text=None).count() >= 1
+
+    tree_id = Book.objects.get().tree.tree_id
+    fields = tree_fields(tree_id)
+    BookNode.objects.partial_rebuild(tree_id)
+    assert tree_fields(tree_id) == fields
+
+    edit(tex_root, "01_sets.tex", "\\begin{remark}New.\\end{remark}\n", "")
+    call_command("refresh", "MA1234", db=True, incremental=True)
+    assert BookNode.objects.count() == count
+
+def question_with(text):
+    jax = BookNode.objects.get(node_type="jax", text__contains=text)
+    return jax.get_ancestors().get(node_type="question")
+
+@pytest.mark.django_db
+def test_incremental_refresh_keeps_answers_with_their_question(tex_root):
+    """
+    Test that inserting an unlabelled question before an answered one does not
+    move the answer to another question, and that an edit which would delete
+    an answered question is refused
+    """
+    Module.objects.create(code="MA1234", year="2015-16")
+    call_command("refresh", "MA1234", db=True)
+    question = question_with("for any two events $A$ and $B$")
+    answer = mommy.make(Answer, question=question)
+    count = BookNode.objects.count()
+
+    edit(tex_root, "03_probability.tex", "\\question % subadditivity", "\\question A new question.\n\\question % subadditivity")
+    call_command("refresh", "MA1234", db=True, incremental=True)
+    assert BookNode.objects.count() > count
+    assert question_with("for any two events $A$ and $B$").pk == question.pk
+    assert question_with("A new question.").pk != question.pk
+    assert Answer.objects.get(pk=answer.pk).question_id == question.pk
+
+    rows = list(BookNode.objects.order_by("pk").values_list("pk", "mpath", "text"))
+    edit(tex_root, "03_probability.tex", "for any two events $A$ and $B$", "for all events $A$ and $B$")
+    with pytest.raises(CommandError):
+        call_command("refresh", "MA1234", db=True, incremental=True)
+    assert list(BookNode.objects.order_by("pk").values_list("pk", "mpath", "text")) == rows
+    assert Answer.objects.filter(pk=answer.pk).exists()
+
+@pytest.mark.django_db
+def test_nodes_point_at_module_book_and_chapter(tex_root, client):
+    """
+    Test that bulk and incremental writes set the module, book and chapter of
+    every node, and that views take the chapter from it
+    """
+    Module.objects.create(code="MA1234", year="2015-16")
+    call_command("refresh", "MA1234", db=True)
+    edit(tex_root, "01_sets.tex", r"\section{Set algebra}", "\\section{Set algebra}\n\\begin{remark}New.\\end{remark}\n")
+    call_command("refresh", "MA1234", db=True, incremental=True)
+
+    book = Book.objects.get()
+    nodes = list(BookNode.objects.filter(tree_id=book.tree.tree_id))
+    chapters = [node for node in nodes if node.node_type == "chapter"]
+    for node in nodes:
+        assert (node.module_id, node.book_id) == (book.module_id, book.pk)
+        containing = [ch.pk for ch in chapters if ch.lft <= node.lft and node.rght <= ch.rght]
+        assert [node.chapter_id] == (containing or [None])
+
+    remark = BookNode.objects.filter(node_type="remark", text=None).first()
+    response = client.get(reverse("chapter-selected", kwargs={"node_type": "theorem", "pk": remark.pk}))
+    assert response.status_code == 200
+    assert response.context["chapter"].mpath == "MA1234.01.01"
+
+@pytest.mark.django_db
+def test_bulk_write_matches_mptt_inserts(tex_root):
+    """
+    Test that the bulk writer gives the same tree as saving one node at a time
+    """
+    Module.objects.create(code="MA1234", year="2015-16")
+    call_command("refresh", "MA1234", db=True)
+    tree_id = Book.objects.get().tree.tree_id
+    columns = ("mpath", "parent__mpath", "lft", "rght", "level", "node_id", "node_type", "text")
+    bulk = list(BookNode.objects.filter(tree_id=tree_id).order_by("lft").values_list(*columns))
+    labels = sorted(Label.objects.values_list("text", "mpath"))
+
+    book = refresh.TexParser().parse_book(str(tex_root.join("MA1234", "main.tex")))
+    root = write_to_camel_database(book, prefix="MA1234.01", commit=True)
+    assert list(BookNode.objects.filter(tree_id=root.tree_id).order_by("lft").values_list(*columns)) == bulk
+    assert len(labels) == len(dict(labels)) > 0
+
+@pytest.mark.django_db
+def test_parallel_refresh_reports_failures(tex_root):
+    """
+    Test that with --jobs a module that fails to parse is reported without
+    stopping the other modules from being written
+    """
+    Module.objects.create(code="MA1234", year="2015-16")
+    with pytest.raises(CommandError) as excinfo:
+        call_command("refresh", "XX0000", "MA1234", db=True, jobs=2)
+    assert "XX0000" in str(excinfo.value)
+    assert "MA1234" not in str(excinfo.value)
+    assert Book.objects.get().tree.get_descendant_count() > 0
+
+def test_xml_is_written_to_xml_root(tex_root, monkeypatch):
+    """
+    Test that refresh --xml streams the xml tree to XML_ROOT/<module_code>.xml
+    """
+    monkeypatch.setattr(refresh, "XML_ROOT", str(tex_root.join("xml")))
+    call_command("refresh", "MA1234", xml=True)
+    book = refresh.TexParser().parse_book(str(tex_root.join("MA1234", "main.tex")))
+    book.title = "Lecture Notes"
+    xml = tex_root.join("xml", "MA1234.xml").read_binary().decode("utf-8")
+    assert xml.startswith(u'<?xml version="1.0" ?>\n')
+    assert u'<chapter label="chap:sets" number="1" title="Set Theory">' in xml
+    assert xml == book.prettyprint_xml()
+
+@pytest.mark.django_db
+def test_refresh_from_snapshot(tex_root, monkeypatch):
+    """
+    Test that a book loaded from a snapshot is written to the database exactly
+    like the parsed book, without the LaTeX sources
+    """
+    monkeypatch.setattr(refresh, "XML_ROOT", str(tex_root.join("xml")))
+    Module.objects.create(code="MA1234", year="2015-16")
+    columns = ("mpath", "lft", "rght", "level", "node_id", "node_type", "number", "title", "label", "text", "image")
+    call_command("refresh", "MA1234", db=True, snapshot="save")
+    parsed = list(BookNode.objects.order_by("lft").values_list(*columns))
+    labels = sorted(Label.objects.values_list("text", "mpath"))
+
+    tex_root.join("MA1234").remove()
+    call_command("refresh", "MA1234", db=True, snapshot="load")
+    assert list(BookNode.objects.order_by("lft").values_list(*columns)) == parsed
+    assert sorted(Label.objects.values_list("text", "mpath")) == labels
+
+def test_snapshot_rejects_unknown_node_types():
+    """
+    Test that a snapshot naming something other than a node type fails with
+    the line number, instead of building an arbitrary booktree attribute
+    """
+    header = '{"format": "camel-booktree", "version": 1, "preamble": {}}\n'
+    for node_type in ("texparser", "counters", "nosuchtype"):
+        source = StringIO(header + '[0,"book",null,null,null,null]\n[1,"%s",null,null,null,null]\n' % node_type)
+        with pytest.raises(ValueError) as excinfo:
+            read_snapshot(source)
+        assert "line 3" in str(excinfo.value)
+
+@pytest.mark.django_db
+def test_benchmark_records_stages(tmpdir):
+    """
+    Test that the benchmark command times every stage on a generated book
+    and appends the results as json
+    """
+    output = tmpdir.join("bench.jsonl")
+    call_command("benchmark", chapters=2, sections=1, questions=2, repeat=1, db=True, output=str(output))
+    result = json.loads(output.read().splitlines()[-1])
+    assert sorted(result["stages"]) == ["db", "parse_body", "parse_preamble", "read_latex_file", "xml"]
+    assert result["nodes"] > 100 and result["size"]["chapters"] == 2
+    assert not Module.objects.exists()
+
+@pytest.mark.django_db
+def test_refresh_profile(tex_root, tmpdir):
+    """
+    Test that --profile prints the parser stages and node counts, and that
+    --profile-dump writes cProfile data
+    """
+    Module.objects.create(code="MA1234", year="2015-16")
+    stdout = StringIO()
+    dump = str(tmpdir.join("refresh.prof"))
+    call_command("refresh", "MA1234", db=True, profile=True, profile_dump=dump, stdout=stdout)
+    report = stdout.getvalue()
+    for stage in ("read", "tokenize", "chop_snippet", "parse_tex", "jax", "db", "nodes"):
+        assert "\n  %s " % stage in report
+    assert "  chapter " in report
+    assert pstats.Stats(dump).total_calls > 0
+
+@pytest.mark.django_db
+def test_refresh_diff_reports_changes_without_writing(tex_root):
+    """
+    Test that --diff lists changed nodes and labels, flags nodes with answers
+    (the command fails) and leaves the database alone
+    """
+    Module.objects.create(code="MA1234", year="2015-16")
+    call_command("refresh", "MA1234", db=True)
+    stdout = StringIO()
+    call_command("refresh", "MA1234", diff=True, stdout=stdout)
+    assert "0 added, 0 removed, 0 changed" in stdout.getvalue()
+
+    node = BookNode.objects.get(text__contains="Games of chance")
+    mommy.make(Answer, question=node)
+    rows = list(BookNode.objects.order_by("pk").values_list("pk", "mpath", "text"))
+    edit(tex_root, "02_events.tex", "Games of chance", "Games of luck")
+    edit(tex_root, "02_events.tex", r"\label{ex:fields_of_sets}", r"\label{ex:fields}")
+    stdout = StringIO()
+    with pytest.raises(CommandError):
+        call_command("refresh", "MA1234", diff=True, stdout=stdout)
+    report = stdout.getvalue()
+    assert "0 added, 0 removed, 2 changed" in report
+    assert "~ %s" % node.mpath in report and "text  [1 answers]" in report
+    assert "labels: 1 added, 1 removed, 0 moved" in report
+    assert "- label MA1234.01.ex:fields_of_sets -> " in report
+    assert list(BookNode.objects.order_by("pk").values_list("pk", "mpath", "text")) == rows
+
+@pytest.mark.django_db
+def test_refresh_publishes_new_tree_atomically(tex_root, monkeypatch):
+    """
+    Test that a full refresh swaps in a new tree under the same Book and deletes
+    the old tree, and that a failed publish leaves the old tree in place
+    """
+    Module.objects.create(code="MA1234", year="2015-16")
+    call_command("refresh", "MA1234", db=True)
+    book = Book.objects.get()
+    old_tree_id = book.tree.tree_id
+    count = BookNode.objects.count()
+    labels = sorted(Label.objects.values_list("text", "mpath"))
+
+    call_command("refresh", "MA1234", db=True)
+    book = Book.objects.get(pk=book.pk)
+    assert book.tree.tree_id != old_tree_id
+    assert not BookNode.objects.filter(tree_id=old_tree_id).exists()
+    assert BookNode.objects.count() == count
+    assert sorted(Label.objects.values_list("text", "mpath")) == labels
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(Label.objects, "bulk_create", fail)
+    with pytest.raises(CommandError):
+        call_command("refresh", "MA1234", db=True)
+    assert Book.objects.get(pk=book.pk).tree_id == book.tree_id
+    assert BookNode.objects.count() == count
+    assert sorted(Label.objects.values_list("text", "mpath")) == labels
@@ -0,0 +1,55 @@
+from core.tokenizer import tokenize, TokenStream
+from core.booktree import TexParser
+
+
+def kinds(source):
+    return [(t.kind, t.name) for t in tokenize(source)]
+
+def test_tokenize_levels_environments_and_items():
+    """
+    Test that a single pass finds level commands, environments and items
+    """
+    source = r"\chapter{Sets}\begin{itemize}\item one \item two\end{itemize}"
+    assert kinds(source) == [
+        ('level', 'chapter'),
+        ('begin', 'itemize'),
+        ('item', 'item'),
+        ('item', 'item'),
+        ('end', 'itemize'),
+    ]
+    assert tokenize(source)[0].arg == 'Sets'
+
+def test_tokenize_marks_tokens_inside_math():
+    """
+    Test that refs inside math are flagged, and that math mode ends at a blank line
+    """
+    tokens = tokenize("$\\ref{a}$ \\ref{b} $ \n\n \\ref{c}")
+    refs = [t for t in tokens if t.kind == 'ref']
+    assert [(t.arg, t.math) for t in refs] == [('a', True), ('b', False), ('c', False)]
+
+def test_tokenize_skips_escaped_delimiters():
+    """
+    Test that \\$ and \\\\[ are not taken as math delimiters
+    """
+    assert kinds(r"costs \$5 \\[2pt] \ref{x}") == [('ref', 'ref')]
+
+def test_parse_snippet_splits_jax_on_references():
+    """
+    Test that a \\ref in running text becomes a Reference node between two Jax nodes
+    """
+    stream = TokenStream(r"By Lemma~\ref{lem:bayes}, we are done.")
+    children = TexParser().parse_snippet(stream, 0, len(stream), 0, len(stream.source))
+    assert [child.__class__.__name__ for child in children] == ['Jax', 'Reference', 'Jax']
+    assert children[1].content == 'lem:bayes'
+
+def test_parse_list_contents_skips_nested_lists():
+    """
+    Test that items of a nested list are not taken as items of the enclosing list
+    """
+    source = r"\begin{questions}\question A \begin{parts}\part x \part y\end{parts}\question B\end{questions}"
+    stream = TokenStream(source)
+    children = TexParser().parse_snippet(stream, 0, len(stream), 0, len(source))
+    questions = children[0]
+    assert [child.__class__.__name__ for child in questions.children] == ['Question', 'Question']
+    parts = questions.children[0].children[1]
+    assert [child.__class__.__name__ for child in parts.children] == ['Part', 'Part']
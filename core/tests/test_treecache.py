@@ -0,0 +1,147 @@
+import os
+import shutil
+
+import pytest
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+
+from core import treecache
+from core.booktree import TexParser
+from core.bookwriter import write_module, update_book, book_prefix
+from core.models import Book, BookNode
+
+
+def write(main_tex):
+    p = TexParser()
+    book = p.parse_book(main_tex)
+    write_module(book, p.parse_preamble(main_tex), commit=True)
+    return book
+
+def pks(nodes):
+    return [node.pk for node in nodes]
+
+@pytest.mark.django_db
+def test_navigation_matches_mptt_queries(django_assert_num_queries):
+    """
+    Test that a bound node answers subtrees, siblings, next/prev and type
+    filters like the MPTT queries do, without querying the database
+    """
+    write(os.path.join(settings.TEX_ROOT, "MA1234", "main.tex"))
+    chapter = BookNode.objects.filter(node_type="chapter").order_by("lft")[1]
+    section = chapter.get_children().last()
+    expected = (
+        pks(chapter.get_descendants(include_self=True)),
+        pks(section.get_siblings(include_self=True)),
+        pks(section.get_children()),
+        (chapter.get_next().pk, chapter.get_prev().pk),
+        pks(BookNode.objects.filter(tree_id=chapter.tree_id, lft__gt=chapter.lft, rght__lt=chapter.rght, node_type="question").order_by("lft")),
+    )
+
+    node = treecache.bind(BookNode.objects.select_related("book").get(pk=section.pk))
+    with django_assert_num_queries(0):
+        tree = treecache.get_tree(node.book_id, node.tree_id, node.book.revision)
+        chap = node.get_parent_chapter()
+        assert (
+            pks(chap.get_descendants(include_self=True)),
+            pks(node.get_siblings(include_self=True)),
+            pks(node.get_children()),
+            (chap.get_next().pk, chap.get_prev().pk),
+            pks(tree.select(within=chap.pk, node_type="question")),
+        ) == expected
+        assert chap.pk == chapter.pk and node.parent.parent.node_type == "book"
+        assert tree.get_previous_sibling(tree.select(node_type="book")[0].pk) is None
+
+@pytest.mark.django_db
+def test_cache_is_invalidated_by_book_revision(tmpdir):
+    """
+    Test that writing a book bumps its revision, so that the cached tree of
+    the old revision is not used again
+    """
+    shutil.copytree(os.path.join(settings.TEX_ROOT, "MA1234"), str(tmpdir.join("MA1234")))
+    main_tex = str(tmpdir.join("MA1234", "main.tex"))
+    write(main_tex)
+    cbook = Book.objects.get()
+    assert cbook.revision == 1
+    old = treecache.get_tree(cbook.pk, cbook.tree.tree_id, cbook.revision)
+
+    chapter_tex = str(tmpdir.join("MA1234", "02_events.tex"))
+    with open(chapter_tex) as f:
+        source = f.read()
+    with open(chapter_tex, "w") as f:
+        f.write(source.replace("Games of chance", "Games of luck"))
+    update_book(TexParser().parse_book(main_tex), cbook, book_prefix("MA1234", cbook.number))
+
+    cbook = Book.objects.get()
+    assert cbook.revision == 2
+    tree = treecache.get_tree(cbook.pk, cbook.tree.tree_id, cbook.revision)
+    assert tree is not old
+    assert any("Games of luck" in (node.text or "") for node in tree.select(node_type="jax"))
+    assert treecache.get_tree(cbook.pk, cbook.tree.tree_id, cbook.revision) is tree
+
+@pytest.mark.django_db
+def test_cache_is_keyed_by_book(tmpdir):
+    """
+    Test that a new book which reuses the tree_id and revision of a deleted
+    book does not get the cached tree of the deleted book
+    """
+    shutil.copytree(os.path.join(settings.TEX_ROOT, "MA1234"), str(tmpdir.join("MA1234")))
+    main_tex = str(tmpdir.join("MA1234", "main.tex"))
+    write(main_tex)
+    old_book = Book.objects.get()
+    old = treecache.get_tree(old_book.pk, old_book.tree.tree_id, old_book.revision)
+
+    BookNode.objects.all().delete()
+    assert not Book.objects.exists()
+    chapter_tex = str(tmpdir.join("MA1234", "02_events.tex"))
+    with open(chapter_tex) as f:
+        source = f.read()
+    with open(chapter_tex, "w") as f:
+        f.write(source.replace("Games of chance", "Games of luck"))
+    write(main_tex)
+
+    cbook = Book.objects.get()
+    assert (cbook.tree.tree_id, cbook.revision) == (old.tree_id, old.revision)
+    tree = treecache.get_tree(cbook.pk, cbook.tree.tree_id, cbook.revision)
+    assert tree is not old
+    assert any("Games of luck" in (node.text or "") for node in tree.select(node_type="jax"))
+
+@pytest.mark.django_db
+def test_navigation_of_other_node_types_is_not_found(client):
+    """
+    Test that the homework, test and answer views give 404 (not an error)
+    for a node that is not of their type
+    """
+    write(os.path.join(settings.TEX_ROOT, "MA1234", "main.tex"))
+    User.objects.create_user("reader", password="secret")
+    assert client.login(username="reader", password="secret")
+    chapter = BookNode.objects.filter(node_type="chapter").order_by("lft")[1]
+    homework = BookNode.objects.filter(node_type="homework").first()
+
+    for name in ("homework", "sctest", "edit-answer"):
+        assert client.get(reverse(name, kwargs={"pk": chapter.pk})).status_code == 404
+    assert client.get(reverse("homework", kwargs={"pk": homework.pk})).status_code == 200
+
+@pytest.mark.django_db
+def test_content_is_not_cached_but_loaded_per_page(django_assert_num_queries):
+    """
+    Test that cached trees hold no text or html, and that the content of the
+    nodes reached from one navigation call is loaded with one query
+    """
+    write(os.path.join(settings.TEX_ROOT, "MA1234", "main.tex"))
+    book = Book.objects.get()
+    tree = treecache.get_tree(book.pk, book.tree.tree_id, book.revision)
+    assert "text" not in tree.attnames and "html" not in tree.attnames
+
+    expected = dict(BookNode.objects.values_list("pk", "text"))
+    theorems = tree.select(node_class="theorem")
+    with django_assert_num_queries(1):
+        for theorem in theorems:
+            for node in theorem.get_descendants(include_self=True):
+                assert node.text == expected[node.pk]
+
+    chapter = treecache.bind(BookNode.objects.select_related("book").get(pk=theorems[0].chapter_id))
+    html = list(BookNode.objects.filter(tree_id=chapter.tree_id, lft__gt=chapter.lft, lft__lt=chapter.rght).order_by("lft").values_list("html", flat=True))
+    with django_assert_num_queries(1):
+        assert [node.html for node in chapter.get_descendants()] == html
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+'''
+tokenizer.py: single-pass tokenizer for latex source (camel.cls)
+
+    The tokenizer walks the expanded latex source exactly once and returns a flat
+    list of Token objects. The tree builders in booktree.py consume this list
+    instead of re-running regular expressions over slices of the source string.
+
+    #--------------------
+    Tokens
+    #--------------------
+    kind        name                                    arg
+    ----        ----                                    ---
+    level       chapter|section|subsection              title
+    begin       environment name                        optional argument (if any)
+    end         environment name                        None
+    item        item|question|part|subpart|...          None
+    label       None                                    label text
+    ref         ref|cite                                label text
+    graphics    None                                    image file name
+    caption     None                                    caption text
+    math        open|close                              delimiter
+
+    Every token records its start and end index in the source string, so that
+    text between tokens is obtained by slicing (once, at the leaves).
+
+    #--------------------
+    Math mode
+    #--------------------
+    Inline and display math delimiters ($, $$, \( \), \[ \]) are tracked by a tiny
+    state machine, and every token carries a flag saying whether it was found
+    inside math. Math mode is reset at paragraph breaks (blank lines), so a stray
+    dollar sign cannot swallow the rest of the document.
+
+    Mathmode environments (equation, align, ...) are *not* tracked here: these are
+    handled by the tree builder (see TexParser.chop_snippet).
+'''
+
+#------------------------------------------------
+# imports
+import re
+from collections import namedtuple
+
+#------------------------------------------------
+# token type
+Token = namedtuple('Token', 'kind name arg start end math')
+
+#------------------------------------------------
+# combined pattern
+#------------------------------------------------
+# Order matters: alternatives are tried left to right at each position.
+# The individual patterns are the ones previously used by TexParser.
+pattern = re.compile('|'.join([
+    r'(?P<escape>\\[\\$%&])',                                           # \\ \$ \% \& (skip)
+    r'\\(?P<level>chapter|section|subsection)\{(?P<level_arg>[^\}]*)\}',
+    r'\\(?P<env>begin|end)\{(?P<env_name>\w+)\}(\[(?P<env_opt>.*)\]|\{(.*)\})*',
+    r'\\label\{(?P<label>[^\}]*)\}',
+    r'\\(?P<ref>ref|cite)\{(?P<ref_arg>[^\}]+)\}',
+    r'\\includegraphics(\[[^\]]*\])*\{(?P<graphics>[^\}]+)\}',
+    r'\\caption\{(?P<caption>[^\}]+)\}',
+    r'\\(?P<item>item|question|part|subpart|choice|correctchoice)',
+    r'(?P<math>\$\$|\$|\\\[|\\\]|\\\(|\\\))',
+    r'(?P<par>\n[ \t]*\n)',                                             # paragraph break
+]))
+
+# closing delimiter for each opening math delimiter
+math_close = {'$': '$', '$$': '$$', r'\(': r'\)', r'\[': r'\]'}
+
+#------------------------------------------------
+# tokenize
+#------------------------------------------------
+def tokenize(source):
+    '''
+    Returns the list of tokens found in source (a single left-to-right pass)
+    '''
+    tokens = []
+    append = tokens.append
+    closer = None   # expected closing math delimiter (None if not in math mode)
+
+    for match in pattern.finditer(source):
+        kind = match.lastgroup
+        start, end = match.span()
+        math = closer is not None
+
+        if kind == 'escape':
+            continue
+
+        elif kind == 'par':
+            closer = None
+
+        elif kind == 'math':
+            delim = match.group('math')
+            if closer is None and delim in math_close:
+                closer = math_close[delim]
+                append( Token('math', 'open', delim, start, end, False) )
+            elif delim == closer:
+                closer = None
+                append( Token('math', 'close', delim, start, end, True) )
+
+        elif match.group('level'):
+            append( Token('level', match.group('level'), match.group('level_arg'), start, end, math) )
+
+        elif match.group('env'):
+            append( Token(match.group('env'), match.group('env_name'), match.group('env_opt') or None, start, end, math) )
+
+        elif match.group('label') is not None:
+            append( Token('label', None, match.group('label'), start, end, math) )
+
+        elif match.group('ref'):
+            append( Token('ref', match.group('ref'), match.group('ref_arg'), start, end, math) )
+
+        elif match.group('graphics'):
+            append( Token('graphics', None, match.group('graphics'), start, end, math) )
+
+        elif match.group('caption'):
+            append( Token('caption', None, match.group('caption'), start, end, math) )
+
+        elif match.group('item'):
+            append( Token('item', match.group('item'), None, start, end, math) )
+
+    return tokens
+
+#------------------------------------------------
+# TokenStream: source string plus its tokens
+#------------------------------------------------
+class TokenStream(object):
+    def __init__(self, source, source_map=None):
+        self.source = source
+        self.source_map = source_map    # character offset -> (filename, lineno), see preprocess.py
+        self.tokens = tokenize(source)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def text(self, start, end):
+        return self.source[start:end]
@@ -0,0 +1,303 @@
+#!/usr/bin/python
+'''
+treecache.py: process-level cache of book trees for read-only navigation
+
+    node = bind( BookNode.objects.select_related('book').get(pk=pk) )
+    node.get_descendants()                    -> list of BookNodes (no query)
+    get_tree( book.pk, tree_id, revision ).select( node_type='chapter' )
+
+    Book content only changes when refresh runs, so the nodes of a book are loaded once
+    per process (one query, in tree order) into a BookTree: the rows, and arrays for the
+    structure of the tree (parent, first child, next sibling and the end of the subtree
+    of each node, as indices into the rows) and for the node types and classes.
+
+    The rows hold every column except the content (text and prerendered html, see
+    CONTENT_FIELDS), so a cached tree stays small. The content of the nodes a page shows
+    is loaded on first access: nodes built by one navigation call (and the nodes reached
+    from them) share a NodeContent, which loads the content of all their subtrees in one
+    query.
+
+    Nodes that come from a BookTree (or are bound to one) answer get_children,
+    get_descendants, get_siblings and get_next_sibling/get_previous_sibling from memory
+    (see BookNode), and have their parent, ancestors and chapter attached. Every call
+    returns fresh BookNode instances, so requests never share (or modify) each others
+    instances.
+
+    #--------------------
+    Invalidation
+    #--------------------
+    Trees are cached by (book id, tree_id, revision): bookwriter bumps Book.revision whenever
+    it writes a tree, so a stale tree is never looked up again and drops out of the cache
+    (least recently used, at most MAX_TREES trees per process). Changes made outside of
+    bookwriter (e.g. in the admin) are not seen until the next refresh. The book id is part
+    of the key because tree_ids are reused (the next tree_id is one more than the highest in
+    use) and a new book starts again at revision 1.
+'''
+
+#------------------------------------------------
+# imports
+import logging, threading
+from array import array
+from collections import OrderedDict
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.db.models.query_utils import deferred_class_factory
+
+from core.models import BookNode
+
+#------------------------------------------------
+# logging
+out = logging.getLogger(__name__)
+
+# maximum number of trees cached per process
+MAX_TREES = 16
+
+# columns that are not cached, but loaded for the nodes of a page (see NodeContent)
+CONTENT_FIELDS = ('text', 'html')
+
+#------------------------------------------------
+# NodeContent
+#------------------------------------------------
+class NodeContent(object):
+    '''
+    Content (CONTENT_FIELDS) of the nodes built from a BookTree, loaded on first access
+    Nodes are added with the subtrees they stand for (e.g. the nodes of get_descendants);
+    the first access to the content of any node loads the content of all subtrees added
+    so far, in one query.
+    '''
+    def __init__(self, tree):
+        self.tree = tree
+        self.roots = []     # indices of nodes whose subtrees are wanted
+        self.values = {}    # index -> tuple of CONTENT_FIELDS values
+
+    def add(self, indices):
+        self.roots.extend( indices )
+
+    def provides(self, fields):
+        return all( field in CONTENT_FIELDS for field in fields )
+
+    def load(self, node):
+        idx = self.tree.index[node.pk]
+        if idx not in self.values:
+            self.fetch( idx )
+        for attname, value in zip(CONTENT_FIELDS, self.values[idx]):
+            setattr( node, attname, value )
+
+    def fetch(self, idx):
+        wanted = set( [idx] )
+        for root in self.roots:
+            wanted.update( range(root, self.tree.end[root]) )
+        self.roots = []
+        missing = sorted( wanted.difference(self.values) )
+
+        # consecutive indices are a range of lft values
+        lft = self.tree.column['lft']
+        ranges = Q()
+        start = 0
+        for pos in range(1, len(missing) + 1):
+            if pos == len(missing) or missing[pos] != missing[pos-1] + 1:
+                first, last = self.tree.rows[ missing[start] ], self.tree.rows[ missing[pos-1] ]
+                ranges |= Q(lft__gte=first[lft], lft__lte=last[lft])
+                start = pos
+        rows = BookNode.objects.filter(ranges, tree_id=self.tree.tree_id).order_by().values_list('pk', *CONTENT_FIELDS)
+        for row in rows:
+            self.values[ self.tree.index[row[0]] ] = row[1:]
+
+#------------------------------------------------
+# BookTree
+#------------------------------------------------
+def attnames():
+    '''
+    Cached columns of a BookNode (all but CONTENT_FIELDS)
+    '''
+    return [ field.attname for field in BookNode._meta.concrete_fields if field.attname not in CONTENT_FIELDS ]
+
+class BookTree(object):
+    '''
+    The nodes of one tree in document (lft) order
+    Descendants of the node at index i are at indices i+1 ... end[i]-1.
+    '''
+    def __init__(self, tree_id, revision, rows):
+        self.tree_id = tree_id
+        self.revision = revision
+        self.attnames = attnames()
+        self.model = deferred_class_factory( BookNode, CONTENT_FIELDS )
+        self.rows = rows
+        size = len(rows)
+        self.column = column = dict( (attname, idx) for idx, attname in enumerate(self.attnames) )
+        pk, parent_id = column['id'], column['parent_id']
+
+        self.index = {}                             # pk -> index
+        self.parent = array('i', [-1]) * size
+        self.first_child = array('i', [-1]) * size
+        self.next_sibling = array('i', [-1]) * size
+        self.end = array('i', [0]) * size
+        self.node_type = [ row[ column['node_type'] ] for row in rows ]
+        self.node_class = [ row[ column['node_class'] ] for row in rows ]
+
+        last_child = {}
+        for idx, row in enumerate(rows):
+            self.index[ row[pk] ] = idx
+            parent = self.index.get( row[parent_id], -1 )
+            self.parent[idx] = parent
+            if parent < 0:
+                continue
+            if parent in last_child:
+                self.next_sibling[ last_child[parent] ] = idx
+            else:
+                self.first_child[parent] = idx
+            last_child[parent] = idx
+        for idx in reversed(range(size)):
+            self.end[idx] = self.end[ last_child[idx] ] if idx in last_child else idx + 1
+
+    def __len__(self):
+        return len(self.rows)
+
+    @classmethod
+    def load(cls, tree_id, revision):
+        rows = BookNode.objects.filter(tree_id=tree_id).order_by('lft').values_list( *attnames() )
+        return cls( tree_id, revision, list(rows) )
+
+    #------------------------------------------------
+    # instances
+    def nodes(self, indices, content=None):
+        '''
+        Returns fresh BookNode instances for indices (parents and ancestors attached)
+        content: the NodeContent of the node the indices were reached from (None for a new one)
+        '''
+        content = content or NodeContent(self)
+        content.add( indices )
+        built = {}
+        return [ self.build(idx, built, content) for idx in indices ]
+
+    def build(self, idx, built, content):
+        node = built.get(idx)
+        if node is not None:
+            return node
+        node = self.model.from_db( DEFAULT_DB_ALIAS, self.attnames, self.rows[idx] )
+        parent = self.build( self.parent[idx], built, content ) if self.parent[idx] >= 0 else None
+        self.attach( node, parent, content )
+        built[idx] = node
+        return node
+
+    def attach(self, node, parent, content):
+        node._book_tree = self
+        node._node_content = content
+        node._parent_cache = parent
+        node._ancestor_chain = ( parent._ancestor_chain if parent else [] ) + [node]
+        if node.chapter_id:
+            for ancestor in node._ancestor_chain:
+                if ancestor.pk == node.chapter_id:
+                    node._chapter_cache = ancestor
+
+    def bind(self, node):
+        '''
+        Attach the tree (and the ancestors) to a node of the tree loaded elsewhere
+        '''
+        idx = self.index[node.pk]
+        content = NodeContent(self)
+        parent = self.build( self.parent[idx], {}, content ) if self.parent[idx] >= 0 else None
+        self.attach( node, parent, content )
+        return node
+
+    def node(self, pk, content=None):
+        return self.nodes( [ self.index[pk] ], content )[0]
+
+    #------------------------------------------------
+    # navigation (pk of a node of the tree -> list of BookNodes)
+    def children(self, idx):
+        indices = []
+        idx = self.first_child[idx]
+        while idx >= 0:
+            indices.append( idx )
+            idx = self.next_sibling[idx]
+        return indices
+
+    def get_children(self, pk, content=None):
+        return self.nodes( self.children( self.index[pk] ), content )
+
+    def get_descendants(self, pk, include_self=False, content=None):
+        idx = self.index[pk]
+        start = idx if include_self else idx + 1
+        return self.nodes( range(start, self.end[idx]), content )
+
+    def get_siblings(self, pk, include_self=False, content=None):
+        idx = self.index[pk]
+        if self.parent[idx] < 0:
+            return self.nodes( [idx], content ) if include_self else []
+        indices = self.children( self.parent[idx] )
+        return self.nodes( [ sibling for sibling in indices if include_self or sibling != idx ], content )
+
+    def get_next_sibling(self, pk, content=None):
+        idx = self.next_sibling[ self.index[pk] ]
+        return self.nodes( [idx], content )[0] if idx >= 0 else None
+
+    def get_previous_sibling(self, pk, content=None):
+        idx = self.index[pk]
+        if self.parent[idx] < 0:
+            return None
+        indices = self.children( self.parent[idx] )
+        position = indices.index(idx)
+        return self.nodes( [ indices[position - 1] ], content )[0] if position > 0 else None
+
+    def select(self, within=None, node_type=None, node_class=None, content=None):
+        '''
+        Nodes of the subtree of within (all nodes if None, in document order) by type:
+        node_type is a node type or a list of node types
+        '''
+        if within is None:
+            start, stop = 0, len(self.rows)
+        else:
+            start = self.index[within]
+            stop = self.end[start]
+        if isinstance(node_type, basestring):
+            node_type = [node_type]
+        indices = [ idx for idx in range(start, stop)
+            if (node_type is None or self.node_type[idx] in node_type)
+            and (node_class is None or self.node_class[idx] == node_class) ]
+        return self.nodes( indices, content )
+
+#------------------------------------------------
+# cache
+#------------------------------------------------
+trees = OrderedDict()       # (book_id, tree_id, revision) -> BookTree, least recently used first
+lock = threading.Lock()
+
+def get_tree(book_id, tree_id, revision):
+    '''
+    Returns the BookTree of tree_id (the tree of book_id) at revision (Book.revision),
+    loaded if necessary
+    '''
+    key = (book_id, tree_id, revision)
+    with lock:
+        tree = trees.pop(key, None)
+        if tree is not None:
+            trees[key] = tree
+            return tree
+    tree = BookTree.load( tree_id, revision )
+    out.info('Loaded tree %s (revision %s): %d nodes', tree_id, revision, len(tree))
+    with lock:
+        trees[key] = tree
+        while len(trees) > MAX_TREES:
+            trees.popitem(last=False)
+    return tree
+
+def tree_of(node):
+    '''
+    Returns the BookTree of node (loaded with select_related('book')); the tree of a
+    node without a book is loaded but not cached
+    '''
+    if node.book is None:
+        return BookTree.load( node.tree_id, None )
+    return get_tree( node.book_id, node.tree_id, node.book.revision )
+
+def bind(node):
+    '''
+    Bind node to its tree, see BookTree.bind
+    '''
+    return tree_of( node ).bind( node )
+
+def clear():
+    with lock:
+        trees.clear()
@@ -7,7 +7,7 @@ import random
 from django import forms
 
 # http
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponse, Http404
 from django.shortcuts import render, render_to_response, get_object_or_404
 from django.http import HttpResponse, HttpResponseRedirect
 from django.core.urlresolvers import reverse, reverse_lazy
@@ -29,8 +29,23 @@ from django.views.generic.detail import DetailView
 # camel
 from core.models import Module, Book, BookNode, Label, Answer, SingleChoiceAnswer, Submission
 from core.forms import UserForm, AnswerForm, SubmissionForm
+from core import treecache
 # from camel.forms import SingleChoiceAnswerForm
 
+#--------------------
+# navigation
+#--------------------
+def next_prev(nodes, node):
+    '''
+    Returns (next, prev) of node among nodes (document order), None at either end
+    Raises Http404 if node is not one of them (e.g. the url names a node of another type)
+    '''
+    pks = [ n.pk for n in nodes ]
+    if node.pk not in pks:
+        raise Http404('No %s navigation for node %s' % (node.node_type, node.pk))
+    idx = pks.index( node.pk )
+    return ( nodes[idx+1] if idx + 1 < len(nodes) else None, nodes[idx-1] if idx > 0 else None )
+
 #--------------------
 # basic
 #--------------------
@@ -63,13 +78,14 @@ class Module_DetailView(DetailView):
 
 class Book_DetailView(DetailView):
     model = Book
+    queryset = Book.objects.select_related('module', 'tree')
     template_name = 'book_detail.html'
     def get_context_data(self, **kwargs):
         context = super(Book_DetailView, self).get_context_data(**kwargs)
         book = self.get_object()
         context['book'] = book
         context['module'] = book.module
-        context['chapters'] = BookNode.objects.filter( node_type="chapter", mpath__startswith=book.tree.mpath )
+        context['chapters'] = treecache.get_tree( book.pk, book.tree.tree_id, book.revision ).select( node_type="chapter" )
         context['next'] = book.get_next()
         context['prev'] = book.get_prev()
         context['toc'] = Book.objects.filter(module=book.module.id).order_by('number')
@@ -77,14 +93,16 @@ class Book_DetailView(DetailView):
 
 class Chapter_DetailView(DetailView):
     model = BookNode
+    queryset = BookNode.objects.select_related('module', 'book')
     template_name = 'chapter_detail.html'
+    def get_object(self, queryset=None):
+        return treecache.bind( super(Chapter_DetailView, self).get_object(queryset) )
     def get_context_data(self, **kwargs):
         context = super(Chapter_DetailView, self).get_context_data(**kwargs)
-        chapter = self.get_object()
-        context['module']  = Module.objects.get( code=chapter.mpath[:6] )
-        context['book']  = Book.objects.get( tree=chapter.get_root_node() )
+        chapter = self.object
+        context['module']  = chapter.module
+        context['book']  = chapter.book
         context['chapter'] = chapter
-        context['subtree'] = chapter.get_descendants(include_self=True)
         context['toc'] = chapter.get_siblings(include_self=True)
         context['next'] = chapter.get_next()
         context['prev'] = chapter.get_prev()
@@ -92,21 +110,23 @@ class Chapter_DetailView(DetailView):
 
 class BookNode_DetailView(DetailView):
     model = BookNode
+    queryset = BookNode.objects.select_related('module', 'book')
     template_name = 'booknode_detail.html'
+    def get_object(self, queryset=None):
+        return treecache.bind( super(BookNode_DetailView, self).get_object(queryset) )
     # def get_success_url(self):
     #     return reverse('chapter-list')
     def get_context_data(self, **kwargs):
         context = super(BookNode_DetailView, self).get_context_data(**kwargs)
-        subtree = self.get_object().get_descendants(include_self=True)
-        mcode = self.get_object().mpath[:6]
-        module = get_object_or_404(Module, code=mcode)
+        booknode = self.object
+        subtree = booknode.get_descendants(include_self=True)
+        module = booknode.module
         context['module']  = module
         context['subtree']  = subtree
-        chapter = self.get_parent_chapter()
-        context['chapter']  = chapter
+        context['chapter']  = booknode.chapter
         context['toc']  = Book.objects.filter( module=module )
-        context['next'] = self.get_object().get_next()
-        context['prev'] = self.get_object().get_prev()
+        context['next'] = booknode.get_next()
+        context['prev'] = booknode.get_prev()
         return context
 
 # the following should be implemented with javascript on the client
@@ -114,28 +134,33 @@ class BookNode_DetailView(DetailView):
 
 def selected(request, pk, node_type):
     context = {}
-    booknode = BookNode.objects.get(pk=pk)
-    module  = Module.objects.get(code=booknode.mpath[:6] )
-    chapter = BookNode.objects.get(mpath=booknode.mpath[:12] )
+    booknode = get_object_or_404( BookNode.objects.select_related('module', 'book'), pk=pk )
+    tree = treecache.tree_of( booknode )
+    booknode = tree.bind( booknode )
+    module  = booknode.module
+    chapter = booknode.chapter
 
     context['module']  = module
     context['chapter']  = chapter
-    context['book']  = Book.objects.get( tree=chapter.get_root_node() )
+    context['book']  = booknode.book
     context['user']  = request.user
 
     context['node_type'] = node_type
 
     if node_type == 'theorem':
-        qset = BookNode.objects.filter(node_class="theorem", mpath__startswith=chapter.mpath).order_by('mpath')
+        qset = tree.select( within=chapter.pk, node_class="theorem" )
     elif node_type == 'test':
-        qset = BookNode.objects.filter(node_type__in=['singlechoice','multiplechoice'], mpath__startswith=chapter.mpath).order_by('mpath')
+        qset = tree.select( within=chapter.pk, node_type=['singlechoice','multiplechoice'] )
     else:
-        qset = BookNode.objects.filter(node_type=node_type, mpath__startswith=chapter.mpath).order_by('mpath')
+        qset = tree.select( within=chapter.pk, node_type=node_type )
     context['booknodes'] = qset
 
     context['next'] = chapter.get_next()
     context['prev'] = chapter.get_prev()
-    context['toc'] = BookNode.objects.filter( node_type="chapter", mpath__startswith=module.code).order_by('mpath')
+    toc = []
+    for book_id, tree_id, revision in Book.objects.filter(module=module, tree__isnull=False).order_by('number').values_list('pk', 'tree__tree_id', 'revision'):
+        toc.extend( treecache.get_tree(book_id, tree_id, revision).select( node_type="chapter" ) )
+    context['toc'] = toc
     return render(request, 'chapter_selected_nodes.html', context)
 
 # # the following should be implemented with javascript on the client
@@ -225,21 +250,20 @@ def selected(request, pk, node_type):
 @login_required
 def edit_answer(request, pk):
     context = {}
-    qu = BookNode.objects.get(pk=pk)
-    context['module']  = get_object_or_404( Module, code=qu.mpath[:6] )
-    context['book']  = Book.objects.get( tree=qu.get_root_node() )
+    qu = get_object_or_404( BookNode.objects.select_related('module', 'book'), pk=pk )
+    tree = treecache.tree_of( qu )
+    qu = tree.bind( qu )
+    context['module']  = qu.module
+    context['book']  = qu.book
     context['question'] = qu
     context['subtree'] = qu.get_descendants(include_self=True)
-    context['chapter'] = qu.get_parent_chapter()
+    context['chapter'] = qu.chapter
     context['assignment'] = qu.get_parent_assignment()
     context['toc'] = qu.get_siblings(include_self=True)
 
     # navigation
-    questions = BookNode.objects.filter( node_type="question", mpath__startswith=qu.mpath[:12] ).order_by('mpath')
-    next = questions.filter( mpath__gt=qu.mpath )
-    prev = questions.filter( mpath__lt=qu.mpath ).order_by('-pk')
-    context['next'] = next[0] if next else None
-    context['prev'] = prev[0] if prev else None
+    questions = tree.select( within=qu.chapter_id, node_type="question" )
+    context['next'], context['prev'] = next_prev( questions, qu )
 
 	# answer form
     # retreive current saved answer (if any)
@@ -293,29 +317,29 @@ def edit_answer(request, pk):
 @login_required
 def sctest(request, pk):
     context = {}
-    test = BookNode.objects.get(pk=pk)
-    chapter = test.get_parent_chapter()
-    questions = BookNode.objects.filter(node_type='question', mpath__startswith=test.mpath).order_by('mpath')
-
-    context['module']  = get_object_or_404( Module, code=test.mpath[:6] )
+    test = get_object_or_404( BookNode.objects.select_related('module', 'book'), pk=pk )
+    tree = treecache.tree_of( test )
+    test = tree.bind( test )
+    chapter = test.chapter
+    questions = tree.select( within=test.pk, node_type='question' )
+
+    context['user'] = request.user     # to splice the prerendered html (no RequestContext)
+    context['module']  = test.module
     context['test'] = test
     context['chapter'] = chapter
     context['questions'] = questions
-    context['book']  = Book.objects.get( tree=chapter.get_root_node() )
-    context['toc'] = BookNode.objects.filter( node_type="homework", mpath__startswith=chapter.mpath ).order_by('mpath')
+    context['book']  = test.book
+    context['toc'] = tree.select( within=chapter.pk, node_type="homework" )
 
     # navigation
-    tests = BookNode.objects.filter( node_type__in=['singlechoice','multiplechoice'], mpath__startswith=chapter.mpath ).order_by('mpath')
-    next = tests.filter( mpath__gt=test.mpath )
-    prev = tests.filter( mpath__lt=test.mpath ).order_by('-mpath')
-    context['next'] = next[0] if next else None
-    context['prev'] = prev[0] if prev else None
+    tests = tree.select( within=chapter.pk, node_type=['singlechoice','multiplechoice'] )
+    context['next'], context['prev'] = next_prev( tests, test )
 
     triplets = []
 
     # create question-choices-answer triplets (answer=None is not yet attempted)
     for qu in questions:
-        choices = BookNode.objects.filter( node_type__in=['choice','correctchoice'], mpath__startswith=qu.mpath)
+        choices = [ node for node in qu.get_descendants() if node.node_type in ('choice', 'correctchoice') ]
         answer = SingleChoiceAnswer.objects.filter(user=request.user, question=qu).first() # returns none if not yet attempted
         triplets.append([ qu, choices, answer])
 
@@ -377,24 +401,24 @@ def sctest(request, pk):
 @login_required
 def homework(request, pk):
     context = {}
-    hwk = BookNode.objects.get(pk=pk)
-    context['module']  = get_object_or_404( Module, code=hwk.mpath[:6] )
+    hwk = get_object_or_404( BookNode.objects.select_related('module', 'book'), pk=pk )
+    tree = treecache.tree_of( hwk )
+    hwk = tree.bind( hwk )
+    context['user'] = request.user     # to splice the prerendered html (no RequestContext)
+    context['module']  = hwk.module
     context['homework'] = hwk
     # context['subtree'] = ex.get_descendants(include_self=True)
-    chapter = hwk.get_parent_chapter()
+    chapter = hwk.chapter
     context['chapter'] = chapter
-    context['book']  = Book.objects.get( tree=chapter.get_root_node() )
-    context['toc'] = BookNode.objects.filter( node_type="homework", mpath__startswith=hwk.mpath[:9] ).order_by('mpath')
+    context['book']  = hwk.book
+    homeworks = tree.select( node_type="homework" )
+    context['toc'] = homeworks
 
     # navigation
     module = context['module']
-    homeworks = BookNode.objects.filter( node_type="homework", mpath__startswith=hwk.mpath[:9] ).order_by('mpath')
-    next = homeworks.filter( mpath__gt=hwk.mpath )
-    prev = homeworks.filter( mpath__lt=hwk.mpath ).order_by('-mpath')
-    context['next'] = next[0] if next else None
-    context['prev'] = prev[0] if prev else None
+    context['next'], context['prev'] = next_prev( homeworks, hwk )
 
-    questions = BookNode.objects.filter(node_type='question', mpath__startswith=hwk.mpath).order_by('mpath')
+    questions = tree.select( within=hwk.pk, node_type='question' )
     context['questions'] = questions
     answers = []
 
@@ -25,11 +25,8 @@ class ReviewIndexView(StaffRequiredMixin, View):
 class ReviewBookView(StaffRequiredMixin, View):
 
     def get(self, request, book_pk):
-        book = Book.objects.get(pk=book_pk)
-        booknode = book.tree
-        chapter = BookNode.objects.get(mpath=booknode.mpath[:12] )
-
-        booknodes = BookNode.objects.filter(node_type="question", mpath__startswith=chapter.mpath).order_by('mpath')
+        book = Book.objects.select_related('tree').get(pk=book_pk)
+        booknodes = BookNode.objects.filter(node_type="question", tree_id=book.tree.tree_id).order_by('mpath')
 
         return render(request, "review/book_index.html", {"book": book, "questions": booknodes})
 